@@ -9,33 +9,81 @@ Author: Nathan Hsu
 __version__ = "1.1"
 __author__ = "Nathan Hsu"
 
-from yahoofinancials import YahooFinancials
 import json
-import csv
-from re import sub
+import re
 import argparse
+import atexit
+import csv
+import functools
+import heapq
+import importlib.util
+import sys
 import time
 import os
-from multiprocessing import Process
+import io
 import threading
 import sqlite3 as sq
-import pandas as pd
 from datetime import date, timedelta
-import requests
-from bs4 import BeautifulSoup
-from functools import cmp_to_key
+from contextlib import contextmanager, nullcontext
+
+
+def lazy_import(name):
+    """ Imports a module when one of its attributes is first used, instead of now. Re-ranking stored data (the rank
+        command) never uses numpy or pandas, and starts much faster without importing them. yahoofinancials,
+        yahoo_async, and multiprocessing are imported by the functions that use them """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ModuleNotFoundError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+cProfile = lazy_import("cProfile")
+pstats = lazy_import("pstats")
+tracemalloc = lazy_import("tracemalloc")
 
 fn_balance = 'quarterly_balance_sheet'
 fn_income = 'quarterly_income_statement'
 fn_cap = 'market_cap_info'
 fn_tickers = 'ticker_dict'
 fn_price = 'price_dict'
+fn_sector = 'sector_info'
 fn_stock_info_db = 'stock_info.db'
+fn_response_cache = 'response_cache.db'
 nasdaq_csv = "nasdaq_stocks.csv"
 batch_size = 10
 max_threads = 3  # Somewhere between 10 and 15 threads with batch_size of 10 seems to be allowed
+thread_start_delay = 3  # Seconds between starting two retrieval/validation threads, so requests don't come in TOO fast
 min_market_cap = 50000000
 min_dollar_volume = 10000000  # based on 10-day and 90-day average volume
+error_flush_size = 500  # Errors are written to the db in batches of this size...
+error_flush_interval = 5  # ...or at least this often, in seconds
+db_cache_size = -64000  # SQLite page cache; negative values are in KiB
+request_rate = 2.0  # Requests per second made by the asyncio retrieval engine (--async)
+max_concurrency = 8  # Maximum number of requests in flight for the asyncio retrieval engine
+yahoo_base_url = None  # Where the asyncio engine sends requests instead of Yahoo Finance (e.g. a yahoo_mock server)
+METRIC_STATEMENTS = "statements"  # retrieve_data metric for the balance sheet and income statement together
+use_response_cache = True  # Whether fresh responses in the response cache are used instead of retrieving again
+response_cache_size = 256 * 2 ** 20  # Maximum size of the cached responses, in bytes
+# How long a cached response stays fresh, in seconds, for each endpoint
+response_cache_ttls = {"balance": 7 * 24 * 3600, "income": 7 * 24 * 3600, "volume": 24 * 3600}
+min_quarter_days = 89  # The shortest quarter; no new quarterly statement can be filed sooner after the latest one
+refresh_budget = 500  # Maximum number of requests made by a scheduled refresh (--schedule)
+empty_retry_days = 30  # A ticker retrieved without statements is only scheduled again after this many days
+local_validation = False  # Validate with the screener's volume instead of Yahoo Finance's ten-day average volume
+escalate_margin = 0.0  # With local validation, tickers this close (a fraction) to min_dollar_volume are checked online
+max_statement_age = 400  # Stocks whose statements are older than this many days aren't ranked
+filing_lag = 90  # Days after a quarter ends that its statements are assumed to be public (the deadline of a 10-K)
+portfolio_size = 30  # Number of top ranked stocks held by each backtest portfolio
+holding_days = 365  # Number of days each backtest portfolio is held
 TICKER_VALID = 1
 TICKER_INVALID = 0
 TICKER_NOT_VALIDATED = -1
@@ -48,6 +96,7 @@ ticker_lock = threading.Lock()
 
 debug = False
 verbose = False  # This can be set in the command line
+echo_errors = True  # Print errors as they are logged; this can be turned off in the command line
 
 """
 BACK
@@ -66,6 +115,253 @@ BACK
 """
 
 
+class Metrics:
+    """ Timers and counters of a run, so that it can be seen where the time goes. Both can have labels, e.g.
+        count("errors", type="metric"). Safe to use from multiple threads """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timers = {}  # (name, labels) -> [count, total seconds, max seconds]
+        self.counters = {}  # (name, labels) -> value
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    @contextmanager
+    def locked(self, lock, lock_name):
+        """ Acquires lock (like "with lock:"), recording how long it was waited for """
+        start = time.perf_counter()
+        with lock:
+            self.observe("lock_wait_seconds", time.perf_counter() - start, lock=lock_name)
+            yield
+
+    def state(self):
+        """ The timers and counters as plain (picklable) dicts, e.g. to send them from a worker process to merge() """
+        with self._lock:
+            return {key: list(timer) for key, timer in self.timers.items()}, dict(self.counters)
+
+    def merge(self, state):
+        timers, counters = state
+        with self._lock:
+            for key, (count, seconds, max_seconds) in timers.items():
+                timer = self.timers.setdefault(key, [0, 0.0, 0.0])
+                timer[0] += count
+                timer[1] += seconds
+                timer[2] = max(timer[2], max_seconds)
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+    def to_dict(self):
+        timers, counters = self.state()
+        result = {"timers": {}, "counters": {}}
+        for (name, labels), (count, seconds, max_seconds) in sorted(timers.items()):
+            result["timers"].setdefault(name, []).append({"labels": dict(labels), "count": count, "seconds": seconds,
+                                                          "max_seconds": max_seconds})
+        for (name, labels), value in sorted(counters.items()):
+            result["counters"].setdefault(name, []).append({"labels": dict(labels), "value": value})
+        return result
+
+    def to_prometheus(self, prefix="magic_formula"):
+        """ The timers (as summaries with a _max gauge) and counters in the Prometheus text exposition format """
+        def series(name, labels, value):
+            label_text = ",".join(f'{key}="{str(label).replace(chr(34), chr(92) + chr(34))}"' for key, label in labels)
+            return f"{prefix}_{name}{{{label_text}}} {value}" if labels else f"{prefix}_{name} {value}"
+
+        timers, counters = self.state()
+        lines = []
+        for name in sorted({name for name, _ in timers}):
+            keys = sorted(key for key in timers if key[0] == name)
+            lines.append(f"# TYPE {prefix}_{name} summary")
+            for _, labels in keys:
+                lines.append(series(f"{name}_sum", labels, timers[(name, labels)][1]))
+                lines.append(series(f"{name}_count", labels, timers[(name, labels)][0]))
+            lines.append(f"# TYPE {prefix}_{name}_max gauge")
+            lines.extend(series(f"{name}_max", labels, timers[(name, labels)][2]) for _, labels in keys)
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.extend(series(f"{name}_total", labels, counters[(name, labels)])
+                         for _, labels in sorted(key for key in counters if key[0] == name))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, file_name):
+        """ Writes the metrics to file_name: in the Prometheus text format if it ends with .prom, otherwise as JSON """
+        with open(file_name, 'w') as metrics_file:
+            if file_name.endswith('.prom'):
+                metrics_file.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), metrics_file, indent=2)
+
+
+metrics = Metrics()
+
+
+class Profiler:
+    """ Profiles each stage with cProfile, and optionally the memory allocated by the JSON loads with tracemalloc.
+        A stage called from within another stage is profiled as part of the outer one. Before Python 3.12, stages that
+        run in threads are profiled in those threads. From 3.12 on, cProfile uses sys.monitoring, so only one profile
+        can be enabled in the whole process and it sees every thread: a stage that starts while another one is being
+        profiled is profiled as part of it. The worker processes of -mc aren't profiled """
+    # Whether each thread can have its own enabled profile (cProfile used sys.setprofile before Python 3.12)
+    PER_THREAD = sys.version_info < (3, 12)
+    _enabled = 0  # Profiles enabled in this process, by any Profiler
+    _enabled_lock = threading.Lock()
+
+    def __init__(self, directory, top_n=20, trace_memory=False):
+        self.directory = directory
+        self.top_n = top_n
+        self.trace_memory = trace_memory
+        self.profiles = {}  # stage -> [cProfile.Profile, ...], one per outermost call
+        self.memory = []  # (label, snapshot before, snapshot after, peak bytes)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name):
+        if getattr(self._local, 'active', False):
+            yield
+            return
+        profile = cProfile.Profile()
+        with Profiler._enabled_lock:
+            if not self.PER_THREAD and Profiler._enabled:
+                profile = None
+            else:
+                try:
+                    profile.enable()
+                except ValueError:  # Another profiler (e.g. a debugger's) is already active
+                    profile = None
+                else:
+                    Profiler._enabled += 1
+        if profile is None:
+            yield
+            return
+        self._local.active = True
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.active = False
+            with Profiler._enabled_lock:
+                Profiler._enabled -= 1
+            with self._lock:
+                self.profiles.setdefault(name, []).append(profile)
+
+    @contextmanager
+    def traced_memory(self, label):
+        if not self.trace_memory:
+            yield
+            return
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        before = tracemalloc.take_snapshot()
+        try:
+            yield
+        finally:
+            after = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            if started:
+                tracemalloc.stop()
+            # The snapshots are compared in write(), so that comparing them isn't profiled as part of the stage
+            self.memory.append((label, before, after, peak))
+
+    def stats(self, stage):
+        """ The pstats.Stats of all calls of a stage """
+        first, *rest = self.profiles[stage]
+        stats = pstats.Stats(first)
+        for profile in rest:
+            stats.add(profile)
+        return stats
+
+    def write(self):
+        """ Writes a <stage>.prof file for each stage (readable with pstats or snakeviz), and summary.txt with each
+            stage's top_n functions by own time and by cumulative time, and the memory allocated by the JSON loads.
+            Returns the summary's path """
+        os.makedirs(self.directory, exist_ok=True)
+        summary = io.StringIO()
+        for stage in sorted(self.profiles):
+            stats = self.stats(stage)
+            stats.dump_stats(os.path.join(self.directory, f"{stage}.prof"))
+            summary.write(f"=== {stage}: {len(self.profiles[stage])} call(s), {stats.total_tt:.3f}s ===\n")
+            stats.stream = summary
+            stats.sort_stats(pstats.SortKey.TIME).print_stats(self.top_n)
+            stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top_n)
+        for label, before, after, peak in self.memory:
+            differences = after.compare_to(before, 'lineno')
+            summary.write(f"=== Memory of {label}: {sum(stat.size_diff for stat in differences) / 2 ** 20:.1f} MiB "
+                          f"allocated, {peak / 2 ** 20:.1f} MiB peak ===\n")
+            summary.write("\n".join(str(stat) for stat in differences[:self.top_n]) + "\n\n")
+        summary_file_name = os.path.join(self.directory, "summary.txt")
+        with open(summary_file_name, 'w') as summary_file:
+            summary_file.write(summary.getvalue())
+        return summary_file_name
+
+
+profiler = None  # A Profiler, with --profile
+
+
+def profiled(stage):
+    """ Context manager that profiles the stage, if profiling is on """
+    return profiler.stage(stage) if profiler is not None else nullcontext()
+
+
+def traced_memory(label):
+    """ Context manager that traces the memory allocated within it, if profiling with --trace-memory is on """
+    return profiler.traced_memory(label) if profiler is not None else nullcontext()
+
+
+def timed(stage):
+    """ Decorator that records how long each call takes, as the stage's timer in metrics, and profiles the stage if
+        profiling is on """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.timer("stage_seconds", stage=stage), profiled(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def instrument_yahoofinancials():
+    """ Counts the requests that YahooFinancials makes in metrics, with their statuses, bytes, and durations. A
+        response other than HTTP 200 makes YahooFinancials retry, so it's counted as a retry """
+    import yahoofinancials.etl
+    url_opener = yahoofinancials.etl.UrlOpener
+    if getattr(url_opener.open, 'instrumented', False):
+        return
+    original_open = url_opener.open
+
+    def open_counted(opener, url, *args, **kwargs):
+        start = time.perf_counter()
+        response = original_open(opener, url, *args, **kwargs)
+        metrics.observe("request_seconds", time.perf_counter() - start, engine="threads")
+        metrics.count("requests", engine="threads", status=response.status_code)
+        metrics.count("bytes_fetched", len(response.content), engine="threads")
+        if response.status_code != 200:
+            metrics.count("retries", engine="threads")
+        return response
+
+    open_counted.instrumented = True
+    url_opener.open = open_counted
+
 
 def get_roc(ticker):
     return get_ebit(ticker) / (get_net_working_capital(ticker) + get_fixed_assets(ticker))
@@ -76,45 +372,34 @@ def get_yield(ticker):
 
 
 def get_ev(ticker):
-    total_debt = get_longTermDebt(ticker) + get_totalCurrentLiabilities(ticker)
+    snapshot = get_snapshot(ticker)
+    total_debt = snapshot.long_term_debt + snapshot.total_current_liabilities
     return max(0, get_market_cap(ticker) + total_debt - get_excess_cash(ticker))
 
 
 def get_net_working_capital(ticker):
-    return max(0, get_total_current_assets(ticker) - get_excess_cash(ticker) - get_accountsPayable(ticker))
+    snapshot = get_snapshot(ticker)
+    return max(0, snapshot.total_current_assets - get_excess_cash(ticker) - snapshot.accounts_payable)
 
 
 def get_fixed_assets(ticker):
     # return get_netTangibleAssets(ticker) - get_total_current_assets(ticker) + get_totalLiab(ticker)
 
-    return get_totalAssets(ticker) - get_total_current_assets(ticker) - get_intangibles(ticker)
+    snapshot = get_snapshot(ticker)
+    return snapshot.total_assets - snapshot.total_current_assets - snapshot.intangibles
 
 
 def get_excess_cash(ticker):
-    return get_cash(ticker) - max(0, get_totalCurrentLiabilities(ticker) - get_total_current_assets(ticker) +
-                                  get_cash(ticker))
+    snapshot = get_snapshot(ticker)
+    return snapshot.cash - max(0, snapshot.total_current_liabilities - snapshot.total_current_assets + snapshot.cash)
 
 
 def get_accountsPayable(ticker):
-    balance_dict = _get_most_recent_dict(balance_sheet, ticker)
-    try:
-        return balance_dict['accountsPayable']
-    except Exception as e:
-        insert_error(ticker, f"Missing {e} information for {ticker}")
-        return 0
+    return get_snapshot(ticker).accounts_payable
 
 
 def get_intangibles(ticker):
-    balance_dict = _get_most_recent_dict(balance_sheet, ticker)
-    try:
-        return balance_dict['intangibleAssets']
-    except Exception as e:
-        insert_error(ticker, f"Missing {e} information for {ticker}, trying different method")
-        try:
-            return get_totalAssets(ticker) - get_netTangibleAssets(ticker) - get_totalLiab(ticker)
-        except Exception as e:
-            insert_error(ticker, f"Missing {e} information for {ticker}")
-            return 0
+    return get_snapshot(ticker).intangibles
 
 
 def get_goodwill(ticker):
@@ -122,87 +407,36 @@ def get_goodwill(ticker):
     try:
         return balance_dict['goodWill']
     except Exception as e:
-        insert_error(ticker, f"Missing {e} information for {ticker}")
+        insert_error(ticker, f"Missing {e} information for {ticker}", ERROR_MISSING_FIELD)
         return 0
 
 
 def get_totalLiab(ticker):
-    balance_dict = _get_most_recent_dict(balance_sheet, ticker)
-    try:
-        return balance_dict['totalLiab']
-    except Exception as e:
-        insert_error(ticker, f"missing {e} information for {ticker}, trying different method")
-        try:
-            return balance_dict['totalLiabilitiesNetMinorityInterest']
-        except Exception as e:
-            insert_error(ticker, f"missing {e} information for {ticker}")
-            return 0
+    return get_snapshot(ticker).total_liab
 
 
 def get_totalAssets(ticker):
-    balance_dict = _get_most_recent_dict(balance_sheet, ticker)
-    try:
-        return balance_dict['totalAssets']
-    except Exception as e:
-        insert_error(ticker, f"Missing {e} information for {ticker}")
-        return 0
+    return get_snapshot(ticker).total_assets
 
 
 def get_netTangibleAssets(ticker):
-    balance_dict = _get_most_recent_dict(balance_sheet, ticker)
-    try:
-        return balance_dict['netTangibleAssets']
-    except Exception as e:
-        insert_error(ticker, f"Missing {e} information for {ticker}")
-        return 0
+    return get_snapshot(ticker).net_tangible_assets
 
 
 def get_total_current_assets(ticker):
-    balance_dict = _get_most_recent_dict(balance_sheet, ticker)
-    try:
-        return balance_dict['totalCurrentAssets']
-    except Exception as e:
-        insert_error(ticker, f"Missing {e} information for {ticker}, trying different method")
-        try:
-            return get_totalAssets(ticker) - balance_dict['totalNonCurrentAssets']
-        except Exception as e:
-            insert_error(ticker, f"Missing {e} information for {ticker}")
-            return 0
+    return get_snapshot(ticker).total_current_assets
 
 
 def get_longTermDebt(ticker):
-    balance_dict = _get_most_recent_dict(balance_sheet, ticker)
-    try:
-        return balance_dict['longTermDebt']
-    except Exception as e:
-        insert_error(ticker, f"Missing {e} information for {ticker}")
-        return 0
+    return get_snapshot(ticker).long_term_debt
 
 
 def get_totalCurrentLiabilities(ticker):
-    balance_dict = _get_most_recent_dict(balance_sheet, ticker)
-    try:
-        return balance_dict['totalCurrentLiabilities']
-    except Exception as e:
-        insert_error(ticker, f"Missing {e} information for {ticker}, trying different method")
-        try:
-            return balance_dict['currentLiabilities']
-        except Exception as e:
-            insert_error(ticker, f"Missing {e} information for {ticker}")
-            return 0
+    return get_snapshot(ticker).total_current_liabilities
 
 
 def get_cash(ticker):
-    balance_dict = _get_most_recent_dict(balance_sheet, ticker)
-    try:
-        return balance_dict['cash']
-    except Exception as e:
-        insert_error(ticker, f"Missing {e} information for {ticker}, trying different method")
-        try:
-            return balance_dict['cashAndCashEquivalents']
-        except Exception as e:
-            insert_error(ticker, f"Missing {e} information for {ticker}")
-            return 0
+    return get_snapshot(ticker).cash
 
 
 def _get_most_recent_dict(financial_stmt, ticker):
@@ -210,30 +444,185 @@ def _get_most_recent_dict(financial_stmt, ticker):
     return list(financial_stmt[ticker][0].values())[-1]
 
 
-def date_compare(date1, date2):
-    if date.fromisoformat(list(date1.keys())[0]) <= date.fromisoformat(list(date2.keys())[0]):
-        return -1
-    else:
-        return 1
+class FinancialSnapshot:
+    """ The most recent balance sheet values of a ticker that the Magic Formula needs.
+        Every value (and its fallbacks) is looked up once when the snapshot is created, so missing information is only
+        logged once per ticker, no matter how many metrics use it """
+    # Values that compute_metrics turns into columns, in order
+    COLUMNS = ('accounts_payable', 'intangibles', 'total_assets', 'total_current_assets', 'long_term_debt',
+               'total_current_liabilities', 'cash')
+    __slots__ = ('ticker', 'total_liab', 'net_tangible_assets') + COLUMNS
+
+    def __init__(self, ticker):
+        self.ticker = ticker
+        balance_dict = _get_most_recent_dict(balance_sheet, ticker)
+        self.accounts_payable = self._lookup(balance_dict, 'accountsPayable')
+        self.total_assets = self._lookup(balance_dict, 'totalAssets')
+        self.net_tangible_assets = self._lookup(balance_dict, 'netTangibleAssets')
+        self.total_liab = self._lookup(balance_dict, 'totalLiab', 'totalLiabilitiesNetMinorityInterest')
+        self.long_term_debt = self._lookup(balance_dict, 'longTermDebt')
+        self.total_current_liabilities = self._lookup(balance_dict, 'totalCurrentLiabilities', 'currentLiabilities')
+        self.cash = self._lookup(balance_dict, 'cash', 'cashAndCashEquivalents')
+
+        if 'intangibleAssets' in balance_dict:
+            self.intangibles = balance_dict['intangibleAssets']
+        else:
+            insert_error(ticker, f"Missing 'intangibleAssets' information for {ticker}, trying different method",
+                         ERROR_MISSING_FIELD)
+            try:
+                self.intangibles = self.total_assets - self.net_tangible_assets - self.total_liab
+            except Exception as e:
+                insert_error(ticker, f"Missing {e} information for {ticker}", ERROR_MISSING_FIELD)
+                self.intangibles = 0
+
+        if 'totalCurrentAssets' in balance_dict:
+            self.total_current_assets = balance_dict['totalCurrentAssets']
+        else:
+            insert_error(ticker, f"Missing 'totalCurrentAssets' information for {ticker}, trying different method",
+                         ERROR_MISSING_FIELD)
+            try:
+                self.total_current_assets = self.total_assets - balance_dict['totalNonCurrentAssets']
+            except Exception as e:
+                insert_error(ticker, f"Missing {e} information for {ticker}", ERROR_MISSING_FIELD)
+                self.total_current_assets = 0
+
+    def _lookup(self, balance_dict, *keys):
+        """ Returns the value of the first key in keys that is in balance_dict, or 0 if none of them are """
+        for i, key in enumerate(keys):
+            try:
+                return balance_dict[key]
+            except KeyError as e:
+                if i < len(keys) - 1:
+                    insert_error(self.ticker, f"Missing {e} information for {self.ticker}, trying different method",
+                                 ERROR_MISSING_FIELD)
+                else:
+                    insert_error(self.ticker, f"Missing {e} information for {self.ticker}", ERROR_MISSING_FIELD)
+        return 0
+
+    def columns(self):
+        return tuple(getattr(self, column) for column in self.COLUMNS)
+
+
+# ticker -> (balance sheet list the snapshot was made from, snapshot)
+_snapshots = {}
+
+
+def get_snapshot(ticker):
+    """ Returns the FinancialSnapshot of a ticker, creating it only if the ticker's balance sheet has changed since the
+        last call (e.g. it was re-retrieved) """
+    statement = balance_sheet[ticker]
+    cached = _snapshots.get(ticker)
+    if cached is not None and cached[0] is statement:
+        return cached[1]
+    snapshot = FinancialSnapshot(ticker)
+    _snapshots[ticker] = (statement, snapshot)
+    return snapshot
+
+
+# date.toordinal() of numpy's datetime64 epoch
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+class QuarterlyIndex:
+    """ Index of the quarters in a financial statement (e.g. balance_sheet or income_statement).
+        Quarter dates are parsed into ordinals once, and each ticker's quarters are stored sorted by date, so the most
+        recent quarter and TTM sums are slices instead of sorts. If field is given, its quarterly values are indexed
+        too. A ticker is re-indexed if its statement list is replaced (e.g. it was re-retrieved) """
+
+    def __init__(self, financial_stmt, field=None):
+        self.financial_stmt = financial_stmt
+        self.field = field
+        self._quarters = {}  # ticker -> (statement list, sorted ordinals, values sorted the same way)
+        for ticker in financial_stmt:
+            try:
+                self._index(ticker)
+            except Exception:
+                pass  # Raised again when the ticker is looked up
+
+    def _index(self, ticker):
+        statement = self.financial_stmt[ticker]
+        quarter_dates = [next(iter(quarter)) for quarter in statement]
+        ordinals = np.array(quarter_dates, dtype='datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+        order = np.argsort(ordinals, kind='stable')
+        values = None
+        if self.field is not None:
+            values = [next(iter(statement[i].values())).get(self.field) for i in order]
+        entry = (statement, ordinals[order], values)
+        self._quarters[ticker] = entry
+        return entry
+
+    def _entry(self, ticker):
+        entry = self._quarters.get(ticker)
+        if entry is None or entry[0] is not self.financial_stmt[ticker]:
+            entry = self._index(ticker)
+        return entry
+
+    def ordinals(self, ticker):
+        """ Sorted date ordinals of the ticker's quarters """
+        return self._entry(ticker)[1]
+
+    def values(self, ticker):
+        """ Values of self.field for the ticker's quarters, in date order (None where the field is missing) """
+        return self._entry(ticker)[2]
+
+    def most_recent(self, ticker):
+        return date.fromordinal(int(self._entry(ticker)[1][-1]))
+
+    def ttm(self, ticker, window=4, end=None):
+        """ Sum of the field over the `window` quarters before quarter position `end` (default: the most recent
+            quarters). Like get_ebit, sums fewer quarters if there aren't enough, and raises if a value is missing """
+        values = self._entry(ticker)[2]
+        if end is None:
+            end = len(values)
+        return sum(values[max(0, end - window):end])
+
+    def ttm_as_of(self, ticker, as_of, window=4):
+        """ TTM sum of the quarters dated on or before the date as_of """
+        end = int(np.searchsorted(self.ordinals(ticker), as_of.toordinal(), side='right'))
+        return self.ttm(ticker, window, end)
+
+    def rolling_ttm(self, ticker, window=4):
+        """ Returns (ordinals, sums): the rolling `window`-quarter sum of the field, ending at every quarter that has
+            `window` quarters of history. Sums that include a missing value are NaN """
+        statement, ordinals, values = self._entry(ticker)
+        if len(values) < window:
+            return ordinals[:0], np.empty(0)
+        values = np.array(values, dtype=float)
+        return ordinals[window - 1:], np.lib.stride_tricks.sliding_window_view(values, window).sum(axis=1)
+
+
+income_index = None
+balance_index = None
+
+
+def get_income_index():
+    """ Returns the QuarterlyIndex of income_statement (indexing its EBIT), building it once per run """
+    global income_index
+    if income_index is None or income_index.financial_stmt is not income_statement:
+        print("Indexing quarterly income statements...")
+        income_index = QuarterlyIndex(income_statement, 'ebit')
+    return income_index
+
+
+def get_balance_index():
+    """ Returns the QuarterlyIndex of balance_sheet, building it once per run """
+    global balance_index
+    if balance_index is None or balance_index.financial_stmt is not balance_sheet:
+        print("Indexing quarterly balance sheets...")
+        balance_index = QuarterlyIndex(balance_sheet)
+    return balance_index
 
 
 def get_ebit(ticker):
-    # First sort by date
-    income_list = [i for i in income_statement[ticker]]
-    income_list.sort(key=cmp_to_key(date_compare))
     # Sum the most recent 4 quarters
-    ttm_ebit = sum([list(i.values())[0]['ebit'] for i in income_list[-4:]])
+    ttm_ebit = get_income_index().ttm(ticker)
 
-    # Add them up
     if verbose:
         print()
         print(f"------{ticker}--------")
-        ebit_sum = 0
-        for element in income_list[-4:]:
-            for verbose_date, value in element.items():
-                print(f"{verbose_date}: {value['ebit']}")
-                ebit_sum += value['ebit']
-        print(f"Debug Total ebit: {ebit_sum}")
+        index = get_income_index()
+        for ordinal, value in zip(index.ordinals(ticker)[-4:], index.values(ticker)[-4:]):
+            print(f"{date.fromordinal(int(ordinal)).isoformat()}: {value}")
         print(f"Returned Total ebit: {ttm_ebit}")
     return ttm_ebit
 
@@ -245,14 +634,8 @@ def get_market_cap(ticker):
 # Gets the most recent dates of the balance sheet and income statement, and returns the least recent between the two
 # The point is to check how recent the stock's information is.
 def get_financials_date(ticker):
-    income_list = [i for i in income_statement[ticker]]
-    income_list.sort(key=cmp_to_key(date_compare))
-
-    balance_list = [i for i in balance_sheet[ticker]]
-    balance_list.sort(key=cmp_to_key(date_compare))
-
-    income_date = date.fromisoformat(list(income_list[-1].keys())[0])
-    balance_date = date.fromisoformat(list(balance_list[-1].keys())[0])
+    income_date = get_income_index().most_recent(ticker)
+    balance_date = get_balance_index().most_recent(ticker)
     if verbose:
         print(f"Most recent income statement: {income_date.isoformat()}")
         print(f"Most recent balance sheet: {balance_date.isoformat()}")
@@ -276,97 +659,457 @@ def get_country(ticker):
     return sector_dict[ticker]['country']
 
 
-# TODO Maybe insert sector, industry, and country in a separate UPDATE sql command, and insert null if they raise
-#   exceptions (e.g. if the information doesn't exist)
-def insert_data(conn, ticker_info):
-    sql = ''' REPLACE INTO stock_info (ticker, roc, yield, market_cap, most_recent, sector, industry, country)
-              VALUES(?,?,?,?,?,?,?,?) '''
-    cur = conn.cursor()
-    cur.execute(sql, ticker_info)
-    conn.commit()
+# The balance sheet fields FinancialSnapshot looks up, each followed by its fallbacks, in the order it looks them up.
+# None stands for a value computed from other fields
+SNAPSHOT_FIELDS = (('accountsPayable',), ('totalAssets',), ('netTangibleAssets',),
+                   ('totalLiab', 'totalLiabilitiesNetMinorityInterest'), ('longTermDebt',),
+                   ('totalCurrentLiabilities', 'currentLiabilities'), ('cash', 'cashAndCashEquivalents'),
+                   ('intangibleAssets', None), ('totalCurrentAssets', 'totalNonCurrentAssets'))
 
 
-# TODO Have a command line argument option to drop the table and refresh (instead of always dropping the table)
-# TODO Add columns for sector, country, and industry
-def update_db(tickers):
-    print("Updating database...")
-    conn = sq.connect(fn_stock_info_db, detect_types=sq.PARSE_DECLTYPES)
-    cursor = conn.cursor()
-    cursor.execute("DROP TABLE IF EXISTS stock_info")
-    cursor.execute('''CREATE TABLE IF NOT EXISTS stock_info (
-    ticker text PRIMARY KEY,
-    roc real NOT NULL,
-    yield real NOT NULL,
-    market_cap int NOT NULL,
-    most_recent DATE,
-    sector text,
-    industry text,
-    country text
-    );''')
+def _log_missing_fields(tickers, quarters):
+    """ Logs the missing fields of each ticker's most recent balance sheet quarter (None if it has none) with the same
+        errors as FinancialSnapshot """
+    for ticker, values in zip(tickers, quarters):
+        if values is None:
+            continue
+        for keys in SNAPSHOT_FIELDS:
+            for i, key in enumerate(keys):
+                if key is None or key in values:
+                    break
+                fallback = ", trying different method" if i < len(keys) - 1 else ""
+                insert_error(ticker, f"Missing '{key}' information for {ticker}{fallback}", ERROR_MISSING_FIELD)
+
+
+def _last_ordinals(keys, counts):
+    """ The date ordinal of each ticker's most recent quarter in a _quarter_panel, or 0 if it has no quarters """
+    ends = np.cumsum(counts)
+    return np.where(counts > 0, keys[np.maximum(ends - 1, 0)] % QUARTER_KEY_STRIDE if len(keys) else 0, 0)
+
+
+def _ttm_ebit_column(tickers, window=4):
+    """ TTM EBIT of every ticker, summed over its `window` most recent income statement quarters like
+        QuarterlyIndex.ttm. A ticker with an unusable income statement gets NaN.
+        Returns (ttm_ebit, ordinals), where ordinals are the dates of the tickers' most recent quarters (0 if none) """
+    keys, quarters = _quarter_panel(income_statement, tickers)
+    positions = keys // QUARTER_KEY_STRIDE
+    counts = np.bincount(positions, minlength=len(tickers))
+    ebit = _field_column(quarters, 'ebit', missing=np.nan)
+    # Quarters are sorted by ticker, then date, so this counts the quarters after each one of the same ticker
+    later = np.cumsum(counts)[positions] - np.arange(len(positions)) - 1
+    recent = later < window
+    ttm_ebit = np.bincount(positions[recent], weights=ebit[recent], minlength=len(tickers))
+    for i, ticker in enumerate(tickers):
+        statement = income_statement.get(ticker)
+        if statement is None:
+            insert_error(ticker, f"Income statement error for ticker {ticker}: no income statement", ERROR_STATEMENT)
+            ttm_ebit[i] = np.nan
+        elif counts[i] < len(statement):
+            ttm_ebit[i] = np.nan  # Its quarter dates couldn't be read, which _quarter_panel logged
+        elif np.isnan(ttm_ebit[i]):
+            insert_error(ticker, f"Income statement error for ticker {ticker}: missing EBIT", ERROR_STATEMENT)
+    return ttm_ebit, _last_ordinals(keys, counts)
+
+
+def compute_metrics(tickers):
+    """ Computes the Magic Formula metrics of all tickers in vectorized passes over their statements, instead of going
+        through the get_* helper chain one ticker at a time. Gives the same numbers as get_roc, get_yield, etc., and
+        most_recent is the date get_financials_date gives (None if a statement has no quarters).
+        Returns a DataFrame indexed by ticker; roc and yield are NaN or inf for tickers whose metrics can't be computed
+    """
+    tickers = list(tickers)
+    quarters = []
     for ticker in tickers:
         try:
-            data = (ticker, get_roc(ticker), get_yield(ticker), get_market_cap(ticker), get_financials_date(ticker),
-                    get_sector(ticker), get_industry(ticker), get_country(ticker))
-            insert_data(conn, data)
+            quarters.append(_get_most_recent_dict(balance_sheet, ticker))
         except Exception as e:
-            insert_error(ticker, f"Update DB, data error for ticker {ticker}: {e}. Going to next ticker.")
-    if conn:
-        conn.close()
+            insert_error(ticker, f"Balance sheet error for ticker {ticker}: {e}", ERROR_STATEMENT)
+            quarters.append(None)
+    _log_missing_fields(tickers, quarters)
+    balance = _balance_columns([values or {} for values in quarters])
+    balance[[values is None for values in quarters]] = np.nan
+    accounts_payable, intangibles, total_assets, total_current_assets, long_term_debt, total_current_liabilities, \
+        cash = balance.T
+    market_cap = np.array([market_cap_dict.get(ticker) for ticker in tickers], dtype=float)
+    ebit, income_ordinals = _ttm_ebit_column(tickers)
+    balance_keys, _ = _quarter_panel(balance_sheet, tickers)
+    balance_ordinals = _last_ordinals(balance_keys, np.bincount(balance_keys // QUARTER_KEY_STRIDE,
+                                                                minlength=len(tickers)))
+    most_recent = [date.fromordinal(int(ordinal)) if ordinal else None
+                   for ordinal in np.where((income_ordinals > 0) & (balance_ordinals > 0),
+                                           np.minimum(income_ordinals, balance_ordinals), 0)]
+
+    excess_cash = cash - np.maximum(0, total_current_liabilities - total_current_assets + cash)
+    net_working_capital = np.maximum(0, total_current_assets - excess_cash - accounts_payable)
+    fixed_assets = total_assets - total_current_assets - intangibles
+    ev = np.maximum(0, market_cap + (long_term_debt + total_current_liabilities) - excess_cash)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        roc = ebit / (net_working_capital + fixed_assets)
+        earnings_yield = ebit / ev
+
+    return pd.DataFrame({'ebit': ebit, 'net_working_capital': net_working_capital, 'fixed_assets': fixed_assets,
+                         'excess_cash': excess_cash, 'ev': ev, 'market_cap': market_cap, 'roc': roc,
+                         'yield': earnings_yield, 'most_recent': most_recent}, index=pd.Index(tickers, name='ticker'))
+
+
+def connect_db(db_file):
+    """ Opens a connection to the SQLite db, tuned for bulk writes: WAL journal mode (readers don't block the writer),
+        fewer fsyncs, and a larger page cache """
+    conn = sq.connect(db_file, detect_types=sq.PARSE_DECLTYPES)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    conn.execute(f"PRAGMA cache_size = {db_cache_size}")
+    return conn
+
+
+# TODO Maybe insert sector, industry, and country in a separate UPDATE sql command, and insert null if they raise
+#   exceptions (e.g. if the information doesn't exist)
+def insert_data(conn, rows):
+    """ Inserts (or replaces) stock_info rows; does not commit """
+    sql = ''' REPLACE INTO stock_info (ticker, roc, yield, market_cap, most_recent, sector, industry, country,
+              refreshed) VALUES(?,?,?,?,?,?,?,?,?) '''
+    conn.executemany(sql, rows)
+
+
+@timed("update_db")
+def update_db(tickers, upsert=False):
+    """ Calculates the metrics of the tickers and writes them to the stock_info table in a single transaction.
+        The table is dropped and recreated first, unless upsert is True, in which case the tickers' rows are updated
+        and the other rows are kept """
+    print("Updating database...")
+    rows = []
+    ticker_metrics = compute_metrics(tickers)
+    refresh_times = get_statement_store().refresh_times(tickers)
+    for ticker, roc, earnings_yield, most_recent in zip(ticker_metrics.index, ticker_metrics['roc'],
+                                                        ticker_metrics['yield'], ticker_metrics['most_recent']):
+        if not (np.isfinite(roc) and np.isfinite(earnings_yield)):
+            insert_error(ticker, f"Update DB, data error for ticker {ticker}: ROC or earnings yield could not be "
+                                 f"calculated. Going to next ticker.", ERROR_METRIC)
+            continue
+        try:
+            if most_recent is None:
+                raise ValueError("a statement has no quarters")
+            info = sector_dict[ticker]
+            refreshed = date.fromtimestamp(refresh_times[ticker]) if ticker in refresh_times else None
+            rows.append((ticker, float(roc), float(earnings_yield), market_cap_dict[ticker], most_recent,
+                         info['sector'], info['industry'], info['country'], refreshed))
+        except Exception as e:
+            insert_error(ticker, f"Update DB, data error for ticker {ticker}: {e}. Going to next ticker.",
+                         ERROR_METRIC)
+
+    conn = connect_db(fn_stock_info_db)
+    with conn:
+        if not upsert:
+            conn.execute("DROP TABLE IF EXISTS stock_info")
+        conn.execute('''CREATE TABLE IF NOT EXISTS stock_info (
+        ticker text PRIMARY KEY,
+        roc real NOT NULL,
+        yield real NOT NULL,
+        market_cap int NOT NULL,
+        most_recent DATE,
+        sector text,
+        industry text,
+        country text,
+        refreshed DATE
+        );''')
+        # A table created by an older version doesn't have the refreshed column yet
+        if "refreshed" not in [column[1] for column in conn.execute("PRAGMA table_info(stock_info)")]:
+            conn.execute("ALTER TABLE stock_info ADD COLUMN refreshed DATE")
+        # Covers the ranking's scan of the fresh rows (and its sector, industry, and country filters), which then
+        # doesn't read the table itself
+        conn.execute("CREATE INDEX IF NOT EXISTS stock_info_ranking ON stock_info (most_recent, roc, yield, sector, "
+                     "industry, country)")
+        insert_data(conn, rows)
+    conn.close()
+    print(f"Wrote {len(rows)} tickers to stock_info")
+
+
+# Reasons for a ticker's status, stored in the tickers table
+REASON_VALID = 'valid'
+REASON_NO_MARKET_CAP = 'no market cap'
+REASON_SMALL_MARKET_CAP = 'market cap below minimum'
+REASON_NO_VOLUME = 'no volume or price'
+REASON_SMALL_DOLLAR_VOLUME = 'dollar volume below minimum'
+
+
+# Error types stored in the errors table, so errors can be counted by type instead of by parsing the error text
+ERROR_MISSING_FIELD = 'missing_field'
+ERROR_MISSING_STATEMENT = 'missing_statement'
+ERROR_STATEMENT = 'statement'
+ERROR_METRIC = 'metric'
+ERROR_RETRIEVAL = 'retrieval'
+ERROR_OTHER = 'other'
 
 
-# TODO Add Error Type (eventually)
 # TODO Add Errors for when yahoo_financials fails to get financial statements
 def create_errors_table():
     """ Create table in db to store errors
     """
     print("Creating errors table...")
+    close_error_sink()
     conn = sq.connect(fn_stock_info_db, detect_types=sq.PARSE_DECLTYPES)
     cursor = conn.cursor()
     cursor.execute("DROP TABLE IF EXISTS errors")
     cursor.execute('''CREATE TABLE IF NOT EXISTS errors (
     error_id INTEGER PRIMARY KEY,
     ticker text,
-    error text
+    error text,
+    error_type text
     );''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS errors_error_type ON errors (error_type)")
     conn.commit()
-
-
-def insert_error(ticker, error):
-    sql = ''' INSERT INTO errors (ticker, error)
-              VALUES(?,?) '''
-    conn = sq.connect(fn_stock_info_db, detect_types=sq.PARSE_DECLTYPES)
-    cur = conn.cursor()
-    cur.execute(sql, (ticker, error))
-    conn.commit()
-    print(error)
-
-
-def rank_stocks(db):
-    print("Ranking stocks based on Magic Formula...")
+    conn.close()
+
+
+class ErrorSink:
+    """ Buffers errors in memory and writes them to the errors table in batches, over a single connection.
+        The buffer is written once it holds flush_size errors, flush_interval seconds after it stopped being empty (by
+        a timer thread, even if no more errors are added), and when the program exits. Safe to use from multiple
+        threads """
+
+    def __init__(self, db_file, flush_size=500, flush_interval=5, echo=True):
+        self.db_file = db_file
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.echo = echo
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._last_flush = time.time()
+        self._timer = None
+        self._timer_pid = None
+
+    def add(self, ticker, error, error_type=ERROR_OTHER):
+        metrics.count("errors", type=error_type)
+        if self.echo:
+            print(error)
+        with self._lock:
+            self._buffer.append((ticker, error, error_type))
+            if len(self._buffer) >= self.flush_size or time.time() - self._last_flush >= self.flush_interval:
+                self._flush()
+            elif self._timer is None or self._timer_pid != os.getpid():
+                # The timer thread of a parent process isn't copied into a forked one
+                self._timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self._timer.daemon = True
+                self._timer_pid = os.getpid()
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    def _timed_flush(self):
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        """ Writes the buffer in one transaction; must be called with self._lock held """
+        self._last_flush = time.time()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        # A connection can't be shared with a forked process, so each process opens its own
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sq.connect(self.db_file, check_same_thread=False)
+            self._pid = os.getpid()
+        with self._conn:
+            self._conn.executemany("INSERT INTO errors (ticker, error, error_type) VALUES(?,?,?)", self._buffer)
+        self._buffer = []
+
+
+error_sink = None
+
+
+def get_error_sink():
+    global error_sink
+    if error_sink is None or error_sink.db_file != fn_stock_info_db:
+        close_error_sink()
+        error_sink = ErrorSink(fn_stock_info_db, error_flush_size, error_flush_interval, echo_errors)
+    return error_sink
+
+
+def close_error_sink():
+    """ Writes any buffered errors and closes the error sink's connection """
+    global error_sink
+    if error_sink is not None:
+        error_sink.close()
+        error_sink = None
+
+
+atexit.register(close_error_sink)
+
+
+def insert_error(ticker, error, error_type=ERROR_OTHER):
+    get_error_sink().add(ticker, error, error_type)
+
+
+# Columns of stock_info that rankings can be grouped by
+RANKING_GROUPS = ('sector', 'industry', 'country')
+
+
+def _statement_cutoff(today=None):
+    """ The date that a stock's statements must be more recent than to take part in a ranking """
+    return (today or date.today()) - timedelta(days=max_statement_age)
+
+
+def _ranking_filter(today=None, exclude_sectors=None, countries=None, sectors=None, only=None):
+    """ WHERE clause (and its parameters) that keeps the stocks that take part in a ranking: those whose statements
+        are at most max_statement_age days old, that aren't in one of exclude_sectors (stocks without a sector never
+        are), and that are in one of the countries, in one of the sectors, and in the list only (if they are given) """
+    clause, params = "most_recent > ?", [_statement_cutoff(today).isoformat()]
+    if exclude_sectors:
+        clause += f" AND (sector IS NULL OR sector NOT IN ({', '.join('?' * len(exclude_sectors))}))"
+        params.extend(exclude_sectors)
+    if countries:
+        clause += f" AND country IN ({', '.join('?' * len(countries))})"
+        params.extend(countries)
+    if sectors:
+        clause += f" AND sector IN ({', '.join('?' * len(sectors))})"
+        params.extend(sectors)
+    if only:
+        clause += f" AND ticker IN ({', '.join('?' * len(only))})"
+        params.extend(only)
+    return clause, params
+
+
+def get_ranking(db, top_n=None, today=None, exclude_sectors=None, countries=None):
+    """ Ranks the stocks in stock_info whose statements are at most max_statement_age days old, leaving out the
+        exclude_sectors and keeping only the countries (if given); the other stocks aren't ranked at all. Returns the
+        top_n stocks (or all of them) as a DataFrame sorted by magic_rank, ties in the order the stocks were written.
+        The ranking is ranking_rows', as written to stock_info.csv """
     conn = sq.connect(rf'{db}')
-    cursor = conn.cursor()
+    columns, rows = ranking_rows(conn, None, top_n, today, exclude_sectors, countries)
+    conn.close()
+    return pd.DataFrame(rows, columns=columns)
 
-    last_year_date = date.today() - timedelta(days=400)
-    print(f"Last year's date: {last_year_date.strftime('%Y-%m-%d')}")
 
-    sql_string = f'''
+def get_group_rankings(db, group, top_n=None, today=None, exclude_sectors=None, countries=None):
+    """ Ranks the stocks within each group (e.g. each sector), with the same filters as get_ranking. Returns the
+        top_n stocks of each group (or all of them) as a DataFrame sorted by group, then magic_rank """
+    if group not in RANKING_GROUPS:
+        raise ValueError(f"Rankings can only be grouped by one of {RANKING_GROUPS}, not {group}")
+    conn = sq.connect(rf'{db}')
+    columns, rows = ranking_rows(conn, group, top_n, today, exclude_sectors, countries)
+    conn.close()
+    return pd.DataFrame(rows, columns=columns)
+
+
+def ranking_rows(conn, group=None, top_n=None, today=None, exclude_sectors=None, countries=None, sectors=None,
+                 only=None):
+    """ Ranks the stocks in stock_info on conn, with the filters of _ranking_filter: all of them, or within each group
+        (e.g. each sector). Returns the columns and the rows of the top_n stocks (of each group), or all of them,
+        sorted by group, then magic_rank, ties in the order the stocks were written. Needs neither numpy nor pandas.
+        Without a group, only the ranks of the ranked rows are read (from the stock_info_ranking index), the top_n are
+        picked with a partial sort, and only their rows are read in full. Every group is ranked by one windowed query,
+        in a single pass over the table """
+    clause, params = _ranking_filter(today, exclude_sectors, countries, sectors, only)
+    if group is None:
+        ranked = [(roc_rank + yield_rank, rowid, roc_rank, yield_rank) for rowid, roc_rank, yield_rank in conn.execute(
+            f'''SELECT rowid, RANK() OVER (ORDER BY roc DESC), RANK() OVER (ORDER BY yield DESC) FROM stock_info
+                WHERE {clause}''', params)]
+        head = sorted(ranked) if top_n is None else heapq.nsmallest(max(top_n, 0), ranked)
+        with conn:
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS rank_rows (row_id INTEGER PRIMARY KEY)")
+            conn.execute("DELETE FROM rank_rows")
+            conn.executemany("INSERT INTO rank_rows VALUES(?)", [(rowid,) for _, rowid, _, _ in head])
+        cursor = conn.execute("SELECT rowid, * FROM stock_info WHERE rowid IN (SELECT row_id FROM rank_rows)")
+        columns = [column[0] for column in cursor.description[1:]] + ['roc_rank', 'yield_rank', 'magic_rank']
+        rows = {row[0]: row[1:] for row in cursor}
+        return columns, [[*rows[rowid], roc_rank, yield_rank, magic_rank]
+                         for magic_rank, rowid, roc_rank, yield_rank in head]
+
+    sql = f'''
     SELECT * FROM (
-        SELECT *, roc_rank + yield_rank AS magic_rank FROM
-        (
-            SELECT *,  RANK ()  OVER( ORDER BY roc DESC) AS roc_rank,
-            RANK () OVER( ORDER BY yield DESC) AS yield_rank FROM stock_info      
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY {group} ORDER BY magic_rank, row_id) AS group_position FROM (
+            SELECT *, roc_rank + yield_rank AS magic_rank FROM (
+                SELECT rowid AS row_id, *,
+                RANK() OVER (PARTITION BY {group} ORDER BY roc DESC) AS roc_rank,
+                RANK() OVER (PARTITION BY {group} ORDER BY yield DESC) AS yield_rank
+                FROM stock_info WHERE {clause}
+            )
         )
-    ) WHERE most_recent > date('{last_year_date.strftime('%Y-%m-%d')}')
-    ORDER BY magic_rank ASC
+    ) WHERE ? IS NULL OR group_position <= ?
+    ORDER BY {group}, group_position
     '''
-    query = cursor.execute(sql_string)
+    cursor = conn.execute(sql, params + [top_n, top_n])
+    kept = [i for i, column in enumerate(cursor.description) if column[0] not in ('row_id', 'group_position')]
+    return [cursor.description[i][0] for i in kept], [[row[i] for i in kept] for row in cursor]
 
-    cols = [column[0] for column in query.description]
-    df = pd.DataFrame.from_records(data=query.fetchall(), columns=cols)
-    df.to_csv('stock_info.csv')
 
-    if conn:
+def write_ranking_csv(columns, rows, file_name):
+    """ Writes ranking rows to a CSV file, numbered from 0 in the first column (as DataFrame.to_csv would) """
+    with open(file_name, 'w', newline='') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow([''] + columns)
+        writer.writerows([position] + row for position, row in enumerate(rows))
+
+
+@timed("rank_stocks")
+def rank_stocks(conn, top_n=None, exclude_sectors=None, countries=None, group=None, sectors=None, only=None):
+    """ Writes the ranking of the fresh stocks in stock_info (only the top_n, if given) to stock_info.csv. If a group
+        is given, the rankings within each group are also written to stock_info_by_<group>.csv. Both are ranked over
+        conn, a connection to the db, and written without pandas """
+    print("Ranking stocks based on Magic Formula...")
+    print(f"Last year's date: {_statement_cutoff().strftime('%Y-%m-%d')}")
+    write_ranking_csv(*ranking_rows(conn, None, top_n, None, exclude_sectors, countries, sectors, only),
+                      'stock_info.csv')
+    if group is not None:
+        print(f"Ranking stocks within each {group}...")
+        write_ranking_csv(*ranking_rows(conn, group, top_n, None, exclude_sectors, countries, sectors, only),
+                          f'stock_info_by_{group}.csv')
+
+
+def add_ranking_arguments(parser):
+    """ Adds the options of the ranking, shared by the full run and the rank command, to an ArgumentParser """
+    parser.add_argument('--top', type=int, dest='top_n', metavar='N',
+                        help='Only writes the N best ranked stocks to stock_info.csv')
+    parser.add_argument('--exclude-sector', action='append', dest='exclude_sectors',
+                        help='Leaves the stocks in this sector out of the ranking; can be used more than once')
+    parser.add_argument('--country', action='append', dest='countries',
+                        help='Only ranks the stocks of this country; can be used more than once')
+    parser.add_argument('--group-by', choices=RANKING_GROUPS, dest='group',
+                        help='Also ranks the stocks within each sector, industry, or country')
+    parser.add_argument('--sector', action='append', dest='sectors',
+                        help='Only ranks stocks in this sector; can be used more than once')
+    parser.add_argument('--only', nargs='+', dest='only', help='Only ranks the listed tickers')
+
+
+def rank_with_arguments(conn, args):
+    """ rank_stocks with the options added by add_ranking_arguments, so that the full run and the rank command rank
+        with the same filters """
+    rank_stocks(conn, top_n=args.top_n, exclude_sectors=args.exclude_sectors, countries=args.countries,
+                group=args.group, sectors=args.sectors, only=args.only)
+
+
+def rank_main(argv=None):
+    """ The rank command ("python -m magic_formula rank"): ranks the stocks already scored in stock_info again, e.g.
+        with other filters, and writes the ranking CSVs. Nothing is retrieved or scored, the errors table is left as it
+        is, and numpy, pandas, and the retrieval modules are never imported, so it starts in tens of milliseconds.
+        Returns the exit status """
+    parser = argparse.ArgumentParser(prog='magic_formula rank', description='Ranks the stocks already in stock_info')
+    add_ranking_arguments(parser)
+    args = parser.parse_args(argv)
+    # One connection both checks that stocks were scored and ranks them
+    conn = sq.connect(rf'{fn_stock_info_db}')
+    try:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stock_info'").fetchone():
+            print(f"There is no stock_info table in {fn_stock_info_db} yet; run magic_formula.py first to score the "
+                  f"stocks")
+            return 1
+        rank_with_arguments(conn, args)
+    finally:
         conn.close()
+    return 0
 
 
 def print_db(db_file_name):
@@ -376,10 +1119,980 @@ def print_db(db_file_name):
         conn.close()
 
 
+def _field_column(quarters, *keys, missing=0.0):
+    """ Like FinancialSnapshot._lookup for many quarters at once: the value of the first of the keys that each quarter
+        has, or missing if it has none of them. None values become NaN """
+    column = np.full(len(quarters), missing, dtype=float)
+    for key in reversed(keys):
+        present = np.array([key in values for values in quarters], dtype=bool)
+        column[present] = np.array([values[key] for values in quarters if key in values], dtype=float)
+    return column
+
+
+def _balance_columns(quarters):
+    """ The FinancialSnapshot.COLUMNS of each balance sheet quarter, with the same fallbacks, as an (n, 7) array.
+        Missing fields aren't logged, since a backtest looks at every quarter and not only the most recent one """
+    total_assets = _field_column(quarters, 'totalAssets')
+    total_liab = _field_column(quarters, 'totalLiab', 'totalLiabilitiesNetMinorityInterest')
+    has_intangibles = np.array(['intangibleAssets' in values for values in quarters], dtype=bool)
+    intangibles = np.nan_to_num(total_assets - _field_column(quarters, 'netTangibleAssets') - total_liab)
+    intangibles[has_intangibles] = _field_column(quarters, 'intangibleAssets')[has_intangibles]
+    has_current_assets = np.array(['totalCurrentAssets' in values for values in quarters], dtype=bool)
+    total_current_assets = np.nan_to_num(total_assets - _field_column(quarters, 'totalNonCurrentAssets',
+                                                                      missing=np.nan))
+    total_current_assets[has_current_assets] = _field_column(quarters, 'totalCurrentAssets')[has_current_assets]
+    return np.column_stack((_field_column(quarters, 'accountsPayable'), intangibles, total_assets, total_current_assets,
+                            _field_column(quarters, 'longTermDebt'),
+                            _field_column(quarters, 'totalCurrentLiabilities', 'currentLiabilities'),
+                            _field_column(quarters, 'cash', 'cashAndCashEquivalents')))
+
+
+# Larger than any date ordinal, so that a quarter key sorts by ticker first
+QUARTER_KEY_STRIDE = 10 ** 7
+
+
+def _quarter_panel(financial_stmt, tickers):
+    """ Flattens the quarters of the tickers' statements into arrays sorted by ticker (by position in tickers), then
+        date. Returns (keys, quarters): keys are ticker position * QUARTER_KEY_STRIDE + date ordinal, and quarters are
+        the value dicts in the same order """
+    positions, quarter_dates, quarters = [], [], []
+    for position, ticker in enumerate(tickers):
+        statement = financial_stmt.get(ticker)
+        if not statement:
+            continue
+        try:
+            ticker_dates = [next(iter(quarter)) for quarter in statement]
+            ticker_quarters = [next(iter(quarter.values())) or {} for quarter in statement]
+        except Exception as e:
+            insert_error(ticker, f"Statement error for ticker {ticker}: {e}", ERROR_STATEMENT)
+            continue
+        positions.extend([position] * len(statement))
+        quarter_dates.extend(ticker_dates)
+        quarters.extend(ticker_quarters)
+    positions = np.array(positions, dtype=np.int64)
+    try:
+        # Parsing every date at once is much faster than parsing each ticker's
+        ordinals = np.array(quarter_dates, dtype='datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+    except ValueError:
+        # Leave out the tickers with a date that can't be parsed
+        ordinals = np.zeros(len(quarter_dates), dtype=np.int64)
+        usable = np.ones(len(quarter_dates), dtype=bool)
+        for position in np.unique(positions):
+            ticker, rows = tickers[position], np.flatnonzero(positions == position)
+            try:
+                ordinals[rows] = np.array([quarter_dates[i] for i in rows], dtype='datetime64[D]').astype(np.int64)
+            except ValueError as e:
+                insert_error(ticker, f"Statement error for ticker {ticker}: {e}", ERROR_STATEMENT)
+                usable[rows] = False
+        positions, ordinals = positions[usable], ordinals[usable] + EPOCH_ORDINAL
+        quarters = [quarter for quarter, is_usable in zip(quarters, usable) if is_usable]
+    keys = positions * QUARTER_KEY_STRIDE + ordinals
+    order = np.argsort(keys, kind='stable')
+    return keys[order], [quarters[i] for i in order]
+
+
+def quarter_ends(start, end):
+    """ The calendar quarter ends (Mar 31, Jun 30, Sep 30, Dec 31) from start through end """
+    dates = []
+    year, quarter = start.year, (start.month - 1) // 3
+    while True:
+        month = 3 * quarter + 3
+        quarter_end = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+        if quarter_end > end:
+            return dates
+        if quarter_end >= start:
+            dates.append(quarter_end)
+        year, quarter = (year + 1, 0) if quarter == 3 else (year, quarter + 1)
+
+
+def load_price_history(file_name, tickers):
+    """ Reads a CSV file of daily closing prices with date, ticker, and close columns (one row per ticker and day).
+        Returns (ordinals, closes): the sorted date ordinals, and a (days, tickers) array of the close of each ticker
+        (in the order of tickers) on or before each day. A ticker keeps its last close after it stops trading, and
+        has NaN before its first one """
+    prices = pd.read_csv(file_name, usecols=['date', 'ticker', 'close'], parse_dates=['date'])
+    closes = prices.pivot_table(index='date', columns='ticker', values='close', aggfunc='last')
+    closes = closes.sort_index().reindex(columns=list(tickers)).ffill()
+    ordinals = closes.index.values.astype('datetime64[D]').astype(np.int64) + EPOCH_ORDINAL
+    return ordinals, closes.to_numpy(dtype=float)
+
+
+class BacktestPanel:
+    """ The quarterly statements and price history of a universe of tickers, arranged so that the Magic Formula ranking
+        as of many dates is computed in vectorized passes over (dates, tickers) arrays.
+
+        Only statements public by the as-of date are used: a quarter counts once filing_lag days have passed since it
+        ended. The balance sheet is the most recent such quarter, and EBIT is the sum of the four most recent such
+        quarters (a ticker with fewer is left out). Market cap is the close on the as-of date times the shares
+        outstanding of that balance sheet (ordinarySharesNumber, or shareIssued). A ticker whose balance sheet has
+        neither gets constant shares, market_cap_dict's market cap over the latest close; a ticker that also isn't in
+        market_cap_dict (e.g. delisted) isn't ranked """
+
+    def __init__(self, tickers, balance_stmt, income_stmt, cap_dict, price_ordinals, closes, lag=filing_lag,
+                 max_age=max_statement_age, min_cap=min_market_cap):
+        self.tickers = np.array(list(tickers), dtype=object)
+        self.lag = lag
+        self.max_age = max_age
+        self.min_cap = min_cap
+        self.price_ordinals = price_ordinals
+        self.closes = closes
+
+        self.balance_keys, balance_quarters = _quarter_panel(balance_stmt, self.tickers)
+        self.balance = _balance_columns(balance_quarters)
+        self.balance_shares = _field_column(balance_quarters, 'ordinarySharesNumber', 'shareIssued', missing=np.nan)
+
+        # TTM EBIT ending at every quarter, from a cumulative sum; NaN without four quarters of the same ticker
+        self.income_keys, income_quarters = _quarter_panel(income_stmt, self.tickers)
+        ebit = _field_column(income_quarters, 'ebit', missing=np.nan)
+        sums = np.concatenate(([0.0], np.cumsum(np.nan_to_num(ebit))))
+        missing = np.concatenate(([0], np.cumsum(np.isnan(ebit))))
+        self.ttm_ebit = np.full(len(ebit), np.nan)
+        if len(ebit) >= 4:
+            window = np.arange(3, len(ebit))
+            complete = ((self.income_keys[window] // QUARTER_KEY_STRIDE == self.income_keys[window - 3] //
+                         QUARTER_KEY_STRIDE) & (missing[window + 1] == missing[window - 3]))
+            self.ttm_ebit[window[complete]] = sums[window[complete] + 1] - sums[window[complete] - 3]
+
+        latest_close = closes[-1] if len(closes) else np.full(len(self.tickers), np.nan)
+        market_cap = np.array([cap_dict.get(ticker, np.nan) for ticker in self.tickers], dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            self.shares = market_cap / latest_close
+
+    def _latest_quarters(self, keys, ordinals):
+        """ Position in keys of each ticker's most recent quarter that is public on each date, as a (dates, tickers)
+            array, and whether the ticker has one """
+        ticker_keys = np.arange(len(self.tickers), dtype=np.int64) * QUARTER_KEY_STRIDE
+        # A quarter is public on a date if it ended more than lag days before it
+        queries = ticker_keys[np.newaxis, :] + (ordinals - self.lag)[:, np.newaxis]
+        positions = np.searchsorted(keys, queries, side='left') - 1
+        found = positions >= 0
+        positions = np.maximum(positions, 0)
+        found &= (keys[positions] // QUARTER_KEY_STRIDE) == ticker_keys[np.newaxis, :] // QUARTER_KEY_STRIDE
+        return positions, found
+
+    def _closes(self, ordinals):
+        """ The close of each ticker on or before each date, as a (dates, tickers) array """
+        rows = np.searchsorted(self.price_ordinals, ordinals, side='right') - 1
+        closes = self.closes[np.maximum(rows, 0)]
+        closes[rows < 0] = np.nan
+        return closes
+
+    def metrics(self, ordinals):
+        """ Returns (roc, earnings_yield, market_cap, ranked) as (dates, tickers) arrays; ranked is whether the stock
+            takes part in the ranking on that date """
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        if not len(self.balance_keys) or not len(self.income_keys):
+            nothing = np.full((len(ordinals), len(self.tickers)), np.nan)
+            return nothing, nothing, nothing, np.zeros(nothing.shape, dtype=bool)
+        balance_positions, has_balance = self._latest_quarters(self.balance_keys, ordinals)
+        income_positions, has_income = self._latest_quarters(self.income_keys, ordinals)
+        accounts_payable, intangibles, total_assets, total_current_assets, long_term_debt, total_current_liabilities, \
+            cash = np.moveaxis(self.balance[balance_positions], -1, 0)
+        ebit = self.ttm_ebit[income_positions]
+        shares = self.balance_shares[balance_positions]
+        shares = np.where(np.isnan(shares), self.shares[np.newaxis, :], shares)
+        market_cap = self._closes(ordinals) * shares
+
+        excess_cash = cash - np.maximum(0, total_current_liabilities - total_current_assets + cash)
+        net_working_capital = np.maximum(0, total_current_assets - excess_cash - accounts_payable)
+        fixed_assets = total_assets - total_current_assets - intangibles
+        ev = np.maximum(0, market_cap + (long_term_debt + total_current_liabilities) - excess_cash)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            roc = ebit / (net_working_capital + fixed_assets)
+            earnings_yield = ebit / ev
+
+        # Like rank_stocks, stocks whose older statement is more than max_age days old aren't ranked
+        oldest = np.minimum(self.balance_keys[balance_positions], self.income_keys[income_positions]) % \
+            QUARTER_KEY_STRIDE
+        with np.errstate(invalid='ignore'):
+            ranked = (has_balance & has_income & np.isfinite(roc) & np.isfinite(earnings_yield) &
+                      (oldest > ordinals[:, np.newaxis] - self.max_age) & (market_cap >= self.min_cap))
+        return roc, earnings_yield, market_cap, ranked
+
+    def portfolios(self, ordinals, top_n=portfolio_size, hold=holding_days):
+        """ The top_n stocks by Magic Formula rank as of each date, and their returns over the next hold days (NaN if
+            the price history ends before then). Returns a DataFrame with one row per date and holding """
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        roc, earnings_yield, market_cap, ranked = self.metrics(ordinals)
+        # Ranked like rank_stocks: RANK() by each metric, descending, and the sum of the two ranks
+        roc_rank = pd.DataFrame(np.where(ranked, roc, np.nan)).rank(axis=1, method='min', ascending=False).to_numpy()
+        yield_rank = pd.DataFrame(np.where(ranked, earnings_yield, np.nan)).rank(axis=1, method='min',
+                                                                                 ascending=False).to_numpy()
+        magic_rank = np.where(ranked, roc_rank + yield_rank, np.inf)
+        top = np.argsort(magic_rank, axis=1, kind='stable')[:, :top_n]
+        held = np.take_along_axis(ranked, top, axis=1)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns = self._closes(ordinals + hold) / self._closes(ordinals) - 1
+        if len(self.price_ordinals):
+            returns[ordinals + hold > self.price_ordinals[-1]] = np.nan
+        else:
+            returns[:] = np.nan
+        priced = ranked & np.isfinite(returns)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            universe_returns = np.where(priced, returns, 0).sum(axis=1) / priced.sum(axis=1)
+
+        date_rows, rank_positions = np.nonzero(held)
+        columns = top[date_rows, rank_positions]
+        return pd.DataFrame({
+            'as_of': [date.fromordinal(int(ordinal)) for ordinal in ordinals[date_rows]],
+            'position': rank_positions + 1,
+            'ticker': self.tickers[columns],
+            'magic_rank': magic_rank[date_rows, columns],
+            'roc': roc[date_rows, columns],
+            'yield': earnings_yield[date_rows, columns],
+            'market_cap': market_cap[date_rows, columns],
+            'forward_return': returns[date_rows, columns],
+            'universe_return': universe_returns[date_rows],
+        })
+
+
+def backtest(panel, as_of_dates, top_n=portfolio_size, hold=holding_days, n_processes=1):
+    """ Builds the top_n portfolio as of each date, splitting the dates between n_processes worker processes.
+        Returns (holdings, returns): the holdings of every portfolio, and each portfolio's equal-weighted return next to
+        the average return of every ranked stock """
+    ordinals = np.array([as_of.toordinal() for as_of in as_of_dates], dtype=np.int64)
+    chunks = [chunk for chunk in np.array_split(ordinals, max(1, min(n_processes, len(ordinals)))) if len(chunk)]
+    if n_processes > 1 and len(chunks) > 1:
+        from multiprocessing import Pool
+        with Pool(len(chunks)) as pool:
+            results = pool.starmap(panel.portfolios, [(chunk, top_n, hold) for chunk in chunks])
+    else:
+        results = [panel.portfolios(chunk, top_n, hold) for chunk in chunks]
+    holdings = pd.concat(results, ignore_index=True) if results else panel.portfolios(ordinals, top_n, hold)
+    returns = holdings.groupby('as_of').agg(holdings=('ticker', 'size'), portfolio_return=('forward_return', 'mean'),
+                                            universe_return=('universe_return', 'first'))
+    return holdings.drop(columns='universe_return'), returns
+
+
+@timed("backtest")
+def run_backtest(price_file, tickers, start=None, end=None, top_n=portfolio_size, hold=holding_days,
+                 n_processes=1):
+    """ Backtests the Magic Formula over the quarter ends between start and end (default: the whole price history)
+        with the stored statements of the tickers, and writes backtest_holdings.csv and backtest_returns.csv """
+    tickers = sorted(tickers)
+    print(f"Loading the price history in {price_file}...")
+    price_ordinals, closes = load_price_history(price_file, tickers)
+    if not len(price_ordinals):
+        print("The price history is empty")
+        return
+    print(f"Loading the statements of {len(tickers)} tickers from the statement store...")
+    store = get_statement_store()
+    panel = BacktestPanel(tickers, store.load("balance", tickers), store.load("income", tickers), market_cap_dict,
+                          price_ordinals, closes)
+    as_of_dates = quarter_ends(start or date.fromordinal(int(price_ordinals[0])),
+                               end or date.fromordinal(int(price_ordinals[-1])))
+    print(f"Backtesting {len(as_of_dates)} quarter ends...")
+    holdings, returns = backtest(panel, as_of_dates, top_n, hold, n_processes)
+    holdings.to_csv('backtest_holdings.csv', index=False)
+    returns.to_csv('backtest_returns.csv')
+    print(returns)
+
+
+# Balance sheet and income statement fields used by FinancialSnapshot, get_goodwill, and get_ebit
+RANKING_BALANCE_FIELDS = ('accountsPayable', 'intangibleAssets', 'goodWill', 'totalLiab',
+                          'totalLiabilitiesNetMinorityInterest', 'totalAssets', 'netTangibleAssets',
+                          'totalCurrentAssets', 'totalNonCurrentAssets', 'longTermDebt', 'totalCurrentLiabilities',
+                          'currentLiabilities', 'cash', 'cashAndCashEquivalents')
+RANKING_INCOME_FIELDS = ('ebit',)
+
+
+class StatementStore:
+    """ Retrieved financial statements, stored in normalized tables of the db (balance_items and income_items), with
+        one row per (ticker, quarter, field). Retrieval batches only write their own tickers' rows, so saving doesn't
+        get slower as more tickers are retrieved, and each thread (or process) can save without waiting for the
+        others. What the ranking uses of each statement (see _refresh_latest) is also kept as one JSON row per ticker
+        in latest_statements, rewritten whenever the ticker is saved, so that loading it is a single fast query.
+        statement_type is the metric name used by retrieve_data, "balance" or "income" """
+
+    STATEMENT_TYPES = ('balance', 'income')
+    # Fields kept in latest_statements, and how many of the most recent income statements
+    LATEST_FIELDS = {'balance': RANKING_BALANCE_FIELDS, 'income': RANKING_INCOME_FIELDS}
+    LATEST_INCOME_QUARTERS = 4
+    # Row that records a ticker whose statement was retrieved, but was empty (None or []); it's loaded back as []
+    EMPTY_PERIOD = ''
+    # Field of the row that records a quarter without any values
+    EMPTY_FIELD = ''
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        conn = self._connect()
+        with conn:
+            for statement_type in self.STATEMENT_TYPES:
+                table = self._table(statement_type)
+                # value has no type affinity, so integers are stored exactly and floats stay floats
+                # Every query looks rows up by ticker, so the primary key is the only index (and the table itself)
+                conn.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+                ticker text NOT NULL,
+                period text NOT NULL,
+                position int NOT NULL,
+                field text NOT NULL,
+                value,
+                PRIMARY KEY (ticker, position, field)
+                ) WITHOUT ROWID;''')
+            conn.execute('''CREATE TABLE IF NOT EXISTS latest_statements (
+            ticker text NOT NULL,
+            statement_type text NOT NULL,
+            data text NOT NULL,
+            PRIMARY KEY (ticker, statement_type)
+            ) WITHOUT ROWID;''')
+            # When each ticker's statements were last retrieved, so the ranking can tell how fresh each row is
+            conn.execute('''CREATE TABLE IF NOT EXISTS statement_refreshes (
+            ticker text NOT NULL,
+            statement_type text NOT NULL,
+            refreshed_at real,
+            PRIMARY KEY (ticker, statement_type)
+            );''')
+        conn.close()
+
+    def _table(self, statement_type):
+        if statement_type not in self.STATEMENT_TYPES:
+            raise ValueError(f"Unknown statement type {statement_type}")
+        return f"{statement_type}_items"
+
+    def _connect(self):
+        conn = connect_db(self.db_file)
+        conn.execute("PRAGMA busy_timeout = 30000")  # Other threads/processes may be writing at the same time
+        return conn
+
+    def save(self, statement_type, statements, refreshed=True):
+        """ Saves {ticker: [{period: values}, ...]} statements, replacing any stored quarters of those tickers """
+        self.save_all({statement_type: statements}, refreshed)
+
+    def save_all(self, statements_by_type, refreshed=True):
+        """ Saves {statement_type: statements} in one transaction, e.g. the balance sheets and income statements of
+            a batch that was retrieved in one pass.
+            refreshed is False for statements that weren't just retrieved (imported, or taken from the response
+            cache); those keep the refresh time they have, if any """
+        refreshed_at = time.time() if refreshed else None
+        conn = self._connect()
+        with conn:
+            for statement_type, statements in statements_by_type.items():
+                self._save(conn, statement_type, statements, refreshed_at)
+        conn.close()
+
+    @classmethod
+    def _rows(cls, statements):
+        """ Flattens {ticker: [{period: values}, ...]} into (ticker, period, position, field, value) rows """
+        rows = []
+        for ticker, statement in statements.items():
+            if not statement:
+                rows.append((ticker, cls.EMPTY_PERIOD, 0, cls.EMPTY_FIELD, None))
+                continue
+            for position, quarter in enumerate(statement):
+                for period, values in quarter.items():
+                    if not values:
+                        rows.append((ticker, period, position, cls.EMPTY_FIELD, None))
+                    rows.extend((ticker, period, position, field, value) for field, value in values.items())
+        return rows
+
+    def save_rows(self, statement_type, tickers, rows, refreshed=True):
+        """ Like save, but with the statements of the tickers already flattened into (ticker, period, position, field,
+            value) rows, e.g. read from an Arrow snapshot, so they don't have to be nested first """
+        conn = self._connect()
+        with conn:
+            self._save_rows(conn, statement_type, tickers, rows, time.time() if refreshed else None)
+        conn.close()
+
+    def _save(self, conn, statement_type, statements, refreshed_at=None):
+        self._save_rows(conn, statement_type, statements, self._rows(statements), refreshed_at)
+
+    def _save_rows(self, conn, statement_type, tickers, rows, refreshed_at=None):
+        table = self._table(statement_type)
+        conn.executemany(f"DELETE FROM {table} WHERE ticker = ?", [(ticker,) for ticker in tickers])
+        conn.executemany(f"INSERT INTO {table} (ticker, period, position, field, value) VALUES(?,?,?,?,?)", rows)
+        insert = "INSERT OR IGNORE" if refreshed_at is None else "REPLACE"
+        conn.executemany(f"{insert} INTO statement_refreshes VALUES(?,?,?)",
+                         [(ticker, statement_type, refreshed_at) for ticker in tickers])
+        self._refresh_latest(conn, statement_type, tickers)
+
+    def _refresh_latest(self, conn, statement_type, tickers):
+        """ Rewrites the latest_statements rows of the tickers, from their stored rows: the LATEST_FIELDS of the first
+            (most recent) balance sheet, and the most recently dated balance sheet without values if it isn't the first
+            one (only its date is used), or the LATEST_FIELDS of the LATEST_INCOME_QUARTERS most recent income
+            statements """
+        ticker_filter = self._select_tickers(conn, tickers)
+        fields = self.LATEST_FIELDS[statement_type]
+        field_list = ", ".join("?" * len(fields))
+        if statement_type == 'balance':
+            rows = conn.execute(f'''
+                WITH quarters AS (
+                    SELECT ticker, period, position,
+                    ROW_NUMBER() OVER (PARTITION BY ticker ORDER BY period DESC, position) AS recent_rank
+                    FROM (SELECT DISTINCT ticker, period, position FROM balance_items WHERE 1 {ticker_filter})
+                )
+                SELECT ticker, period, position, field, value FROM balance_items
+                WHERE position = 0 AND field IN ({field_list}) {ticker_filter}
+                UNION ALL
+                SELECT ticker, period, position, '{self.EMPTY_FIELD}', NULL FROM quarters
+                WHERE position = 0 OR recent_rank = 1
+                ORDER BY 1, 3, 4 DESC''', fields)
+        else:
+            rows = conn.execute(f'''
+                WITH quarters AS (
+                    SELECT ticker, period, position,
+                    ROW_NUMBER() OVER (PARTITION BY ticker ORDER BY period DESC, position DESC) AS recent_rank
+                    FROM (SELECT DISTINCT ticker, period, position FROM income_items WHERE 1 {ticker_filter})
+                )
+                SELECT q.ticker, q.period, q.position, COALESCE(i.field, '{self.EMPTY_FIELD}'), i.value FROM quarters q
+                LEFT JOIN income_items i ON i.ticker = q.ticker AND i.position = q.position
+                AND i.field IN ({field_list})
+                WHERE q.recent_rank <= ? OR q.period = '{self.EMPTY_PERIOD}'
+                ORDER BY 1, 3''', (*fields, self.LATEST_INCOME_QUARTERS))
+        latest = self._assemble(rows)
+        conn.execute(f"DELETE FROM latest_statements WHERE statement_type = ? {ticker_filter}", (statement_type,))
+        conn.executemany("INSERT INTO latest_statements VALUES(?,?,?)",
+                         [(ticker, statement_type, json.dumps(statement, separators=(',', ':')))
+                          for ticker, statement in latest.items()])
+
+    def _select_tickers(self, conn, tickers):
+        """ Puts the tickers in a temp table, to be used in a query as "ticker IN (SELECT ticker FROM load_tickers)" """
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS load_tickers (ticker text PRIMARY KEY)")
+        conn.execute("DELETE FROM load_tickers")
+        conn.executemany("INSERT OR IGNORE INTO load_tickers VALUES(?)", [(ticker,) for ticker in tickers])
+        return " AND ticker IN (SELECT ticker FROM load_tickers)"
+
+    def load(self, statement_type, tickers=None):
+        """ Loads statements in the same nested shape they were saved in: {ticker: [{period: values}, ...]}.
+            Loads every stored ticker, unless a list of tickers is given """
+        conn = self._connect()
+        ticker_filter = "" if tickers is None else self._select_tickers(conn, tickers)
+        cursor = conn.execute(f'''SELECT ticker, period, position, field, value FROM {self._table(statement_type)}
+                                  WHERE 1 {ticker_filter} ORDER BY ticker, position''')
+        statements = self._assemble(cursor)
+        conn.close()
+        return statements
+
+    def rows(self, statement_type):
+        """ All stored (ticker, period, position, field, value) rows of a statement type, as saved by save_rows """
+        conn = self._connect()
+        rows = conn.execute(f"SELECT ticker, period, position, field, value FROM {self._table(statement_type)}")
+        rows = rows.fetchall()
+        conn.close()
+        return rows
+
+    @classmethod
+    def _assemble(cls, rows):
+        """ Builds {ticker: [{period: values}, ...]} out of (ticker, period, position, field, value) rows that are
+            sorted by ticker and position """
+        statements = {}
+        last_quarter = None
+        values = None
+        for ticker, period, position, field, value in rows:
+            if period == cls.EMPTY_PERIOD:
+                statements[ticker] = []
+                continue
+            if (ticker, position) != last_quarter:
+                last_quarter = (ticker, position)
+                values = {}
+                statements.setdefault(ticker, []).append({period: values})
+            if field != cls.EMPTY_FIELD:
+                values[field] = value
+        return statements
+
+    def load_latest(self, tickers=None):
+        """ Loads only what the ranking needs (see _refresh_latest) of the tickers (default: all stored tickers), from
+            latest_statements. Returns (balance_sheet, income_statement) in the usual nested shape.
+            The rows of each statement type are joined into one JSON object by SQLite, and decoded with one json.loads
+            call, which is much faster than decoding each row on its own """
+        conn = self._connect()
+        ticker_filter = "" if tickers is None else self._select_tickers(conn, tickers)
+        latest = []
+        for statement_type in self.STATEMENT_TYPES:
+            (data,) = conn.execute(f'''
+                SELECT '{{' || COALESCE(group_concat(json_quote(ticker) || ':' || data, ','), '') || '}}' FROM (
+                    SELECT ticker, data FROM latest_statements WHERE statement_type = ? {ticker_filter} ORDER BY ticker
+                )''', (statement_type,)).fetchone()
+            latest.append(json.loads(data))
+        conn.close()
+        return tuple(latest)
+
+    def tickers(self, statement_type):
+        """ The set of tickers whose statement has been retrieved (even if it was empty) """
+        conn = self._connect()
+        stored = {row[0] for row in conn.execute(f"SELECT DISTINCT ticker FROM {self._table(statement_type)}")}
+        conn.close()
+        return stored
+
+    def refresh_times(self, tickers=None):
+        """ {ticker: time its least recently retrieved statement was retrieved}, for the tickers with a known time """
+        conn = self._connect()
+        ticker_filter = "" if tickers is None else self._select_tickers(conn, tickers)
+        rows = conn.execute(f'''SELECT ticker, MIN(refreshed_at) FROM statement_refreshes
+                                WHERE refreshed_at IS NOT NULL {ticker_filter} GROUP BY ticker''').fetchall()
+        conn.close()
+        return dict(rows)
+
+    def is_empty(self, statement_type):
+        conn = self._connect()
+        row = conn.execute(f"SELECT 1 FROM {self._table(statement_type)} LIMIT 1").fetchone()
+        conn.close()
+        return row is None
+
+
+_statement_stores = {}  # db file -> StatementStore
+
+
+def get_statement_store():
+    """ The StatementStore of fn_stock_info_db. There is one per db file, so its tables are only created once """
+    store = _statement_stores.get(fn_stock_info_db)
+    if store is None:
+        store = _statement_stores[fn_stock_info_db] = StatementStore(fn_stock_info_db)
+    return store
+
+
+def load_statements(statement_type, file_name):
+    """ Loads all stored statements of a type. If none are stored yet, but there is a JSON file from an older version
+        of this script, the JSON file is imported into the store first """
+    store = get_statement_store()
+    if store.is_empty(statement_type) and os.path.isfile(file_name + '.json'):
+        print(f"Importing {file_name}.json into the statement store...")
+        with open(file_name + '.json') as json_file, traced_memory(f"{file_name}.json"):
+            statements = json.load(json_file)
+        store.save(statement_type, statements, refreshed=False)
+        return statements
+    return store.load(statement_type)
+
+
+@timed("load_statements")
+def load_ranking_statements(tickers=None):
+    """ Loads the balance sheets and income statements of the tickers (default: all stored tickers), with only the
+        fields and quarters that the ranking uses """
+    for statement_type, file_name in (("balance", fn_balance), ("income", fn_income)):
+        if get_statement_store().is_empty(statement_type):
+            load_statements(statement_type, file_name)  # Imports the old JSON file, if there is one
+    return get_statement_store().load_latest(tickers)
+
+
+def save_statements_arrow(statements, file_name):
+    """ Writes {ticker: [{period: values}, ...]} statements to an Arrow IPC file with ticker, period, position, field,
+        and value columns (pyarrow is only needed for these snapshot files). Each field is its own record batch, so a
+        memory-mapped read of a few fields only touches their batches. Empty statements and quarters without values
+        are kept as rows with an empty field, as in the statement store """
+    save_rows_arrow(StatementStore._rows(statements), file_name)
+
+
+def save_rows_arrow(statement_rows, file_name):
+    """ Writes (ticker, period, position, field, value) rows, as kept by the statement store, to an Arrow IPC file
+        (see save_statements_arrow) """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    names = ['ticker', 'period', 'position', 'field', 'value']
+    types = [pa.string(), pa.string(), pa.int32(), pa.string(), pa.float64()]
+    # Converting the row tuples as structs avoids transposing them into columns in Python
+    rows = pa.array(list(statement_rows), pa.struct(list(zip(names, types))))
+    columns = dict(zip(names, rows.flatten()))
+
+    # Every batch shares the same dictionaries, since an IPC file can't replace them between batches
+    field_dictionary = pc.unique(columns['field'])
+    for name in ('ticker', 'period', 'field'):
+        dictionary = field_dictionary if name == 'field' else pc.unique(columns[name]).sort()
+        indices = pc.index_in(columns[name], value_set=dictionary).cast(pa.int32())
+        columns[name] = pa.DictionaryArray.from_arrays(indices, dictionary)
+    field_numbers = columns['field'].indices.to_numpy()
+    batch_numbers = {field: i for i, field in enumerate(field_dictionary.to_pylist())}
+    schema = pa.schema([(name, pa.dictionary(pa.int32(), column_type) if column_type == pa.string() else column_type)
+                        for name, column_type in zip(names, types)], metadata={'fields': json.dumps(batch_numbers)})
+    # A stable sort by field keeps each field's rows in the order they were given
+    table = pa.table(list(columns.values()), schema=schema).take(np.argsort(field_numbers, kind='stable'))
+
+    with pa.OSFile(file_name, 'wb') as sink:
+        with pa.ipc.new_file(sink, schema) as writer:
+            offset = 0
+            for count in np.bincount(field_numbers, minlength=len(field_dictionary)):
+                writer.write_batch(table.slice(offset, count).combine_chunks().to_batches()[0])
+                offset += count
+
+
+def read_statements_arrow(file_name, fields=None, tickers=None):
+    """ Memory-maps a file written by save_statements_arrow, and returns a pyarrow Table of the rows of the fields (or
+        of all fields), optionally only of the tickers. Only the record batches of those fields are read """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    reader = pa.ipc.open_file(pa.memory_map(file_name))
+    if fields is None:
+        batches = [reader.get_batch(i) for i in range(reader.num_record_batches)]
+    else:
+        batch_numbers = json.loads(reader.schema.metadata[b'fields'])
+        batches = [reader.get_batch(batch_numbers[field]) for field in fields if field in batch_numbers]
+    table = pa.Table.from_batches(batches, schema=reader.schema)
+    if tickers is not None:
+        table = table.filter(pc.is_in(table['ticker'].cast(pa.string()), value_set=pa.array(list(tickers),
+                                                                                             pa.string())))
+    return table
+
+
+def _arrow_rows(table, sort=False):
+    """ The (ticker, period, position, field, value) rows of a table read by read_statements_arrow, in its order, or
+        sorted by ticker and position """
+    import pyarrow as pa
+
+    table = table.select(['ticker', 'period', 'position', 'field', 'value'])
+    table = pa.table([column.cast(pa.string()) if pa.types.is_dictionary(column.type) else column
+                      for column in table.columns], names=table.column_names)
+    if sort:
+        table = table.sort_by([('ticker', 'ascending'), ('position', 'ascending')])
+    return zip(*(column.to_pylist() for column in table.columns))
+
+
+def load_statements_arrow(file_name, fields=None, tickers=None):
+    """ Loads a file written by save_statements_arrow in the usual nested shape, {ticker: [{period: values}, ...]}.
+        Values are loaded as floats. If fields are given, quarters without any of them are left out.
+        Building the nested dicts of a whole file is slower than json.load of the same statements; the snapshots are
+        fast for reading a few fields as a table (read_statements_arrow), and for importing (import_statements_arrow),
+        which saves the rows as they are """
+    return StatementStore._assemble(_arrow_rows(read_statements_arrow(file_name, fields, tickers), sort=True))
+
+
+def export_statements_arrow():
+    """ Writes the stored balance sheets and income statements to Arrow snapshot files, straight from the stored
+        rows """
+    for statement_type, file_name in (("balance", fn_balance), ("income", fn_income)):
+        print(f"Exporting {statement_type} statements to {file_name}.arrow...")
+        save_rows_arrow(get_statement_store().rows(statement_type), file_name + '.arrow')
+
+
+def import_statements_arrow():
+    """ Saves the balance sheets and income statements of Arrow snapshot files to the statement store. The snapshot's
+        rows are saved as they are, without building the nested statements """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    for statement_type, file_name in (("balance", fn_balance), ("income", fn_income)):
+        print(f"Importing {file_name}.arrow into the statement store...")
+        table = read_statements_arrow(file_name + '.arrow')
+        tickers = set(pc.unique(table['ticker'].cast(pa.string())).to_pylist())
+        get_statement_store().save_rows(statement_type, tickers, _arrow_rows(table), refreshed=False)
+
+
+class ResponseCache:
+    """ On-disk cache of the responses retrieved from Yahoo Finance, keyed by (ticker, endpoint), where the endpoint is
+        "balance", "income", or "volume". A response is fresh for the endpoint's TTL. A statement is also fresh while
+        its latest quarter is so recent that no newer quarter can have ended yet, so a refresh only retrieves the
+        tickers that may have filed since.
+        Once the cached responses take up more than max_bytes, the least recently used ones are evicted """
+
+    STATEMENT_ENDPOINTS = ('balance', 'income')
+
+    def __init__(self, db_file, max_bytes=256 * 2 ** 20, ttls=None):
+        self.db_file = db_file
+        self.max_bytes = max_bytes
+        self.ttls = ttls if ttls is not None else {}
+        conn = self._connect()
+        with conn:
+            conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+            ticker text NOT NULL,
+            endpoint text NOT NULL,
+            fetched_at real NOT NULL,
+            last_used real NOT NULL,
+            latest_period text,
+            size int NOT NULL,
+            data text,
+            PRIMARY KEY (ticker, endpoint)
+            );''')
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        conn.close()
+
+    def _connect(self):
+        conn = connect_db(self.db_file)
+        conn.execute("PRAGMA busy_timeout = 30000")  # Other threads/processes may be writing at the same time
+        return conn
+
+    def is_fresh(self, endpoint, fetched_at, latest_period, now):
+        if now - fetched_at < self.ttls.get(endpoint, 0):
+            return True
+        if latest_period:
+            next_quarter_end = date.fromisoformat(latest_period) + timedelta(days=min_quarter_days)
+            return date.fromtimestamp(now) < next_quarter_end
+        return False
+
+    def get_many(self, endpoint, tickers, now=None):
+        """ Returns {ticker: response} for the tickers with a fresh cached response """
+        now = time.time() if now is None else now
+        conn = self._connect()
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS cache_tickers (ticker text PRIMARY KEY)")
+        conn.execute("DELETE FROM cache_tickers")
+        conn.executemany("INSERT OR IGNORE INTO cache_tickers VALUES(?)", [(ticker,) for ticker in tickers])
+        rows = conn.execute('''SELECT ticker, fetched_at, latest_period, data FROM responses WHERE endpoint = ?
+                               AND ticker IN (SELECT ticker FROM cache_tickers)''', (endpoint,)).fetchall()
+        responses = {ticker: json.loads(data) for ticker, fetched_at, latest_period, data in rows
+                     if self.is_fresh(endpoint, fetched_at, latest_period, now)}
+        with conn:
+            conn.executemany("UPDATE responses SET last_used = ? WHERE ticker = ? AND endpoint = ?",
+                             [(now, ticker, endpoint) for ticker in responses])
+        conn.close()
+        return responses
+
+    def put_many(self, endpoint, responses, now=None):
+        """ Caches {ticker: response}, then evicts the least recently used responses if the cache is too big """
+        now = time.time() if now is None else now
+        rows = []
+        for ticker, response in responses.items():
+            data = json.dumps(response)
+            latest_period = None
+            if endpoint in self.STATEMENT_ENDPOINTS and response:
+                latest_period = max(period for quarter in response for period in quarter)
+            rows.append((ticker, endpoint, now, now, latest_period, len(data), data))
+        conn = self._connect()
+        with conn:
+            conn.executemany("REPLACE INTO responses VALUES(?,?,?,?,?,?,?)", rows)
+            self._evict(conn)
+        conn.close()
+
+    def _evict(self, conn):
+        excess = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0] - self.max_bytes
+        if excess <= 0:
+            return
+        evicted = []
+        for ticker, endpoint, size in conn.execute("SELECT ticker, endpoint, size FROM responses ORDER BY last_used"):
+            evicted.append((ticker, endpoint))
+            excess -= size
+            if excess <= 0:
+                break
+        conn.executemany("DELETE FROM responses WHERE ticker = ? AND endpoint = ?", evicted)
+
+
+def get_response_cache():
+    return ResponseCache(fn_response_cache, response_cache_size, response_cache_ttls)
+
+
+def retrieve_cached(ticker_keys, metric, data_dict):
+    """ Adds the statements that are still fresh in the response cache to data_dict (and the statement store), and
+        returns the tickers that still have to be retrieved """
+    endpoints = StatementStore.STATEMENT_TYPES if metric == METRIC_STATEMENTS else (metric,)
+    if not use_response_cache or not set(endpoints) <= set(ResponseCache.STATEMENT_ENDPOINTS):
+        return ticker_keys
+    cache = get_response_cache()
+    cached = {endpoint: cache.get_many(endpoint, ticker_keys) for endpoint in endpoints}
+    hits = [ticker for ticker in ticker_keys if all(ticker in cached[endpoint] for endpoint in endpoints)]
+    if hits:
+        financial_statement = {endpoint: {ticker: cached[endpoint][ticker] for ticker in hits}
+                               for endpoint in endpoints}
+        if metric != METRIC_STATEMENTS:
+            financial_statement = financial_statement[metric]
+        save_batch(metric, data_dict, financial_statement, None, from_cache=True)
+    hit_set = set(hits)
+    print(f"{len(hits)} of {len(ticker_keys)} tickers are fresh in the response cache; retrieving the other "
+          f"{len(ticker_keys) - len(hits)}")
+    return [ticker for ticker in ticker_keys if ticker not in hit_set]
+
+
+def cache_responses(metric, financial_statement):
+    """ Puts a retrieved batch in the response cache """
+    cache = get_response_cache()
+    if metric == METRIC_STATEMENTS:
+        for statement_type, statements in financial_statement.items():
+            cache.put_many(statement_type, statements)
+    elif metric in ResponseCache.STATEMENT_ENDPOINTS:
+        cache.put_many(metric, financial_statement)
+
+
+def _create_universe_tables(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS tickers (
+    ticker text PRIMARY KEY,
+    status int NOT NULL,
+    last_validated real,
+    reason text
+    );''')
+    # A tickers table created by an older version doesn't have the last_validated and reason columns yet
+    ticker_columns = [column[1] for column in conn.execute("PRAGMA table_info(tickers)")]
+    for column, column_type in (("last_validated", "real"), ("reason", "text")):
+        if column not in ticker_columns:
+            conn.execute(f"ALTER TABLE tickers ADD COLUMN {column} {column_type}")
+    conn.execute("CREATE INDEX IF NOT EXISTS tickers_status ON tickers (status)")
+    conn.execute('''CREATE TABLE IF NOT EXISTS prices (
+    ticker text PRIMARY KEY,
+    price real,
+    market_cap real,
+    volume int
+    );''')
+    # A prices table created by an older version doesn't have the volume column yet
+    if "volume" not in [column[1] for column in conn.execute("PRAGMA table_info(prices)")]:
+        conn.execute("ALTER TABLE prices ADD COLUMN volume int")
+    conn.execute('''CREATE TABLE IF NOT EXISTS sectors (
+    ticker text PRIMARY KEY,
+    sector text,
+    industry text,
+    country text
+    );''')
+    conn.execute("CREATE INDEX IF NOT EXISTS sectors_sector ON sectors (sector)")
+
+
+_universe_dbs = set()  # db files whose universe tables were created by this process
+
+
+def _connect_universe():
+    """ Opens fn_stock_info_db for the universe tables. They are only created (or migrated) on the first connection
+        to each db file, not on every save and load """
+    conn = connect_db(fn_stock_info_db)
+    conn.execute("PRAGMA busy_timeout = 30000")
+    if fn_stock_info_db not in _universe_dbs:
+        with conn:
+            _create_universe_tables(conn)
+        _universe_dbs.add(fn_stock_info_db)
+    return conn
+
+
+def _save_universe_rows(sql, rows, replace_table=None):
+    conn = _connect_universe()
+    with conn:
+        if replace_table is not None:
+            conn.execute(f"DELETE FROM {replace_table}")
+        conn.executemany(sql, rows)
+    conn.close()
+
+
+def _load_universe_rows(sql, json_file_name, import_json):
+    """ Runs a query on the universe tables. If it finds nothing and json_file_name exists (saved by an older version
+        of this script), the JSON file is imported with import_json and the query is run again """
+    conn = _connect_universe()
+    rows = conn.execute(sql).fetchall()
+    if not rows and json_file_name is not None and os.path.isfile(json_file_name):
+        print(f"Importing {json_file_name} into {fn_stock_info_db}...")
+        with open(json_file_name) as json_file, traced_memory(json_file_name):
+            import_json(json.load(json_file))
+        rows = conn.execute(sql).fetchall()
+    conn.close()
+    return rows
+
+
+def diff_screener(screener, tickers, cap_dict, prices, sectors):
+    """ Compares a screener DataFrame with the stored universe (tickers, cap_dict, prices, and sectors).
+        Returns (ticker_dict, added, removed, changed): the new ticker_dict, and the tickers that were added to the
+        screener, removed from it, or whose price, market cap, or sector info changed.
+        Tickers keep their validity, except that new tickers, tickers whose market cap crossed min_market_cap, and
+        tickers that were missing information (TICKER_MISSING_INFO, e.g. after a failed retrieval) are marked as not
+        validated, so they are validated again """
+    old = pd.DataFrame({'price': pd.Series(prices, dtype=float), 'market_cap': pd.Series(cap_dict, dtype=float)})
+    old = old.join(pd.DataFrame.from_dict(sectors, orient='index', columns=['sector', 'industry', 'country']),
+                   how='outer').reindex(screener.index)
+    stored = screener.index.isin(list(tickers))
+    columns = ['price', 'market_cap', 'sector', 'industry', 'country']
+    differs = (screener[columns] != old[columns]).any(axis=1) & stored
+    # A missing old market cap compares as crossed, so that the ticker is validated again
+    crossed = ~((old['market_cap'] >= min_market_cap) == (screener['market_cap'] >= min_market_cap)) \
+        | old['market_cap'].isna()
+
+    added = list(screener.index[~stored])
+    changed = list(screener.index[differs])
+    listed = set(screener.index)
+    removed = [ticker for ticker in tickers if ticker not in listed]
+    revalidate = set(screener.index[~stored | (crossed & stored)])
+    revalidate.update(ticker for ticker in screener.index[stored] if tickers[ticker] == TICKER_MISSING_INFO)
+    ticker_dict = {ticker: TICKER_NOT_VALIDATED if ticker in revalidate else tickers[ticker]
+                   for ticker in screener.index}
+    return ticker_dict, added, removed, changed
+
+
+def save_screener(screener, ticker_dict):
+    """ Replaces the ticker list with the tickers of a screener DataFrame, with their validity from ticker_dict, and
+        saves their prices, market caps, volumes, and sectors, in one transaction. Tickers that are still listed keep
+        when and why they were validated, unless they have to be validated again; the tickers that left the screener
+        are deleted, with their prices and sectors """
+    tickers = list(screener.index)
+    conn = _connect_universe()
+    with conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS screener_tickers (ticker text PRIMARY KEY)")
+        conn.execute("DELETE FROM screener_tickers")
+        conn.executemany("INSERT INTO screener_tickers VALUES(?)", [(ticker,) for ticker in tickers])
+        for table in ('tickers', 'prices', 'sectors'):
+            conn.execute(f"DELETE FROM {table} WHERE ticker NOT IN (SELECT ticker FROM screener_tickers)")
+        conn.executemany(f'''INSERT INTO tickers (ticker, status) VALUES(?,?)
+                             ON CONFLICT(ticker) DO UPDATE SET status = excluded.status,
+                             last_validated = CASE WHEN excluded.status = {TICKER_NOT_VALIDATED} THEN NULL
+                                              ELSE last_validated END,
+                             reason = CASE WHEN excluded.status = {TICKER_NOT_VALIDATED} THEN NULL ELSE reason END''',
+                         [(ticker, ticker_dict[ticker]) for ticker in tickers])
+        conn.executemany('''INSERT INTO prices (ticker, price, market_cap, volume) VALUES(?,?,?,?)
+                            ON CONFLICT(ticker) DO UPDATE SET price = excluded.price,
+                            market_cap = excluded.market_cap, volume = excluded.volume''',
+                         zip(tickers, screener['price'].tolist(), screener['market_cap'].tolist(),
+                             screener['volume'].tolist()))
+        conn.executemany("REPLACE INTO sectors (ticker, sector, industry, country) VALUES(?,?,?,?)",
+                         zip(tickers, screener['sector'], screener['industry'], screener['country']))
+    conn.close()
+
+
+def save_ticker_dict(tickers):
+    """ Replaces the stored ticker list (and each ticker's validity) with tickers """
+    _save_universe_rows("INSERT INTO tickers (ticker, status) VALUES(?,?)", list(tickers.items()), 'tickers')
+
+
+def load_ticker_dict():
+    return dict(_load_universe_rows("SELECT ticker, status FROM tickers", fn_tickers + '.json', save_ticker_dict))
+
+
+def save_ticker_status(rows, validated=True):
+    """ Updates the status of only the given tickers, from (ticker, status, reason) rows, in one small transaction,
+        so that validation threads don't rewrite the whole ticker list. If validated, last_validated is set as well """
+    last_validated = time.time() if validated else None
+    _save_universe_rows('''INSERT INTO tickers (ticker, status, last_validated, reason) VALUES(?,?,?,?)
+                           ON CONFLICT(ticker) DO UPDATE SET status = excluded.status, reason = excluded.reason,
+                           last_validated = COALESCE(excluded.last_validated, last_validated)''',
+                        [(ticker, status, last_validated, reason) for ticker, status, reason in rows])
+
+
+def delete_tickers(tickers):
+    _save_universe_rows("DELETE FROM tickers WHERE ticker = ?", [(ticker,) for ticker in tickers])
+
+
+def load_tickers_with_status(status):
+    """ The tickers with a status, through the index on status """
+    return [row[0] for row in _load_universe_rows(f"SELECT ticker FROM tickers WHERE status = {int(status)}", None,
+                                                  None)]
+
+
+def has_ticker_status(status):
+    return bool(_load_universe_rows(f"SELECT 1 FROM tickers WHERE status = {int(status)} LIMIT 1", None, None))
+
+
+def save_market_caps(cap_dict):
+    _save_universe_rows('''INSERT INTO prices (ticker, market_cap) VALUES(?,?)
+                           ON CONFLICT(ticker) DO UPDATE SET market_cap = excluded.market_cap''',
+                        list(cap_dict.items()))
+
+
+def load_market_caps():
+    return dict(_load_universe_rows("SELECT ticker, market_cap FROM prices WHERE market_cap IS NOT NULL",
+                                    fn_cap + '.json', save_market_caps))
+
+
+def save_prices(prices):
+    _save_universe_rows('''INSERT INTO prices (ticker, price) VALUES(?,?)
+                           ON CONFLICT(ticker) DO UPDATE SET price = excluded.price''',
+                        list(prices.items()))
+
+
+def load_prices():
+    return dict(_load_universe_rows("SELECT ticker, price FROM prices WHERE price IS NOT NULL", fn_price + '.json',
+                                    save_prices))
+
+
+def load_volumes():
+    """ The day's volume of each ticker, from the last screener file read with -t """
+    return dict(_load_universe_rows("SELECT ticker, volume FROM prices WHERE volume IS NOT NULL", None, None))
+
+
+def save_sectors(sectors):
+    _save_universe_rows("REPLACE INTO sectors (ticker, sector, industry, country) VALUES(?,?,?,?)",
+                        [(ticker, info['sector'], info['industry'], info['country'])
+                         for ticker, info in sectors.items()])
+
+
+def load_sectors():
+    rows = _load_universe_rows("SELECT ticker, sector, industry, country FROM sectors", fn_sector + '.json',
+                               save_sectors)
+    return {ticker: {'sector': sector, 'industry': industry, 'country': country}
+            for ticker, sector, industry, country in rows}
+
+
 # Return new ticker list based on if ticker exceeds a market cap and average dollar volume threshold
 # Does not modify ticker_dict.json because that is a list of POTENTIALLY valid tickers (i.e. it only does not include
 # tickers that are missing financial statements)
 # Also updates the market cap info for valid tickers
+@timed("validate_tickers")
 def validate_tickers(tickers, cap_dict, batch_sz=batch_size, newonly=False):
     ticker_keys = list(tickers.keys())
 
@@ -387,6 +2100,12 @@ def validate_tickers(tickers, cap_dict, batch_sz=batch_size, newonly=False):
         # We only validate the tickers that are marked as "not validated"
         ticker_keys = [ticker for ticker in ticker_keys if tickers[ticker] == TICKER_NOT_VALIDATED]
 
+    if local_validation:
+        # Only the tickers that are too close to call from the screener's volume are validated through Yahoo Finance
+        ticker_keys = validate_tickers_locally(ticker_keys, tickers, cap_dict, escalate_margin)
+        if not ticker_keys:
+            return
+
     if batch_sz == 0:
         batch_sz = len(ticker_keys)
     batches = len(ticker_keys) // batch_sz
@@ -406,7 +2125,7 @@ def validate_tickers(tickers, cap_dict, batch_sz=batch_size, newonly=False):
     while join_count < len(thread_jobs):
         if running < max_threads and next_count < len(thread_jobs):
             thread_jobs[next_count].start()
-            time.sleep(3)  # So that requests don't come it TOO fast
+            time.sleep(thread_start_delay)  # So that requests don't come it TOO fast
             running += 1
             next_count += 1
         elif join_count < next_count:
@@ -415,6 +2134,39 @@ def validate_tickers(tickers, cap_dict, batch_sz=batch_size, newonly=False):
             join_count += 1
 
 
+def validate_tickers_locally(ticker_keys, tickers, cap_dict, margin=0.0):
+    """ Validates the tickers with the dollar volume of the screener file (price * the day's volume), computed for all
+        the tickers at once, instead of Yahoo Finance's ten-day average volume.
+        Since one day's volume is noisy, tickers whose dollar volume is within margin (a fraction) of min_dollar_volume
+        are left as they are, and returned so that they can be validated through Yahoo Finance """
+    start_validation = time.time()
+    keys = pd.Index(ticker_keys, dtype=object)
+    caps = pd.Series(cap_dict, dtype=float).reindex(keys).to_numpy()
+    dollar_volume = (pd.Series(price_dict, dtype=float).reindex(keys).to_numpy()
+                     * pd.Series(volume_dict, dtype=float).reindex(keys).to_numpy())
+
+    # Same rules as validate_tickers_thread: missing data means removal, otherwise both minimums must be exceeded
+    with np.errstate(invalid='ignore'):
+        status = np.where(dollar_volume > min_dollar_volume, TICKER_VALID, TICKER_INVALID)
+        status = np.where(np.isnan(dollar_volume), TICKER_REMOVE, status)
+        status = np.where(caps < min_market_cap, TICKER_INVALID, status)
+        status = np.where(np.isnan(caps), TICKER_REMOVE, status)
+        escalate = (np.abs(dollar_volume - min_dollar_volume) <= margin * min_dollar_volume) \
+            & (caps >= min_market_cap)
+
+    reasons = np.select([np.isnan(caps), caps < min_market_cap, np.isnan(dollar_volume),
+                         dollar_volume > min_dollar_volume],
+                        [REASON_NO_MARKET_CAP, REASON_SMALL_MARKET_CAP, REASON_NO_VOLUME, REASON_VALID],
+                        REASON_SMALL_DOLLAR_VOLUME)
+    set_ticker_status(tickers, [(ticker, int(ticker_status), reason) for ticker, ticker_status, reason
+                                in zip(keys[~escalate], status[~escalate], reasons[~escalate])])
+    escalated = list(keys[escalate])
+    print(f"Validated {len(keys) - len(escalated)} tickers from the screener's volume in "
+          f"{time.time() - start_validation:.3f} seconds; {len(escalated)} are near the minimum dollar volume")
+    return escalated
+
+
+@timed("validate_tickers_thread")
 def validate_tickers_thread(ticker_keys, tickers, cap_dict, batch_no):
     print(f"Batch {batch_no + 1}: Validating tickers {ticker_keys}")
 
@@ -422,75 +2174,191 @@ def validate_tickers_thread(ticker_keys, tickers, cap_dict, batch_no):
 
     # For the sake of efficiency, don't get average 10 day volume of tickers that don't meet market cap minimum
     new_ticker_keys = []
+    status_rows = []  # (ticker, status, reason) of this batch, saved at the end with row-level writes
 
     for ticker in ticker_keys:
         if ticker not in cap_dict:
-            tickers[ticker] = TICKER_REMOVE
+            status_rows.append((ticker, TICKER_REMOVE, REASON_NO_MARKET_CAP))
             continue
         elif cap_dict[ticker] < min_market_cap:
             if verbose:
                 print(f"Setting {ticker} to invalid")
-            tickers[ticker] = TICKER_INVALID
+            status_rows.append((ticker, TICKER_INVALID, REASON_SMALL_MARKET_CAP))
             continue
         new_ticker_keys.append(ticker)
 
     if len(new_ticker_keys) == 0:
         if verbose:
             print("No tickers were valid")
+        set_ticker_status(tickers, status_rows)
         end_loop = time.time()
         print(f"Time elapsed for ticker validation, batch {batch_no + 1}: {end_loop - start_loop}")
         print()
         return
 
-    yh = YahooFinancials(new_ticker_keys)
+    # Volumes that were retrieved recently are taken from the response cache
+    cache = get_response_cache()
+    avg_ten_day_volume = cache.get_many("volume", new_ticker_keys) if use_response_cache else {}
+    uncached_keys = [ticker for ticker in new_ticker_keys if ticker not in avg_ten_day_volume]
 
-    if verbose:
-        print(f"Batch {batch_no + 1}: Retrieving volume information from Yahoo Finance...")
-    avg_ten_day_volume = yh.get_ten_day_avg_daily_volume()
+    if uncached_keys:
+        from yahoofinancials import YahooFinancials
+        yh = YahooFinancials(uncached_keys)
+
+        if verbose:
+            print(f"Batch {batch_no + 1}: Retrieving volume information from Yahoo Finance...")
+        retrieved_volume = yh.get_ten_day_avg_daily_volume()
+        cache.put_many("volume", retrieved_volume)
+        avg_ten_day_volume.update(retrieved_volume)
 
     if verbose:
         print(f"Batch {batch_no + 1}: Calculating average dollar volumes...")
     avg_ten_day_dollar_volume = {}
     for ticker, value in avg_ten_day_volume.items():
         if ticker is None or value is None or ticker not in price_dict:
-            tickers[ticker] = TICKER_REMOVE
+            status_rows.append((ticker, TICKER_REMOVE, REASON_NO_VOLUME))
         else:
             avg_ten_day_dollar_volume[ticker] = value * price_dict[ticker]
-            ticker_lock.acquire()
             if avg_ten_day_dollar_volume[ticker] > min_dollar_volume:
                 if verbose:
                     print(f"Setting {ticker} to valid")
-                tickers[ticker] = TICKER_VALID
+                status_rows.append((ticker, TICKER_VALID, REASON_VALID))
             else:
                 if verbose:
                     print(f"Setting {ticker} to invalid")
-                tickers[ticker] = TICKER_INVALID
-            ticker_lock.release()
-    json.dump(tickers, open(fn_tickers + '.json', 'w'))
+                status_rows.append((ticker, TICKER_INVALID, REASON_SMALL_DOLLAR_VOLUME))
+    set_ticker_status(tickers, [row for row in status_rows if row[0] is not None])
 
     end_loop = time.time()
     print(f"Time elapsed for ticker validation, batch {batch_no + 1}: {end_loop - start_loop}")
     print()
 
 
+def set_ticker_status(tickers, status_rows, validated=True):
+    """ Sets the status of (ticker, status, reason) rows in the tickers dict, and saves only those rows """
+    with metrics.locked(ticker_lock, "ticker_lock"):
+        for ticker, status, reason in status_rows:
+            tickers[ticker] = status
+    save_ticker_status(status_rows, validated)
+
+
 def is_tickers_validated():
-    return TICKER_NOT_VALIDATED not in ticker_dict.values()
+    return not has_ticker_status(TICKER_NOT_VALIDATED)
+
+
+# Descriptions of securities that aren't common stock
+NOT_COMMON_STOCK = re.compile(r'WARRANT|PREFERRED|UNIT|ETF|INDEX', re.IGNORECASE)
 
 
 def is_common_stock(description):
-    description = description.upper()
-    return "Warrant".upper() not in description and "Preferred".upper() not in description and \
-           "Unit".upper() not in description and "ETF" not in description and "Index".upper() not in description
+    return NOT_COMMON_STOCK.search(description) is None
+
+
+# Columns of nasdaq_stocks.csv, the stock screener file from nasdaq.com
+SCREENER_COLUMNS = ['ticker', 'description', 'price', 'net_change', 'percent_change', 'market_cap', 'country',
+                    'ipo_year', 'volume', 'sector', 'industry']
+
+
+@timed("read_screener")
+def read_screener(file_name, chunksize=100000):
+    """ Reads the common stocks in a stock screener file, in chunks so that files of hundreds of thousands of rows
+        (e.g. with several exchanges) don't have to fit in memory as strings. Rows with an empty cell are skipped.
+        Returns a DataFrame indexed by ticker with price, market_cap, volume, sector, industry, and country """
+    start_read = time.time()
+    n_rows = 0
+    chunks = []
+    reader = pd.read_csv(file_name, header=0, names=SCREENER_COLUMNS, dtype=str, keep_default_na=False,
+                         chunksize=chunksize)
+    for chunk in reader:
+        n_rows += len(chunk)
+        chunk = chunk[(chunk != '').all(axis=1) & ~chunk['description'].str.contains(NOT_COMMON_STOCK)]
+        # I use a float here instead of Decimal because for my purposes, precision isn't a big deal
+        price = chunk['price'].str.replace(r'[^\d.]', '', regex=True).astype(float)
+        chunks.append(pd.DataFrame({'price': price.values, 'market_cap': chunk['market_cap'].astype(float).values,
+                                    'volume': chunk['volume'].astype(np.int64).values,
+                                    'sector': chunk['sector'].values, 'industry': chunk['industry'].values,
+                                    'country': chunk['country'].values}, index=chunk['ticker'].values))
+    if not chunks:
+        chunks.append(pd.DataFrame(columns=['price', 'market_cap', 'volume', 'sector', 'industry', 'country']))
+    screener = pd.concat(chunks)
+    screener = screener[~screener.index.duplicated(keep='last')]
+    elapsed = time.time() - start_read
+    print(f"Read {n_rows} rows of {file_name} in {elapsed:.2f} seconds ({n_rows / max(elapsed, 1e-9):.0f} rows per "
+          f"second); {len(screener)} are common stocks")
+    return screener
+
+
+def filter_tickers(tickers, sectors=None, only=None):
+    """ Keeps the tickers that are in one of the sectors, and in the list only (if they are given) """
+    if sectors:
+        tickers = [ticker for ticker in tickers if ticker in sector_dict and sector_dict[ticker]['sector'] in sectors]
+    if only:
+        only = set(only)
+        tickers = [ticker for ticker in tickers if ticker in only]
+    return tickers
 
 
 def get_valid_ticker_list():
     "Gets a list of tickers that a valid -> There should be no validation/checking of value outside of this function"
-    temp = [ticker for ticker, value in ticker_dict.items() if value == TICKER_VALID]
+    # Tickers left out of ticker_dict (e.g. with --debug) are left out here too
+    temp = [ticker for ticker in load_tickers_with_status(TICKER_VALID) if ticker in ticker_dict]
     print(f"Getting valid ticker list of {len(temp)} tickers")
     return temp
 
 
-def retrieve_data(batch_sz, ticker_keys, metric, file_name, data_dict):
+@timed("retrieve_data_async")
+def retrieve_data_async(ticker_keys, metric, data_dict):
+    """ Retrieves the "balance" or "income" statements of the tickers with the asyncio engine in yahoo_async, which
+        paces requests at request_rate per second with up to max_concurrency requests at a time.
+        The "statements" metric retrieves both with one request per ticker; data_dict is then
+        {"balance": balance_sheet, "income": income_statement}.
+        Statements are saved to the statement store in batches of batch_size as they arrive """
+    from yahoo_async import AsyncRetriever, YAHOO_BASE_URL
+    start_retrieval = time.time()
+    ticker_keys = retrieve_cached(ticker_keys, metric, data_dict)
+    print(f"Retrieving {metric} of {len(ticker_keys)} tickers, {request_rate} requests per second...")
+    retriever = AsyncRetriever(rate=request_rate, concurrency=max_concurrency,
+                               base_url=yahoo_base_url or YAHOO_BASE_URL)
+    store = get_statement_store()
+    data_dicts = data_dict if metric == METRIC_STATEMENTS else {metric: data_dict}
+    batch = {statement_type: {} for statement_type in data_dicts}
+    batch_tickers = set()
+
+    def save_batch():
+        with metrics.locked(dict_lock, "dict_lock"):
+            for statement_type, statements in batch.items():
+                data_dicts[statement_type].update(statements)
+        store.save_all(batch)
+        cache_responses(METRIC_STATEMENTS, batch)
+        for statements in batch.values():
+            statements.clear()
+        batch_tickers.clear()
+
+    def on_result(ticker, statement):
+        statements = statement if metric == METRIC_STATEMENTS else {metric: statement}
+        for statement_type, type_statement in statements.items():
+            batch[statement_type][ticker] = type_statement
+        batch_tickers.add(ticker)
+        if len(batch_tickers) >= batch_size:
+            save_batch()
+
+    try:
+        retriever.retrieve(ticker_keys, list(data_dicts) if metric == METRIC_STATEMENTS else metric, on_result)
+    finally:
+        save_batch()
+        retriever.close()
+    for ticker, reason in retriever.failures.items():
+        insert_error(ticker, f"Could not retrieve {metric} for {ticker}: {reason}", ERROR_RETRIEVAL)
+    metrics.count("requests", retriever.request_count, engine="async")
+    metrics.count("retries", retriever.retry_count, engine="async")
+    metrics.count("bytes_fetched", retriever.bytes_received, engine="async")
+    print(f"Retrieved {metric} of {len(ticker_keys) - len(retriever.failures)} of {len(ticker_keys)} tickers with "
+          f"{retriever.request_count} requests ({retriever.retry_count} retries) in {time.time() - start_retrieval}")
+
+
+@timed("retrieve_data")
+def retrieve_data(batch_sz, ticker_keys, metric, data_dict):
+    ticker_keys = retrieve_cached(ticker_keys, metric, data_dict)
     if batch_sz == 0:
         batch_sz = len(ticker_keys)
     batches = len(ticker_keys) // batch_sz
@@ -501,7 +2369,7 @@ def retrieve_data(batch_sz, ticker_keys, metric, file_name, data_dict):
         if len(ticker_sublist) == 0:  # This is for when the batch_size evenly divides into the ticker_dict size
             break
 
-        thread = threading.Thread(target=create_retrieve_thread, args=(ticker_sublist, metric, file_name, data_dict, i))
+        thread = threading.Thread(target=create_retrieve_thread, args=(ticker_sublist, metric, data_dict, i))
         thread_jobs.append(thread)
 
     running = 0
@@ -510,7 +2378,7 @@ def retrieve_data(batch_sz, ticker_keys, metric, file_name, data_dict):
     while join_count < len(thread_jobs):
         if running < max_threads and next_count < len(thread_jobs):
             thread_jobs[next_count].start()
-            time.sleep(3)  # So that requests don't come it TOO fast
+            time.sleep(thread_start_delay)  # So that requests don't come it TOO fast
             running += 1
             next_count += 1
         elif join_count < next_count:
@@ -519,12 +2387,77 @@ def retrieve_data(batch_sz, ticker_keys, metric, file_name, data_dict):
             join_count += 1
 
 
-def create_retrieve_thread(ticker_keys, metric, file_name, data_dict, batch_no):
+def retrieve_statements(ticker_keys, n_processes=1, use_async=False):
+    """ Retrieves the balance sheets and income statements of the tickers into balance_sheet and income_statement,
+        with the asyncio engine, a process pool (if n_processes > 1), or threads """
+    statements = {"balance": balance_sheet, "income": income_statement}
+    # The asyncio engine paces its own requests, so it doesn't need to be split between processes
+    if use_async:
+        retrieve_data_async(ticker_keys, METRIC_STATEMENTS, statements)
+    elif n_processes > 1:
+        retrieve_data_pool(n_processes, batch_size, ticker_keys, METRIC_STATEMENTS, statements)
+    else:
+        retrieve_data(batch_size, ticker_keys, METRIC_STATEMENTS, statements)
+
+
+@timed("retrieve_data_pool")
+def retrieve_data_pool(n_processes, batch_sz, ticker_keys, metric, data_dict):
+    """ Retrieves the tickers in batches with a pool of n_processes worker processes. The batches form a shared queue:
+        an idle worker takes the next batch, so one slow or throttled batch doesn't hold up the others. Each batch is
+        sent back to this process, which saves it as soon as it arrives """
+    ticker_keys = retrieve_cached(ticker_keys, metric, data_dict)
+    batches = [(batch_no, ticker_keys[i: i + batch_sz], metric)
+               for batch_no, i in enumerate(range(0, len(ticker_keys), batch_sz))]
+    print(f"Retrieving {len(batches)} batches with {n_processes} processes...")
+    get_error_sink().flush()  # So that the workers don't inherit (and write again) errors buffered so far
+    from multiprocessing import Pool
+    with Pool(n_processes) as pool:
+        for batch_no, financial_statement, elapsed, batch_metrics in pool.imap_unordered(retrieve_batch_process,
+                                                                                          batches):
+            metrics.merge(batch_metrics)
+            save_batch(metric, data_dict, financial_statement, batch_no)
+            print(f"Time elapsed for batch {batch_no + 1}: {elapsed}, metric: {metric}")
+
+
+def retrieve_batch_process(batch):
+    """ Runs in a worker process of retrieve_data_pool; returns the retrieved batch, and the batch's metrics, to the
+        parent process """
+    global metrics
+    metrics = Metrics()  # Only this batch's metrics are sent back
+    batch_no, ticker_keys, metric = batch
+    start_loop = time.time()
+    print(f"Batch {batch_no + 1}: Tickers to be retrieved are: {ticker_keys}")
+    try:
+        financial_statement = fetch_batch(ticker_keys, metric)
+    except Exception as e:
+        for ticker in ticker_keys:
+            insert_error(ticker, f"Could not retrieve {metric} for {ticker}: {e}", ERROR_RETRIEVAL)
+        financial_statement = {}
+    get_error_sink().flush()  # atexit handlers don't run in a pool's worker processes
+    metrics.observe("stage_seconds", time.time() - start_loop, stage="retrieve_batch_process")
+    return batch_no, financial_statement, time.time() - start_loop, metrics.state()
+
+
+@timed("create_retrieve_thread")
+def create_retrieve_thread(ticker_keys, metric, data_dict, batch_no):
     """ Create a thread that retrieves ticker financial info through YahooFinancials.
         Also, uses yfinance to get the financial currency used """
     start_loop = time.time()
     print(f"Batch/thread {batch_no + 1}: Tickers to be retrieved are: {ticker_keys}")
 
+    financial_statement = fetch_batch(ticker_keys, metric)
+    save_batch(metric, data_dict, financial_statement, batch_no)
+
+    end_loop = time.time()
+
+    print(f"Time elapsed for batch {batch_no + 1}: {end_loop - start_loop}, metric: {metric}")
+    print()
+
+
+@timed("fetch_batch")
+def fetch_batch(ticker_keys, metric):
+    """ Retrieves the metric of a batch of tickers through YahooFinancials """
+    from yahoofinancials import YahooFinancials
     yahoo_financials = YahooFinancials(ticker_keys)
 
     if metric == "balance":
@@ -537,7 +2470,27 @@ def create_retrieve_thread(ticker_keys, metric, file_name, data_dict, batch_no):
         financial_statement = yahoo_financials.get_financial_stmts('quarterly', 'income')[
             'incomeStatementHistoryQuarterly']
 
-    # For the most part, "cap" should not be used; it should be parsed from nasdaq_stocks.csv. Kept this here, just in case
+    # Both statements with one request per ticker, with the combined url of the asyncio engine. The request goes
+    # through YahooFinancials, so it keeps its minimum interval between requests, its retries, and its response cache
+    elif metric == METRIC_STATEMENTS:
+        from yahoo_async import statement_url, split_statement_data
+        from yahoofinancials.maps import REQUEST_MAP
+        print(f"Retrieving quarterly balance sheets and income statement history from Yahoo Finance...")
+        statement_types = ["balance", "income"]
+        financial_statement = {statement_type: {} for statement_type in statement_types}
+        for ticker in ticker_keys:
+            url = statement_url(ticker, statement_types)
+            try:
+                # 'statements' isn't a statement type, so the combined response is only requested and cached here
+                yahoo_financials._get_historical_data(url, REQUEST_MAP['fundamentals'], '', 'statements')
+            except (KeyError, AttributeError):
+                pass  # A response without data, which split_statement_data turns into None statements
+            for statement_type, statement in split_statement_data(yahoo_financials._cache.get(url),
+                                                                  statement_types).items():
+                financial_statement[statement_type][ticker] = statement
+
+    # For the most part, "cap" should not be used; it should be parsed from nasdaq_stocks.csv. Kept this here, just in
+    # case
     elif metric == "cap":
         print(f"Retrieving market cap information from Yahoo Finance...")
         financial_statement = yahoo_financials.get_market_cap()
@@ -546,30 +2499,83 @@ def create_retrieve_thread(ticker_keys, metric, file_name, data_dict, batch_no):
         print("Metric entered is not recognized.")
         financial_statement = {}
 
-    dict_lock.acquire()
-    data_dict.update(financial_statement)
+    return financial_statement
 
-    end_loop = time.time()
 
-    print(f"Saving batch {batch_no + 1} to JSON file...")
-    json.dump(data_dict, open(file_name + '.json', 'w'))
-    dict_lock.release()
+@timed("save_batch")
+def save_batch(metric, data_dict, financial_statement, batch_no, from_cache=False):
+    """ Adds a retrieved batch to data_dict and saves it, and puts it in the response cache unless it came from there.
+        For the "statements" metric, data_dict is {"balance": balance_sheet, "income": income_statement} """
+    with metrics.locked(dict_lock, "dict_lock"):
+        if metric == METRIC_STATEMENTS:
+            for statement_type, statements in financial_statement.items():
+                data_dict[statement_type].update(statements)
+        else:
+            data_dict.update(financial_statement)
+
+    # Only this batch is saved, and outside of dict_lock, so that threads don't wait on each other's disk writes
+    batch_name = "cached statements" if from_cache else f"batch {batch_no + 1}"
+    if metric in ("balance", "income"):
+        print(f"Saving {batch_name} to the statement store...")
+        get_statement_store().save(metric, financial_statement, refreshed=not from_cache)
+    elif metric == METRIC_STATEMENTS:
+        print(f"Saving {batch_name} to the statement store...")
+        get_statement_store().save_all(financial_statement, refreshed=not from_cache)
+    elif metric == "cap":
+        save_market_caps(financial_statement)
+    if not from_cache:
+        cache_responses(metric, financial_statement)
+
+
+def schedule_refresh(tickers, budget, requests_per_ticker=2, today=None):
+    """ Picks the tickers that are due for a new quarterly filing: those whose next quarter has ended since their most
+        recent quarter (from get_financials_date), plus those that were never retrieved. Tickers that were retrieved
+        without statements (e.g. empty ones) are only due again empty_retry_days after that retrieval, and then rank
+        by how long ago it was, so they don't use up the budget on every run. Tickers whose statements are still
+        fresh in the response cache are left out. The stalest tickers come first, and only as many are picked as can
+        be retrieved with budget requests """
+    today = date.today() if today is None else today
+    refresh_times = get_statement_store().refresh_times(tickers)
+    due = []
+    for ticker in tickers:
+        try:
+            most_recent = get_financials_date(ticker)
+        except Exception:
+            if ticker not in refresh_times:
+                due.append((float('inf'), ticker))  # Never retrieved
+            elif today >= date.fromtimestamp(refresh_times[ticker]) + timedelta(days=empty_retry_days):
+                due.append(((today - date.fromtimestamp(refresh_times[ticker])).days, ticker))
+            continue
+        if today >= most_recent + timedelta(days=min_quarter_days):
+            due.append(((today - most_recent).days, ticker))
+    due.sort(key=lambda staleness_ticker: -staleness_ticker[0])
+    due_tickers = [ticker for staleness, ticker in due]
 
-    print(f"Time elapsed for batch {batch_no + 1}: {end_loop - start_loop}, metric: {metric}")
-    print()
+    if use_response_cache:
+        cache = get_response_cache()
+        fresh = set(cache.get_many("balance", due_tickers)) & set(cache.get_many("income", due_tickers))
+        due_tickers = [ticker for ticker in due_tickers if ticker not in fresh]
+
+    scheduled = due_tickers[:max(0, budget // requests_per_ticker)]
+    print(f"{len(due_tickers)} of {len(tickers)} tickers are due for a new filing; refreshing the {len(scheduled)} "
+          f"stalest with a budget of {budget} requests")
+    return scheduled
 
 
+@timed("clean_tickers")
 def clean_tickers():
-    """ Checks balance_sheet, income_statement, and market_cap_dict dictionaries for None values and empty list values, and removes
-        those entries from the dictionaries, then updates their respective JSON files.
-        ticker_dict changes are not saved to the json because info might be missing due to communication errors, and not
-        necessarily because the data is missing (e.g. if we made too many requests to Yahoo Finance and the site refuses.
-        This way, if we continue retrieving, all the tickers will be retrieved, since they are still in the ticker_dict
+    """ Checks balance_sheet, income_statement, and market_cap_dict dictionaries for None values and empty list values,
+        and removes those entries from the dictionaries, then updates their respective JSON files.
+        ticker_dict changes are not saved to the json because info might be missing due to communication errors, and
+        not necessarily because the data is missing (e.g. if we made too many requests to Yahoo Finance and the site
+        refuses. This way, if we continue retrieving, all the tickers will be retrieved, since they are still in the
+        ticker_dict
         Always called after refreshing data
     """
     global ticker_dict
     print("Cleaning tickers...")
     remove_tickers = set()
+    missing_rows = []
     get_valid_ticker_list()     # Here as a test to see when valid tickers go to 0
 
     for ticker, value in ticker_dict.items():
@@ -581,77 +2587,28 @@ def clean_tickers():
         if value == TICKER_REMOVE:
             remove_tickers.add(ticker)
         elif value == TICKER_VALID:
+            missing = []
             if ticker not in balance_sheet or balance_sheet[ticker] is None or balance_sheet[ticker] == []:
-                ticker_dict[ticker] = TICKER_MISSING_INFO
-                insert_error(ticker, "Missing balance sheet")
+                missing.append("balance sheet")
             if ticker not in income_statement or income_statement[ticker] is None or income_statement[ticker] == []:
-                ticker_dict[ticker] = TICKER_MISSING_INFO
-                insert_error(ticker, "Missing income statement")
+                missing.append("income statement")
             if ticker not in market_cap_dict or market_cap_dict[ticker] is None or market_cap_dict[ticker] == []:
-                ticker_dict[ticker] = TICKER_MISSING_INFO
-                insert_error(ticker, "Missing market cap")
+                missing.append("market cap")
+            for info in missing:
+                insert_error(ticker, f"Missing {info}", ERROR_MISSING_STATEMENT)
+            if missing:
+                missing_rows.append((ticker, TICKER_MISSING_INFO, "missing " + ", ".join(missing)))
 
-    clean_ticker_dict = {ticker: value for ticker, value in ticker_dict.items() if ticker not in remove_tickers}
-    json.dump(clean_ticker_dict, open(fn_tickers + '.json', 'w'))
-    ticker_dict = clean_ticker_dict
+    # Only the changed rows are written
+    set_ticker_status(ticker_dict, missing_rows, validated=False)
+    delete_tickers(remove_tickers)
+    ticker_dict = {ticker: value for ticker, value in ticker_dict.items() if ticker not in remove_tickers}
 
 
 # TODO Instead of calling "continue retrieval", it should automatically retrieve if valid tickers are missing info
 # Implement a MISSING_INFO flag so that script knows when a ticker has already been checked and is actually missing info
-#   * Can I differentiate between different errors, so that I can check if there was a communication error vs actual missing info?
-
-
-def create_process(batch_sz, p_tickers, p_id):
-    """ Create empty dictionaries for the process, since the process does not have access to the global variables
-        These will be accessed through their saved JSON files.
-    """
-    balance_sheet = {}
-    income_statement = {}
-    retrieve_data(batch_sz, p_tickers[0], "balance", f"{fn_balance}_{p_id}", balance_sheet)
-    retrieve_data(batch_sz, p_tickers[1], "income", f"{fn_income}_{p_id}", income_statement)
-
-
-def consolidate_json(remove=False):
-    """ Takes the various JSON files from processes and updates the dictionaries: balance_sheet, income_statement, market_cap_dict
-        Also removes the JSON files after consolidating
-    :param remove:
-    :return:
-    """
-    process_id = 0
-    while os.path.isfile(f"{fn_balance}_{process_id}.json"):
-        with open(f'{fn_balance}_{process_id}.json') as json_file:
-            temp_dict = json.load(json_file)
-            balance_sheet.update(temp_dict)
-        if remove:
-            try:
-                os.remove(f"{fn_balance}_{process_id}.json")
-            except OSError as e:
-                print(f"Error deleting JSON file {fn_balance}_{process_id}.json: {e}")
-        process_id += 1
-
-    process_id = 0
-    while os.path.isfile(f"{fn_income}_{process_id}.json"):
-        with open(f'{fn_income}_{process_id}.json') as json_file:
-            temp_dict = json.load(json_file)
-            income_statement.update(temp_dict)
-        if remove:
-            try:
-                os.remove(f"{fn_income}_{process_id}.json")
-            except OSError as e:
-                print(f"Error deleting JSON file {fn_income}_{process_id}.json: {e}")
-        process_id += 1
-
-    process_id = 0
-    while os.path.isfile(f"{fn_cap}_{process_id}.json"):
-        with open(f'{fn_cap}_{process_id}.json') as json_file:
-            temp_dict = json.load(json_file)
-            market_cap_dict.update(temp_dict)
-        if remove:
-            try:
-                os.remove(f"{fn_cap}_{process_id}.json")
-            except OSError as e:
-                print(f"Error deleting JSON file {fn_cap}_{process_id}.json: {e}")
-        process_id += 1
+#   * Can I differentiate between different errors, so that I can check if there was a communication error vs actual
+#     missing info?
 
 
 def old_refresh_tickers():
@@ -672,27 +2629,85 @@ def old_refresh_tickers():
         if is_common_stock(fields[1]):
             ticker_dict[fields[0]] = TICKER_NOT_VALIDATED
     fhr.close()
-    json.dump(ticker_dict, open(fn_tickers + ".json", "w"))
+    save_ticker_dict(ticker_dict)
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['rank']:
+        sys.exit(rank_main(sys.argv[2:]))
+
     parser = argparse.ArgumentParser(description='Process refresh options')
     parser.add_argument('--refresh', '-r', action='store_true', dest='refresh',
                         help='flag determines if we refresh the yahoo finance data')
     parser.add_argument('--tickers', '-t', action='store_true', dest='refresh_tickers',
                         help='gets list of stocks from nasdaq_stocks.csv')
     parser.add_argument('--continue', '-c', action='store_true', dest='continue_refresh',
-                        help='Refreshes only tickers not already stored in each JSON file')
-    parser.add_argument('--multiprocess', '-mc', type=int, nargs='?', default=1, dest='n_processes',
-                        help='Specify the number of processes to scrape data with')
+                        help='Refreshes only tickers not already stored in the statement store')
+    parser.add_argument('--multiprocess', '-mc', type=int, nargs='?', default=1, const=os.cpu_count(),
+                        dest='n_processes', help='Specify the number of processes to scrape data with')
+    parser.add_argument('--schedule', action='store_true', dest='schedule',
+                        help='Refreshes only the tickers that are due for a new quarterly filing, stalest first')
+    parser.add_argument('--budget', type=int, default=refresh_budget, dest='refresh_budget',
+                        help='Maximum number of requests a --schedule refresh makes')
     parser.add_argument('--verbose', '-v', action='store_true', dest='verbose',
                         help='Flag for extra print statements')
     parser.add_argument('--validate', action='store_true', dest='validate',
                         help='validates tickers and gets market cap data')
+    parser.add_argument('--local-validation', action='store_true', dest='local_validation',
+                        help="Validates tickers with the day's volume in nasdaq_stocks.csv instead of Yahoo Finance")
+    parser.add_argument('--escalate-margin', type=float, default=escalate_margin, dest='escalate_margin',
+                        help='With --local-validation, validates tickers whose dollar volume is within this fraction '
+                             'of the minimum through Yahoo Finance')
     parser.add_argument('--debug', '-d', action='store_true', dest='debug',
                         help='Reduces size of ticker_dict for debugging purposes')
+    parser.add_argument('--async', action='store_true', dest='use_async',
+                        help='Retrieves data with the asyncio engine, which is paced by --rate instead of fixed sleeps')
+    parser.add_argument('--rate', type=float, default=request_rate, dest='request_rate',
+                        help='Requests per second made by the asyncio engine')
+    parser.add_argument('--concurrency', type=int, default=max_concurrency, dest='max_concurrency',
+                        help='Maximum number of requests in flight for the asyncio engine')
+    parser.add_argument('--no-cache', action='store_false', dest='use_response_cache',
+                        help='Retrieves everything again, even responses that are still fresh in the response cache')
+    parser.add_argument('--export-arrow', action='store_true', dest='export_arrow',
+                        help='Writes the stored statements to Arrow snapshot files (needs pyarrow)')
+    parser.add_argument('--import-arrow', action='store_true', dest='import_arrow',
+                        help='Imports the statements of Arrow snapshot files into the statement store (needs pyarrow)')
+    parser.add_argument('--backtest', dest='backtest', metavar='PRICE_FILE',
+                        help='Backtests the Magic Formula with the daily closes in a CSV file (date, ticker, close)')
+    parser.add_argument('--start', type=date.fromisoformat, dest='start',
+                        help='First as-of date of the backtest (YYYY-MM-DD)')
+    parser.add_argument('--end', type=date.fromisoformat, dest='end',
+                        help='Last as-of date of the backtest (YYYY-MM-DD)')
+    parser.add_argument('--portfolio-size', type=int, default=portfolio_size, dest='portfolio_size',
+                        help='Number of stocks in each backtest portfolio')
+    parser.add_argument('--holding-days', type=int, default=holding_days, dest='holding_days',
+                        help='Number of days each backtest portfolio is held')
+    add_ranking_arguments(parser)
+    parser.add_argument('--profile', dest='profile_dir', metavar='DIR',
+                        help='Profiles each stage with cProfile, and writes a .prof file per stage and summary.txt, '
+                             'with the top functions of each stage, to DIR')
+    parser.add_argument('--profile-top', type=int, default=20, dest='profile_top',
+                        help='Number of functions per stage in the --profile summary')
+    parser.add_argument('--trace-memory', action='store_true', dest='trace_memory',
+                        help='With --profile, also traces the memory allocated by the JSON loads with tracemalloc')
+    parser.add_argument('--metrics', dest='metrics_file', metavar='FILE',
+                        help='Writes timers and counters of the run to FILE, as JSON or, if FILE ends with .prom, in '
+                             'the Prometheus text format')
+    parser.add_argument('--upsert', action='store_true', dest='upsert',
+                        help='Updates the rows of the retrieved tickers in stock_info instead of recreating the table')
+    parser.add_argument('--no-echo-errors', action='store_false', dest='echo_errors',
+                        help='Only log errors to the errors table, without printing them')
+    parser.add_argument('--error-flush-interval', type=float, default=error_flush_interval,
+                        dest='error_flush_interval', help='Maximum number of seconds between writes of logged errors')
     args = parser.parse_args()
     verbose = args.verbose
     debug = args.debug
+    echo_errors = args.echo_errors
+    request_rate = args.request_rate
+    max_concurrency = args.max_concurrency
+    use_response_cache = args.use_response_cache
+    local_validation = args.local_validation
+    escalate_margin = args.escalate_margin
+    error_flush_interval = args.error_flush_interval
 
     balance_sheet = {}
     income_statement = {}
@@ -702,62 +2717,50 @@ if __name__ == '__main__':
     # A value of -2 means it was flagged for removal (it should be removed, but for some reason wasn't), due to missing
     # volume, price, or market cap information during the validation process
     ticker_dict = {}
+    if args.profile_dir:
+        profiler = Profiler(args.profile_dir, args.profile_top, args.trace_memory)
     create_errors_table()
+    if args.metrics_file:
+        instrument_yahoofinancials()
 
     start = time.time()
 
+    if args.import_arrow:
+        import_statements_arrow()
+    if args.export_arrow:
+        export_statements_arrow()
+
     # refresh the tickers, volume, market cap, and sector info based on nasdaq_stocks.csv
     if args.refresh_tickers:
-        sector_dict = {}
-        price_dict = {}
-        with open(nasdaq_csv, newline="") as csvfile:
-            reader = csv.reader(csvfile, delimiter=",")
-            next(reader, None)  # skip the header
-            for row in reader:
-                if any([not cell for cell in row]):
-                    continue
-                print(row)
-                ticker = row[0]
-                description = row[1]
-                country = row[6]
-                sector = row[9]
-                industry = row[10]
-
-                if not is_common_stock(description):
-                    continue
-
-                price = float(sub(r'[^\d.]', '', row[2]))   # I use a float here instead of Decimal because for my purposes, precision isn't a big deal
-                market_cap = float(row[5])
-                daily_volume = int(row[8])
-
-                ticker_dict[ticker] = TICKER_NOT_VALIDATED
-                market_cap_dict[ticker] = market_cap
-                price_dict[ticker] = price
-                sector_dict[ticker] = {}
-                sector_dict[ticker]["sector"] = sector
-                sector_dict[ticker]["industry"] = industry
-                sector_dict[ticker]["country"] = country
-        json.dump(market_cap_dict, open(fn_cap + '.json', 'w'))
-        json.dump(price_dict, open(fn_price + '.json', 'w'))
+        screener = read_screener(nasdaq_csv)
+        # Only new tickers, and tickers whose market cap crossed min_market_cap, need to be validated again
+        ticker_dict, added, removed, changed = diff_screener(screener, load_ticker_dict(), load_market_caps(),
+                                                             load_prices(), load_sectors())
+        print(f"{len(added)} tickers added, {len(removed)} removed, {len(changed)} changed; "
+              f"{list(ticker_dict.values()).count(TICKER_NOT_VALIDATED)} need to be validated")
+        save_screener(screener, ticker_dict)
+        market_cap_dict = screener['market_cap'].to_dict()
+        price_dict = screener['price'].to_dict()
+        volume_dict = screener['volume'].to_dict()
+        sector_dict = screener[['sector', 'industry', 'country']].to_dict('index')
 
     else:
-        print("Loading ticker list...")
-        with open(fn_tickers + '.json') as json_list:
-            ticker_dict = json.load(json_list)
-        print("Loading price dict")
-        with open(fn_price + '.json') as price_dict_file:
-            price_dict = json.load(price_dict_file)
-        print("Loading sector, industry, and country info from JSON file...")
-        with open('sector_info.json') as json_file:
-            sector_dict = json.load(json_file)
-        print("Loading market caps from json file...")
-        with open(fn_cap + '.json') as json_file:
-            market_cap_dict = json.load(json_file)
+        with profiled("load_universe"):
+            print("Loading ticker list...")
+            ticker_dict = load_ticker_dict()
+            print("Loading price dict")
+            price_dict = load_prices()
+            volume_dict = load_volumes()
+            print("Loading sector, industry, and country info...")
+            sector_dict = load_sectors()
+            print("Loading market caps...")
+            market_cap_dict = load_market_caps()
 
     print(f"Number of tickers in ticker_dict: {len(ticker_dict)}")
 
     if debug:
-        ticker_dict = {key: ticker_dict[key] for key in list(ticker_dict.keys())[0:100]}  # For debugging purposes, when we want a smaller ticker_dict to work with
+        # For debugging purposes, when we want a smaller ticker_dict to work with
+        ticker_dict = {key: ticker_dict[key] for key in list(ticker_dict.keys())[0:100]}
 
     # Validates tickers and gets market cap info
     if args.validate:
@@ -775,23 +2778,22 @@ if __name__ == '__main__':
 
         ticker_list = get_valid_ticker_list()
 
-        retrieve_data(batch_size, ticker_list, "balance", fn_balance, balance_sheet)
-        retrieve_data(batch_size, ticker_list, "income", fn_income, income_statement)
+        retrieve_statements(ticker_list, args.n_processes, args.use_async)
         clean_tickers()
 
     else:
-        print("Loading all stock data from json files...")
-        print("Loading quarterly balance sheets from json file...")
-        with open(fn_balance + '.json') as json_file:
-            balance_sheet = json.load(json_file)
-        print("Loading quarterly income statement history from json file...")
-        with open(fn_income + '.json') as json_file:
-            income_statement = json.load(json_file)
+        # Only the fields and quarters used by the ranking are loaded. When not retrieving anything, only the tickers
+        # that will be ranked are loaded.
+        load_list = get_valid_ticker_list()
+        if not args.continue_refresh and not args.schedule:
+            load_list = filter_tickers(load_list, args.sectors, args.only)
+        print("Loading the latest balance sheets and income statements from the statement store...")
+        balance_sheet, income_statement = load_ranking_statements(load_list)
 
     # Retrieves the data for tickers that have not been retrieved yet (i.e. not in the dictionary yet)
     # Note: balance_sheet, income_statement, and market_cap_dict are already loaded in the args.refresh if-else block
     if args.continue_refresh:
-        print("Continuing retrieval of stock data that is not already in json files...")
+        print("Continuing retrieval of stock data that is not already in the statement store...")
 
         # check that volume and market cap exceed specific thresholds for non-validated tickers
         if not is_tickers_validated():
@@ -799,85 +2801,56 @@ if __name__ == '__main__':
 
         ticker_list = get_valid_ticker_list()
 
-        # Step 1: Consolidate any JSON sub_files into the dictionaries for the respective metric
-        # Iterate through all sub_lists of each process
-        print("Consolidating JSON files and removing sub_files...")
-        consolidate_json(remove=True)
-
-        # Step 2: Find the tickers in the ticker_dict whose data has not been retrieved yet
-        balance_keys = balance_sheet.keys()
-        income_keys = income_statement.keys()
-        cap_keys = market_cap_dict.keys()
-        balance_sublist = [i for i in ticker_list if i not in balance_keys]
-        income_sublist = [i for i in ticker_list if i not in income_keys]
-        cap_sublist = [i for i in ticker_list if i not in cap_keys]
-
-        # Step 3: Separate the un-retrieved tickers for each metric into the desired number of processes
-        p_balance_list = list()
-        p_income_list = list()
-        p_cap_list = list()
-        print("Splitting tickers up between processes...")
-        print(f"Number of processes: {args.n_processes}")
-        if len(balance_sublist) % args.n_processes == 0:
-            p_size = len(balance_sublist) // args.n_processes
-        else:  # If the number of processes does not divide evenly into the number of tickers
-            # TODO Find better method when # of processes does not divide evenly into # number of tickers
-            p_size = (len(balance_sublist) // args.n_processes) + 1
-        for i in range(args.n_processes):
-            # Store the separate lists of tickers for each process into a list
-            p_balance_list.append(balance_sublist[i * p_size: min((i + 1) * p_size, len(balance_sublist))])
-
-        if len(income_sublist) % args.n_processes == 0:
-            p_size = len(income_sublist) // args.n_processes
-        else:  # If the number of processes does not divide evenly into the number of tickers
-            # TODO Find better method when # of processes does not divide evenly into # number of tickers
-            p_size = (len(income_sublist) // args.n_processes) + 1
-        for i in range(args.n_processes):
-            p_income_list.append(income_sublist[i * p_size: min((i + 1) * p_size, len(income_sublist))])
-
-        if len(cap_sublist) % args.n_processes == 0:
-            p_size = len(cap_sublist) // args.n_processes
-        else:  # If the number of processes does not divide evenly into the number of tickers
-            # TODO Find better method when # of processes does not divide evenly into # number of tickers
-            p_size = (len(cap_sublist) // args.n_processes) + 1
-        for i in range(args.n_processes):
-            p_cap_list.append(cap_sublist[i * p_size: min((i + 1) * p_size, len(cap_sublist))])
-
-        # Step 4: Retrieve the data; each list in the process lists gets its own process
-        p_ticker_list = list(zip(p_balance_list, p_income_list, p_cap_list))
-
-        print("Creating processes...")
-        jobs = []
-        for i in range(args.n_processes):
-            process = Process(target=create_process, args=(batch_size, p_ticker_list[i], i))
-            jobs.append(process)
-
-        print("Starting processes...")
-        for j in jobs:
-            j.start()
-
-        print("Waiting for processes to finish...")
-        for j in jobs:
-            j.join()
-
-        # Consolidate the dictionaries for each process into a main dictionary for each metric
-        # This is completed through the JSON files that were saved. Then remove the process's JSON files.
-        consolidate_json(remove=True)
-
-        # Step 7: Clean the tickers; this also saves the dictionaries into the main JSON file
+        # Find the tickers in the ticker_dict whose data has not been retrieved yet
+        statement_store = get_statement_store()
+        balance_keys = statement_store.tickers("balance")
+        income_keys = statement_store.tickers("income")
+        # Both statements are retrieved together, so a ticker missing either one is retrieved again
+        statement_sublist = [i for i in ticker_list if i not in balance_keys or i not in income_keys]
+        retrieve_statements(statement_sublist, args.n_processes, args.use_async)
+
+        # Clean the tickers; this also saves the ticker_dict
         clean_tickers()
 
 
+    # Refreshes only the tickers that may have filed a new quarterly statement since they were last retrieved
+    if args.schedule and not args.refresh:
+        print("Refreshing the tickers that are due for a new filing...")
+
+        if not is_tickers_validated():
+            validate_tickers(ticker_dict, market_cap_dict, newonly=True)
+
+        # Both statements of a ticker are retrieved with one request
+        due_list = schedule_refresh(get_valid_ticker_list(), args.refresh_budget, 1)
+        retrieve_statements(due_list, args.n_processes, args.use_async)
+        clean_tickers()
+
     # update db with tickers that have the data for balance sheet, income statement, and market cap
     ticker_list = list()
-    for matched_ticker in get_valid_ticker_list():
+    for matched_ticker in filter_tickers(get_valid_ticker_list(), args.sectors, args.only):
         if matched_ticker in balance_sheet and matched_ticker in income_statement and matched_ticker in market_cap_dict:
             ticker_list.append(matched_ticker)
         else:
             print(f"Not inserting {matched_ticker} into db: Missing Data")
-    update_db(ticker_list)
-
-    rank_stocks(fn_stock_info_db)
+    update_db(ticker_list, upsert=args.upsert)
+
+    conn = sq.connect(rf'{fn_stock_info_db}')
+    rank_with_arguments(conn, args)
+    conn.close()
+
+    # The backtest universe is every stored ticker, not only the currently valid ones, to limit survivorship bias:
+    # tickers that are no longer listed are ranked with the share counts of their stored balance sheets
+    if args.backtest:
+        backtest_list = get_statement_store().tickers("balance") & get_statement_store().tickers("income")
+        run_backtest(args.backtest, filter_tickers(backtest_list, args.sectors, args.only), args.start, args.end,
+                     args.portfolio_size, args.holding_days, args.n_processes)
     end = time.time()
 
     print(f"Execution time: {end - start}")
+    if args.metrics_file:
+        metrics.observe("stage_seconds", end - start, stage="run")
+        close_error_sink()
+        metrics.dump(args.metrics_file)
+        print(f"Wrote metrics to {args.metrics_file}")
+    if profiler is not None:
+        print(f"Wrote profiles to {args.profile_dir}; see {profiler.write()}")
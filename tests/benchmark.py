@@ -0,0 +1,133 @@
+"""
+Offline benchmark of the scoring and persistence pipeline
+
+Builds synthetic universes (balance_sheet, income_statement, market_cap_dict, sector_dict, and ticker_dict in the same
+nested shapes the script uses), and times each stage of a run on them, without any network access:
+
+    json_load       json.load of the quarterly statement JSON files
+    json_import     load_statements importing those JSON files into the statement store
+    store_load      load_ranking_statements loading the ranking's fields and quarters from the store
+    clean_tickers   clean_tickers flagging the valid tickers with missing statements
+    update_db       update_db computing the metrics and writing stock_info
+    rank            ranking_rows ranking the fresh stocks, as rank_stocks does
+    csv_export      write_ranking_csv writing the ranking to stock_info.csv, as rank_stocks does
+
+Usage: python tests/benchmark.py [--sizes 1000 10000 100000] [--output benchmark.json]
+The timings (in seconds) are printed, or written to --output, as JSON.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import magic_formula as mf
+from test_magic_formula import make_universe
+
+SECTORS = ['Technology', 'Healthcare', 'Industrials', 'Energy', 'Utilities', 'Financial Services']
+COUNTRIES = ['United States', 'United States', 'United States', 'Canada', 'China']
+TODAY = mf.date(2023, 1, 31)  # The synthetic statements end in 2022, so they're fresh as of this date
+
+
+def make_benchmark_universe(n_tickers, seed=0):
+    """ A synthetic universe of n_tickers: make_universe's statements and market caps, plus sector info and a ticker
+        dict. About 1% of the tickers are flagged for removal, and about 2% of the valid ones have no balance sheet """
+    rng = random.Random(seed)
+    balance_sheet, income_statement, market_cap_dict = make_universe(n_tickers, seed)
+    sector_dict = {ticker: {'sector': rng.choice(SECTORS), 'industry': 'Industry ' + str(rng.randrange(50)),
+                            'country': rng.choice(COUNTRIES)} for ticker in balance_sheet}
+    ticker_dict = {}
+    for ticker in list(balance_sheet):
+        roll = rng.random()
+        ticker_dict[ticker] = mf.TICKER_REMOVE if roll < 0.01 else mf.TICKER_VALID
+        if 0.01 <= roll < 0.03:
+            del balance_sheet[ticker]
+    return balance_sheet, income_statement, market_cap_dict, sector_dict, ticker_dict
+
+
+def run_benchmark(n_tickers, work_dir):
+    """ Times each stage on a universe of n_tickers, with every file in work_dir. Returns {stage: seconds} """
+    timings = {}
+
+    @contextlib.contextmanager
+    def stage(name):
+        start = time.perf_counter()
+        yield
+        timings[name] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    balance_sheet, income_statement, market_cap_dict, sector_dict, ticker_dict = make_benchmark_universe(n_tickers)
+    generate_time = time.perf_counter() - start
+
+    mf.fn_stock_info_db = os.path.join(work_dir, 'stock_info.db')
+    mf.fn_response_cache = os.path.join(work_dir, 'response_cache.db')
+    mf.fn_balance = os.path.join(work_dir, 'quarterly_balance_sheet')
+    mf.fn_income = os.path.join(work_dir, 'quarterly_income_statement')
+    mf.echo_errors = False
+    for file_name, statements in ((mf.fn_balance, balance_sheet), (mf.fn_income, income_statement)):
+        with open(file_name + '.json', 'w') as json_file:
+            json.dump(statements, json_file)
+    mf.create_errors_table()
+    mf.save_ticker_dict(ticker_dict)
+    mf.market_cap_dict, mf.sector_dict, mf.ticker_dict = market_cap_dict, sector_dict, ticker_dict
+
+    with stage('json_load'):
+        for file_name in (mf.fn_balance, mf.fn_income):
+            with open(file_name + '.json') as json_file:
+                json.load(json_file)
+    with stage('json_import'):
+        mf.load_statements("balance", mf.fn_balance)
+        mf.load_statements("income", mf.fn_income)
+    with stage('store_load'):
+        mf.balance_sheet, mf.income_statement = mf.load_ranking_statements(mf.get_valid_ticker_list())
+    with stage('clean_tickers'):
+        mf.clean_tickers()
+    tickers = [ticker for ticker in mf.get_valid_ticker_list() if ticker in mf.balance_sheet]
+    with stage('update_db'):
+        mf.update_db(tickers)
+    conn = sqlite3.connect(mf.fn_stock_info_db)
+    with stage('rank'):
+        columns, ranking = mf.ranking_rows(conn, today=TODAY)
+    with stage('csv_export'):
+        mf.write_ranking_csv(columns, ranking, os.path.join(work_dir, 'stock_info.csv'))
+    conn.close()
+
+    mf.close_error_sink()
+    timings['total'] = sum(timings.values())
+    timings['generate'] = generate_time
+    timings['ranked'] = len(ranking)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times each stage of the pipeline on synthetic universes')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Numbers of tickers of the synthetic universes')
+    parser.add_argument('--output', help='Writes the results to this JSON file instead of printing them')
+    args = parser.parse_args()
+
+    results = {'python': platform.python_version(), 'numpy': np.__version__, 'sqlite': sqlite3.sqlite_version,
+               'machine': platform.machine(), 'universes': {}}
+    for n_tickers in args.sizes:
+        with tempfile.TemporaryDirectory() as work_dir, contextlib.redirect_stdout(io.StringIO()):
+            results['universes'][str(n_tickers)] = run_benchmark(n_tickers, work_dir)
+        print(f"{n_tickers} tickers: {results['universes'][str(n_tickers)]['total']:.2f}s", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
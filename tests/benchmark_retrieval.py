@@ -0,0 +1,126 @@
+"""
+Offline benchmark of retrieval and validation against a local Yahoo Finance stand-in (yahoo_mock)
+
+Serves a synthetic universe from a MockYahooServer with the given latency, error rate, and throttling, and runs
+retrieve_statements and validate_tickers against it for every combination of batch size, number of threads, and thread
+start delay (and the asyncio engine with --async), reporting throughput, request latency percentiles, and the responses
+the server gave (HTTP 429 and 500 responses are what YahooFinancials retries).
+
+Usage: python tests/benchmark_retrieval.py [--tickers 200] [--latency 0.05] [--max-rate 20] [--batch-sizes 10 20]
+           [--threads 3 10] [--delays 0 1] [--async] [--output retrieval.json]
+The results are printed, or written to --output, as JSON.
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import magic_formula as mf
+import yahoo_mock
+from benchmark import make_benchmark_universe
+
+
+def make_recordings(n_tickers):
+    """ A synthetic universe of n_tickers as recordings, and its (tickers, market caps, prices) """
+    balance_sheet, income_statement, market_cap_dict, sector_dict, ticker_dict = make_benchmark_universe(n_tickers)
+    prices = {ticker: 10.0 + i % 90 for i, ticker in enumerate(market_cap_dict)}
+    volumes = {ticker: 10 ** 5 * (1 + i % 20) for i, ticker in enumerate(market_cap_dict)}
+    recordings = yahoo_mock.recordings_from_statements(balance_sheet, income_statement, market_cap_dict, prices,
+                                                       volumes)
+    return recordings, list(market_cap_dict), market_cap_dict, prices
+
+
+def run_retrieval(server, tickers, market_caps, prices, stage, work_dir, sleep_scale=0.0, use_async=False):
+    """ Runs one stage ("statements" or "validate") against server, with every file in work_dir. Returns its
+        throughput, request latencies, and the statuses of the server's responses """
+    mf.fn_stock_info_db = os.path.join(work_dir, 'stock_info.db')
+    mf.fn_response_cache = os.path.join(work_dir, 'response_cache.db')
+    mf.echo_errors = False
+    mf.use_response_cache = False
+    mf.yahoo_base_url = server.base_url
+    mf.create_errors_table()
+    mf.balance_sheet, mf.income_statement = {}, {}
+    mf.market_cap_dict, mf.price_dict = dict(market_caps), dict(prices)
+    mf.ticker_dict = {ticker: mf.TICKER_NOT_VALIDATED for ticker in tickers}
+    mf.save_ticker_dict(mf.ticker_dict)
+
+    harness = yahoo_mock.YahooFinancialsHarness(server.base_url, sleep_scale=sleep_scale)
+    statuses_before = server.statuses.copy()
+    start = time.perf_counter()
+    with harness.active():
+        if stage == "statements":
+            mf.retrieve_statements(tickers, use_async=use_async)
+            done = sum(1 for ticker in tickers if mf.income_statement.get(ticker))
+        else:
+            mf.validate_tickers(mf.ticker_dict, mf.market_cap_dict, batch_sz=mf.batch_size)
+            done = sum(1 for status in mf.ticker_dict.values() if status != mf.TICKER_NOT_VALIDATED)
+    elapsed = time.perf_counter() - start
+    mf.close_error_sink()
+
+    result = {'seconds': elapsed, 'tickers': len(tickers), 'done': done, 'tickers_per_second': done / elapsed,
+              'server_statuses': {str(status): count - statuses_before[status]
+                                  for status, count in server.statuses.items() if count > statuses_before[status]}}
+    if not use_async:
+        result.update(harness.summary())
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks retrieval against a local Yahoo Finance stand-in')
+    parser.add_argument('--tickers', type=int, default=200, help='Number of tickers in the synthetic universe')
+    parser.add_argument('--stages', nargs='+', default=['statements', 'validate'], choices=['statements', 'validate'])
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds every response is delayed')
+    parser.add_argument('--jitter', type=float, default=0.02, help='Mean of an extra, random delay, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 429')
+    parser.add_argument('--max-rate', type=float, help='Requests per second above which requests get HTTP 429')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[mf.batch_size])
+    parser.add_argument('--threads', type=int, nargs='+', default=[mf.max_threads])
+    parser.add_argument('--delays', type=float, nargs='+', default=[0.0],
+                        help='Seconds between starting two threads (thread_start_delay)')
+    parser.add_argument('--sleep-scale', type=float, default=0.0,
+                        help="Scales YahooFinancials' 2-10 second waits before retrying; 1 keeps them as they are")
+    parser.add_argument('--async', action='store_true', dest='use_async',
+                        help='Also benchmarks the asyncio engine (statements only), at --rate and --concurrency')
+    parser.add_argument('--rate', type=float, default=20.0)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output', help='Writes the results to this JSON file instead of printing them')
+    args = parser.parse_args()
+
+    recordings, tickers, market_caps, prices = make_recordings(args.tickers)
+    results = {'server': {'latency': args.latency, 'jitter': args.jitter, 'error_rate': args.error_rate,
+                          'throttle_rate': args.throttle_rate, 'max_rate': args.max_rate}, 'runs': []}
+    with yahoo_mock.MockYahooServer(recordings, args.latency, args.jitter, args.error_rate, args.throttle_rate,
+                                    args.max_rate, seed=0) as server:
+        runs = [(stage, batch_size, threads, delay, False) for stage, batch_size, threads, delay
+                in itertools.product(args.stages, args.batch_sizes, args.threads, args.delays)]
+        if args.use_async and 'statements' in args.stages:
+            runs.append(('statements', mf.batch_size, None, None, True))
+        for stage, batch_size, threads, delay, use_async in runs:
+            mf.batch_size, mf.request_rate, mf.max_concurrency = batch_size, args.rate, args.concurrency
+            if not use_async:
+                mf.max_threads, mf.thread_start_delay = threads, delay
+            with tempfile.TemporaryDirectory() as work_dir, contextlib.redirect_stdout(io.StringIO()):
+                result = run_retrieval(server, tickers, market_caps, prices, stage, work_dir, args.sleep_scale,
+                                       use_async)
+            run = {'stage': stage, 'engine': 'async' if use_async else 'threads', 'batch_size': batch_size,
+                   'threads': threads, 'thread_start_delay': delay}
+            results['runs'].append(dict(run, **result))
+            print(f"{run}: {result['tickers_per_second']:.1f} tickers/s", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+import unittest
+import tempfile
+import magic_formula as mf
+import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.old_globals = {name: getattr(mf, name) for name in ('fn_stock_info_db', 'fn_response_cache', 'fn_balance',
+                                                                  'fn_income', 'echo_errors')}
+
+    def tearDown(self):
+        for name, value in self.old_globals.items():
+            setattr(mf, name, value)
+
+    def test_run_benchmark(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            timings = benchmark.run_benchmark(300, work_dir)
+            self.assertEqual(mf.load_tickers_with_status(mf.TICKER_REMOVE), [])
+        for stage in ('json_load', 'json_import', 'store_load', 'clean_tickers', 'update_db', 'rank', 'csv_export'):
+            self.assertGreaterEqual(timings[stage], 0)
+        # Valid tickers without a balance sheet aren't ranked
+        self.assertGreater(timings['ranked'], 0)
+        self.assertLess(timings['ranked'], 300)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,793 @@
+import unittest
+import os
+import sys
+import csv
+import subprocess
+import random
+import tempfile
+import multiprocessing
+import importlib.util
+import numpy as np
+import magic_formula as mf
+
+
+BALANCE_KEYS = ['accountsPayable', 'intangibleAssets', 'totalAssets', 'netTangibleAssets', 'totalLiab',
+                'totalLiabilitiesNetMinorityInterest', 'totalCurrentAssets', 'totalNonCurrentAssets', 'longTermDebt',
+                'totalCurrentLiabilities', 'currentLiabilities', 'cash', 'cashAndCashEquivalents']
+QUARTERS = ['2021-03-31', '2021-06-30', '2021-09-30', '2021-12-31', '2022-03-31', '2022-06-30']
+
+
+def make_universe(n_tickers, seed=0):
+    """ Builds a random balance_sheet, income_statement, and market_cap_dict in the same nested shape as the JSON
+        files. Some fields are left out or set to None so that every fallback gets exercised """
+    rng = random.Random(seed)
+    balance_sheet, income_statement, market_cap_dict = {}, {}, {}
+    for i in range(n_tickers):
+        ticker = f"T{i}"
+        quarters = rng.sample(QUARTERS, rng.randint(3, len(QUARTERS)))  # Out of order on purpose
+        balance_sheet[ticker] = []
+        income_statement[ticker] = []
+        for quarter in quarters:
+            values = {}
+            for key in BALANCE_KEYS:
+                roll = rng.random()
+                if roll < 0.15:
+                    continue
+                values[key] = None if roll < 0.17 else rng.randint(0, 10 ** 10)
+            balance_sheet[ticker].append({quarter: values})
+            ebit = None if rng.random() < 0.03 else rng.randint(-10 ** 8, 10 ** 9)
+            income_statement[ticker].append({quarter: {'ebit': ebit, 'netIncome': rng.randint(0, 10 ** 8)}})
+        market_cap_dict[ticker] = float(rng.randint(10 ** 7, 10 ** 11))
+    return balance_sheet, income_statement, market_cap_dict
+
+
+def call_or_none(func, ticker):
+    try:
+        return func(ticker)
+    except Exception:
+        return None
+
+
+class TestMagicFormula(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_db = mf.fn_stock_info_db
+        self.old_cache = mf.fn_response_cache
+        mf.fn_stock_info_db = os.path.join(self.tmp_dir.name, 'stock_info.db')
+        mf.fn_response_cache = os.path.join(self.tmp_dir.name, 'response_cache.db')
+        mf.create_errors_table()
+        mf.balance_sheet, mf.income_statement, mf.market_cap_dict = make_universe(300)
+        mf.sector_dict = {ticker: {'sector': 'Technology', 'industry': 'Software', 'country': 'United States'}
+                          for ticker in mf.balance_sheet}
+
+    def tearDown(self):
+        mf.close_error_sink()
+        mf.fn_stock_info_db = self.old_db
+        mf.fn_response_cache = self.old_cache
+        self.tmp_dir.cleanup()
+
+    def test_compute_metrics_matches_getters(self):
+        """ The vectorized metrics must give exactly the same numbers as the per-ticker getters, and must leave out
+            exactly the tickers for which the getters raise """
+        tickers = list(mf.balance_sheet.keys())
+        metrics = mf.compute_metrics(tickers)
+        for ticker in tickers:
+            expected_roc = call_or_none(mf.get_roc, ticker)
+            expected_yield = call_or_none(mf.get_yield, ticker)
+            roc = metrics.loc[ticker, 'roc']
+            earnings_yield = metrics.loc[ticker, 'yield']
+            if expected_roc is None:
+                self.assertFalse(np.isfinite(roc), ticker)
+            else:
+                self.assertEqual(roc, expected_roc, ticker)
+            if expected_yield is None:
+                self.assertFalse(np.isfinite(earnings_yield), ticker)
+            else:
+                self.assertEqual(earnings_yield, expected_yield, ticker)
+            if expected_roc is not None and expected_yield is not None:
+                self.assertEqual(metrics.loc[ticker, 'ebit'], mf.get_ebit(ticker), ticker)
+                self.assertEqual(metrics.loc[ticker, 'ev'], mf.get_ev(ticker), ticker)
+            self.assertEqual(metrics.loc[ticker, 'most_recent'], call_or_none(mf.get_financials_date, ticker), ticker)
+
+    def test_snapshot_logs_missing_fields_once(self):
+        mf.balance_sheet['T0'] = [{'2022-06-30': {'totalAssets': 100, 'totalCurrentAssets': 50, 'intangibleAssets': 5,
+                                                  'accountsPayable': 10, 'totalCurrentLiabilities': 20,
+                                                  'netTangibleAssets': 60, 'totalLiab': 30, 'longTermDebt': 1}}]
+        mf.get_roc('T0')
+        mf.get_yield('T0')
+        self.assertIs(mf.get_snapshot('T0'), mf.get_snapshot('T0'))
+        self.assertEqual(mf.get_cash('T0'), 0)
+
+        mf.get_error_sink().flush()
+        conn = mf.sq.connect(mf.fn_stock_info_db)
+        errors = [row[0] for row in conn.execute("SELECT error FROM errors WHERE ticker = 'T0'")]
+        conn.close()
+        self.assertEqual(errors, ["Missing 'cash' information for T0, trying different method",
+                                  "Missing 'cashAndCashEquivalents' information for T0"])
+
+        # A re-retrieved balance sheet gets a new snapshot
+        mf.balance_sheet['T0'] = [{'2022-09-30': {'cash': 7}}]
+        self.assertEqual(mf.get_cash('T0'), 7)
+
+    def test_compute_metrics_logs_missing_fields(self):
+        mf.balance_sheet['T0'] = [{'2022-06-30': {'totalAssets': 100, 'accountsPayable': 10, 'netTangibleAssets': 60,
+                                                  'totalLiabilitiesNetMinorityInterest': 30, 'longTermDebt': 1,
+                                                  'currentLiabilities': 20, 'cash': 3}}]
+        mf.create_errors_table()
+        mf.compute_metrics(['T0'])
+        conn = mf.sq.connect(mf.fn_stock_info_db)
+        mf.get_error_sink().flush()
+        errors = [row[0] for row in conn.execute("SELECT error FROM errors ORDER BY error_id")]
+        mf.create_errors_table()
+        mf.FinancialSnapshot('T0')
+        mf.get_error_sink().flush()
+        self.assertEqual(errors, [row[0] for row in conn.execute("SELECT error FROM errors ORDER BY error_id")])
+        conn.close()
+        self.assertIn("Missing 'totalNonCurrentAssets' information for T0", errors)
+
+    def test_error_sink_batches_writes(self):
+        sink = mf.ErrorSink(mf.fn_stock_info_db, flush_size=3, flush_interval=60, echo=False)
+        threads = [mf.threading.Thread(target=sink.add, args=(f"T{i}", "Missing 'cash'", mf.ERROR_MISSING_FIELD))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        conn = mf.sq.connect(mf.fn_stock_info_db)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM errors").fetchone()[0], 6)
+        sink.close()
+        self.assertEqual(conn.execute("SELECT error_type, COUNT(*) FROM errors GROUP BY error_type").fetchall(),
+                         [(mf.ERROR_MISSING_FIELD, 8)])
+
+        # Errors are written after flush_interval seconds, even if no more errors are added
+        sink = mf.ErrorSink(mf.fn_stock_info_db, flush_size=100, flush_interval=0.05, echo=False)
+        sink.add('T0', "Missing 'cash'", mf.ERROR_MISSING_FIELD)
+        deadline = mf.time.time() + 5
+        while conn.execute("SELECT COUNT(*) FROM errors").fetchone()[0] < 9 and mf.time.time() < deadline:
+            mf.time.sleep(0.01)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM errors").fetchone()[0], 9)
+        self.assertIsNone(sink._timer)
+        sink.close()
+        conn.close()
+
+    def test_quarterly_index(self):
+        mf.income_statement['T0'] = [{'2022-03-31': {'ebit': 3}}, {'2021-09-30': {'ebit': 1}},
+                                     {'2022-06-30': {'ebit': 4}}, {'2021-12-31': {'ebit': 2}},
+                                     {'2021-06-30': {'ebit': 10}}]
+        mf.balance_sheet['T0'] = [{'2022-03-31': {}}, {'2021-12-31': {}}]
+        index = mf.get_income_index()
+        self.assertEqual(mf.get_ebit('T0'), 10)
+        self.assertEqual(index.most_recent('T0'), mf.date(2022, 6, 30))
+        self.assertEqual(mf.get_financials_date('T0'), mf.date(2022, 3, 31))
+        self.assertEqual(index.ttm_as_of('T0', mf.date(2022, 5, 1)), 16)
+        self.assertEqual(index.ttm('T0', window=2), 7)
+        ordinals, sums = index.rolling_ttm('T0')
+        self.assertEqual([mf.date.fromordinal(int(o)) for o in ordinals], [mf.date(2022, 3, 31), mf.date(2022, 6, 30)])
+        self.assertEqual(list(sums), [16, 10])
+
+        # Replacing a ticker's statement re-indexes only that ticker
+        mf.income_statement['T0'] = [{'2022-09-30': {'ebit': 5}}]
+        self.assertIs(mf.get_income_index(), index)
+        self.assertEqual(mf.get_ebit('T0'), 5)
+
+    def test_update_db(self):
+        tickers = list(mf.balance_sheet.keys())
+        mf.update_db(tickers)
+        conn = mf.sq.connect(mf.fn_stock_info_db)
+        rows = dict(conn.execute("SELECT ticker, roc FROM stock_info").fetchall())
+        self.assertEqual(rows, {ticker: mf.get_roc(ticker) for ticker in tickers
+                                if call_or_none(mf.get_roc, ticker) is not None
+                                and call_or_none(mf.get_yield, ticker) is not None})
+
+        # Upserting keeps the rows of the other tickers
+        ticker = next(iter(rows))
+        mf.market_cap_dict[ticker] *= 2
+        mf.update_db([ticker], upsert=True)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM stock_info").fetchone()[0], len(rows))
+        self.assertEqual(conn.execute("SELECT market_cap FROM stock_info WHERE ticker = ?", (ticker,)).fetchone()[0],
+                         mf.market_cap_dict[ticker])
+
+        # Each row records when its statements were last retrieved
+        mf.get_statement_store().save_all({'balance': {ticker: mf.balance_sheet[ticker]},
+                                           'income': {ticker: mf.income_statement[ticker]}})
+        mf.update_db([ticker], upsert=True)
+        self.assertEqual(conn.execute("SELECT refreshed FROM stock_info WHERE ticker = ?", (ticker,)).fetchone()[0],
+                         mf.date.today().isoformat())
+        conn.close()
+
+    def test_get_ranking(self):
+        mf.update_db(list(mf.balance_sheet))
+        conn = mf.sq.connect(mf.fn_stock_info_db)
+        conn.execute("UPDATE stock_info SET most_recent = '2021-03-31' WHERE ticker IN ('T1', 'T2', 'T3')")
+        conn.commit()
+        self.assertIn('COVERING INDEX stock_info_ranking', str(conn.execute(
+            "EXPLAIN QUERY PLAN SELECT rowid, RANK() OVER (ORDER BY roc DESC), RANK() OVER (ORDER BY yield DESC) "
+            "FROM stock_info WHERE most_recent > ?", ('2022-01-01',)).fetchall()))
+
+        # Stale stocks are left out before ranking, so the ranks are the ones among the fresh stocks only
+        today = mf.date(2023, 1, 31)
+        expected = mf.pd.read_sql_query('''
+            SELECT ticker, RANK() OVER (ORDER BY roc DESC) + RANK() OVER (ORDER BY yield DESC) AS magic_rank
+            FROM stock_info WHERE most_recent > ? ORDER BY magic_rank, rowid''', conn,
+            params=((today - mf.timedelta(days=mf.max_statement_age)).isoformat(),))
+        conn.close()
+        ranking = mf.get_ranking(mf.fn_stock_info_db, today=today)
+        self.assertEqual(list(ranking['ticker']), list(expected['ticker']))
+        self.assertEqual(list(ranking['magic_rank']), list(expected['magic_rank']))
+        self.assertTrue({'T1', 'T2', 'T3'}.isdisjoint(ranking['ticker']))
+
+        top = mf.get_ranking(mf.fn_stock_info_db, 10, today=today)
+        mf.pd.testing.assert_frame_equal(top, ranking.head(10))
+
+    def test_group_rankings(self):
+        sectors = ['Technology', 'Utilities', 'Financial Services', 'Energy']
+        for i, ticker in enumerate(mf.balance_sheet):
+            mf.sector_dict[ticker] = {'sector': sectors[i % 4], 'industry': 'Software',
+                                      'country': 'Canada' if i % 5 == 0 else 'United States'}
+        mf.sector_dict['T1']['sector'] = None
+        mf.update_db(list(mf.balance_sheet))
+        today = mf.date(2023, 1, 31)
+        filters = {'exclude_sectors': ['Utilities', 'Financial Services'], 'countries': ['United States']}
+
+        ranking = mf.get_ranking(mf.fn_stock_info_db, today=today, **filters)
+        # A stock without a sector isn't in an excluded one
+        self.assertEqual(set(ranking['sector'].dropna()), {'Technology', 'Energy'})
+        self.assertIn('T1', set(ranking['ticker']))
+        self.assertEqual(set(ranking['country']), {'United States'})
+
+        # Each sector is ranked as if it were ranked on its own
+        grouped = mf.get_group_rankings(mf.fn_stock_info_db, 'sector', today=today, **filters)
+        for sector, group in grouped.groupby('sector'):
+            expected = ranking[ranking['sector'] == sector]
+            roc_rank = expected['roc'].rank(method='min', ascending=False)
+            yield_rank = expected['yield'].rank(method='min', ascending=False)
+            self.assertEqual(sorted(group['magic_rank']), sorted((roc_rank + yield_rank).astype(int)))
+            self.assertTrue(group['magic_rank'].is_monotonic_increasing)
+        self.assertEqual(len(grouped), len(ranking))
+
+        top = mf.get_group_rankings(mf.fn_stock_info_db, 'sector', 5, today=today, **filters)
+        mf.pd.testing.assert_frame_equal(top.reset_index(drop=True),
+                                         grouped.groupby('sector', dropna=False).head(5).reset_index(drop=True))
+        with self.assertRaises(ValueError):
+            mf.get_group_rankings(mf.fn_stock_info_db, 'ticker')
+
+    def test_statement_store(self):
+        store = mf.get_statement_store()
+        store.save('balance', mf.balance_sheet)
+        store.save('balance', {'EMPTY': [], 'NONE': None})
+        self.assertEqual(store.tickers('balance'), set(mf.balance_sheet) | {'EMPTY', 'NONE'})
+        self.assertTrue(store.is_empty('income'))
+
+        loaded = store.load('balance')
+        self.assertEqual({ticker: loaded[ticker] for ticker in mf.balance_sheet}, mf.balance_sheet)
+        self.assertEqual(loaded['EMPTY'], [])
+        self.assertEqual(loaded['NONE'], [])
+
+        # Saving a ticker again replaces its quarters
+        store.save('balance', {'T0': [{'2023-03-31': {'cash': 1}}]})
+        self.assertEqual(store.load('balance', ['T0', 'T1']), {'T0': [{'2023-03-31': {'cash': 1}}],
+                                                             'T1': mf.balance_sheet['T1']})
+
+        # Both statements of a batch retrieved in one pass are saved together
+        store.save_all({'balance': {'T2': [{'2023-03-31': {'cash': 2}}]},
+                        'income': {'T2': [{'2023-03-31': {'ebit': 3}}]}})
+        self.assertEqual(store.load('balance', ['T2']), {'T2': [{'2023-03-31': {'cash': 2}}]})
+        self.assertEqual(store.load('income'), {'T2': [{'2023-03-31': {'ebit': 3}}]})
+
+        # Statements that weren't just retrieved keep the refresh time they have
+        refresh_times = store.refresh_times(['T2', 'EMPTY'])
+        store.save('income', {'T2': [], 'NEW': []}, refreshed=False)
+        self.assertEqual(store.refresh_times(['T2', 'NEW']), {'T2': refresh_times['T2']})
+
+    def test_load_ranking_statements(self):
+        """ Ranking from only the latest fields and quarters must give the same metrics as the full statements """
+        store = mf.get_statement_store()
+        store.save('balance', mf.balance_sheet)
+        store.save('income', mf.income_statement)
+        store.save('income', {'EMPTY': []})
+        tickers = list(mf.balance_sheet.keys())
+        expected = mf.compute_metrics(tickers)
+        expected_dates = [call_or_none(mf.get_financials_date, ticker) for ticker in tickers[:200]]
+
+        mf.balance_sheet, mf.income_statement = mf.load_ranking_statements(tickers[:200] + ['EMPTY'])
+        self.assertEqual(len(mf.balance_sheet), 200)
+        self.assertEqual(mf.income_statement['EMPTY'], [])
+        self.assertTrue(all(len(statement) <= 4 for statement in mf.income_statement.values()))
+        self.assertTrue(all(len(statement) <= 2 for statement in mf.balance_sheet.values()))
+        metrics = mf.compute_metrics(tickers[:200])
+        mf.pd.testing.assert_frame_equal(metrics, expected.iloc[:200])
+        self.assertEqual([call_or_none(mf.get_financials_date, ticker) for ticker in tickers[:200]], expected_dates)
+
+        # Saving a ticker again rewrites what is loaded for the ranking
+        store.save('income', {'T0': [{'2023-03-31': {'ebit': 1, 'netIncome': 2}}]})
+        self.assertEqual(store.load_latest(['T0'])[1], {'T0': [{'2023-03-31': {'ebit': 1}}]})
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), "pyarrow is not installed")
+    def test_statements_arrow(self):
+        file_name = os.path.join(self.tmp_dir.name, 'balance.arrow')
+        statements = dict(mf.balance_sheet, EMPTY=[], NONE=None, BLANK=[{'2022-06-30': {}}])
+        mf.save_statements_arrow(statements, file_name)
+
+        loaded = mf.load_statements_arrow(file_name)
+        self.assertEqual({ticker: loaded[ticker] for ticker in mf.balance_sheet}, mf.balance_sheet)
+        self.assertEqual((loaded['EMPTY'], loaded['NONE'], loaded['BLANK']), ([], [], [{'2022-06-30': {}}]))
+
+        # Only the batches of the requested fields are read
+        table = mf.read_statements_arrow(file_name, ['cash', 'totalAssets'])
+        self.assertEqual(set(table['field'].to_pylist()), {'cash', 'totalAssets'})
+        loaded = mf.load_statements_arrow(file_name, ['cash'], ['T0', 'T1'])
+        self.assertEqual(sorted(loaded), ['T0', 'T1'])
+        self.assertEqual(loaded['T1'], [{period: {'cash': values['cash']}} for quarter in mf.balance_sheet['T1']
+                                        for period, values in quarter.items() if 'cash' in values])
+
+        # Snapshots are exported from and imported into the store as flat rows
+        store = mf.get_statement_store()
+        store.save('balance', statements)
+        store.save('income', mf.income_statement)
+        old_files = mf.fn_balance, mf.fn_income
+        mf.fn_balance, mf.fn_income = (os.path.join(self.tmp_dir.name, name) for name in ('balance', 'income'))
+        try:
+            mf.export_statements_arrow()
+            store.save('balance', {'T0': [], 'EXTRA': []})
+            mf.import_statements_arrow()
+        finally:
+            mf.fn_balance, mf.fn_income = old_files
+        self.assertEqual(store.load('balance', list(statements) + ['EXTRA']), dict(statements, NONE=[], EXTRA=[]))
+        self.assertEqual(store.load('income'), mf.income_statement)
+        self.assertEqual(store.load_latest(['T0'])[0]['T0'][0], statements['T0'][0])
+
+    @unittest.skipUnless(multiprocessing.get_start_method() == 'fork', "workers must inherit the patched fetch_batch")
+    def test_retrieve_data_pool(self):
+        universe = {'balance': mf.balance_sheet, 'income': mf.income_statement}
+
+        def fetch_batch(ticker_keys, metric):
+            if 'T13' in ticker_keys:
+                raise ConnectionError("throttled")
+            return {statement_type: {ticker: statements[ticker] for ticker in ticker_keys}
+                    for statement_type, statements in universe.items()}
+
+        old_fetch_batch = mf.fetch_batch
+        mf.fetch_batch = fetch_batch
+        try:
+            statements = {'balance': {}, 'income': {}}
+            tickers = list(mf.balance_sheet)[:45]
+            mf.retrieve_data_pool(3, 4, tickers, mf.METRIC_STATEMENTS, statements)
+        finally:
+            mf.fetch_batch = old_fetch_batch
+
+        # Every batch but the failed one is handed back to the parent and saved
+        retrieved = [ticker for ticker in tickers if ticker not in ('T12', 'T13', 'T14', 'T15')]
+        self.assertEqual(statements['income'], {ticker: mf.income_statement[ticker] for ticker in retrieved})
+        self.assertEqual(mf.get_statement_store().load('balance'),
+                         {ticker: mf.balance_sheet[ticker] for ticker in retrieved})
+        mf.get_error_sink().flush()
+        conn = mf.sq.connect(mf.fn_stock_info_db)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM errors WHERE error_type = ?",
+                                      (mf.ERROR_RETRIEVAL,)).fetchone()[0], 4)
+        conn.close()
+
+    def test_response_cache(self):
+        cache = mf.ResponseCache(mf.fn_response_cache, max_bytes=10 ** 6, ttls={'income': 3600, 'volume': 60})
+        now = mf.time.mktime(mf.date(2022, 8, 1).timetuple())
+        cache.put_many('income', {'RECENT': [{'2022-06-30': {'ebit': 1}}, {'2022-03-31': {'ebit': 2}}],
+                                  'OLD': [{'2021-12-31': {'ebit': 3}}], 'EMPTY': None}, now=now)
+        cache.put_many('volume', {'RECENT': 1000}, now=now)
+        self.assertEqual(set(cache.get_many('income', ['RECENT', 'OLD', 'EMPTY', 'NEW'], now=now + 60)),
+                         {'RECENT', 'OLD', 'EMPTY'})
+        # After the TTL, only a statement whose next quarter can't have ended yet is still fresh
+        self.assertEqual(cache.get_many('income', ['RECENT', 'OLD', 'EMPTY'], now=now + 7200),
+                         {'RECENT': [{'2022-06-30': {'ebit': 1}}, {'2022-03-31': {'ebit': 2}}]})
+        self.assertEqual(cache.get_many('income', ['RECENT'], now=now + 60 * 24 * 3600), {})
+        self.assertEqual(cache.get_many('volume', ['RECENT'], now=now + 59), {'RECENT': 1000})
+        self.assertEqual(cache.get_many('volume', ['RECENT'], now=now + 61), {})
+
+        # The least recently used responses are evicted first
+        small = mf.ResponseCache(os.path.join(self.tmp_dir.name, 'small.db'), max_bytes=20, ttls={'volume': 60})
+        small.put_many('volume', {'A': 1111111, 'B': 2222222}, now=now)
+        small.get_many('volume', ['A'], now=now + 1)
+        small.put_many('volume', {'C': 3333333}, now=now + 2)
+        self.assertEqual(small.get_many('volume', ['A', 'B', 'C'], now=now + 3), {'A': 1111111, 'C': 3333333})
+
+    def test_retrieve_cached(self):
+        tickers = ['T0', 'T1', 'T2']
+        mf.get_response_cache().put_many('balance', {ticker: mf.balance_sheet[ticker] for ticker in tickers})
+        mf.get_response_cache().put_many('income', {ticker: mf.income_statement[ticker] for ticker in tickers[:2]})
+        statements = {'balance': {}, 'income': {}}
+        self.assertEqual(mf.retrieve_cached(tickers + ['T3'], mf.METRIC_STATEMENTS, statements), ['T2', 'T3'])
+        self.assertEqual(statements['income'], {ticker: mf.income_statement[ticker] for ticker in tickers[:2]})
+        self.assertEqual(mf.get_statement_store().tickers('balance'), {'T0', 'T1'})
+
+    def test_schedule_refresh(self):
+        mf.balance_sheet = {'A': [{'2022-06-30': {}}], 'B': [{'2022-03-31': {}}], 'C': [{'2021-12-31': {}}]}
+        mf.income_statement = {'A': [{'2022-06-30': {}}], 'B': [{'2022-06-30': {}}], 'C': [{'2021-12-31': {}}]}
+        today = mf.date(2022, 8, 1)
+        # A's next quarter hasn't ended yet; D hasn't been retrieved at all
+        self.assertEqual(mf.schedule_refresh(['A', 'B', 'C', 'D'], 100, today=today), ['D', 'C', 'B'])
+        self.assertEqual(mf.schedule_refresh(['A', 'B', 'C', 'D'], 5, today=today), ['D', 'C'])
+        self.assertEqual(mf.schedule_refresh(['A', 'B', 'C', 'D'], 2, requests_per_ticker=1, today=today), ['D', 'C'])
+
+        # Tickers that were retrieved recently are skipped, even if they haven't filed yet
+        mf.get_response_cache().put_many('balance', {'C': mf.balance_sheet['C']})
+        mf.get_response_cache().put_many('income', {'C': []})
+        self.assertEqual(mf.schedule_refresh(['A', 'B', 'C', 'D'], 4, today=today), ['D', 'B'])
+
+        # A ticker retrieved without statements waits empty_retry_days, then ranks by how long ago it was retrieved
+        mf.get_statement_store().save_all({'balance': {'E': []}, 'income': {'E': []}})
+        today = mf.date.today() + mf.timedelta(days=mf.empty_retry_days - 1)
+        self.assertEqual(mf.schedule_refresh(['A', 'B', 'C', 'D', 'E'], 100, today=today), ['D', 'B', 'A'])
+        today += mf.timedelta(days=1)
+        self.assertEqual(mf.schedule_refresh(['E', 'A', 'B', 'C', 'D'], 100, today=today), ['D', 'B', 'A', 'E'])
+
+    def test_read_screener(self):
+        file_name = os.path.join(self.tmp_dir.name, 'nasdaq_stocks.csv')
+        with open(file_name, 'w') as csv_file:
+            csv_file.write("Symbol,Name,Last Sale,Net Change,% Change,Market Cap,Country,IPO Year,Volume,Sector,"
+                           "Industry\n"
+                           "AAA,AAA Inc. Common Stock,$12.50,0.1,1%,1000000000,United States,2001,500000,Technology,"
+                           "Software\n"
+                           "AAAW,AAA Inc. Warrant,$0.50,0.1,1%,1000,United States,2001,500,Technology,Software\n"
+                           "IDX,Some index fund,$10.00,0.1,1%,1000,United States,2001,500,Finance,Funds\n"
+                           "NOIPO,No IPO Year Corp. Common Stock,$3.00,0.1,1%,5000000,United States,,900,Energy,Oil\n"
+                           "NA,NA Holdings Common Stock,\"$1,234.50\",0.1,1%,2e9,Canada,1999,1000,Finance,Banks\n"
+                           "AAA,AAA Inc. Common Stock,$13.00,0.1,1%,1100000000,United States,2001,600000,Technology,"
+                           "Software\n")
+        screener = mf.read_screener(file_name, chunksize=2)
+        self.assertEqual(list(screener.index), ['NA', 'AAA'])
+        self.assertEqual(screener.loc['AAA', 'price'], 13.0)
+        self.assertEqual(screener.loc['NA', 'price'], 1234.5)
+        self.assertEqual(screener.loc['NA', 'market_cap'], 2e9)
+        self.assertEqual(screener.loc['AAA', 'volume'], 600000)
+        self.assertFalse(mf.is_common_stock("Some Preferred unit"))
+        self.assertTrue(mf.is_common_stock("Apple Inc. Common Stock"))
+
+        mf.save_screener(screener, {'NA': mf.TICKER_NOT_VALIDATED, 'AAA': mf.TICKER_VALID})
+        self.assertEqual(mf.load_ticker_dict(), {'NA': mf.TICKER_NOT_VALIDATED, 'AAA': mf.TICKER_VALID})
+        self.assertEqual(mf.load_prices(), {'NA': 1234.5, 'AAA': 13.0})
+        self.assertEqual(mf.load_volumes(), {'NA': 1000, 'AAA': 600000})
+        self.assertEqual(mf.load_sectors()['NA'], {'sector': 'Finance', 'industry': 'Banks', 'country': 'Canada'})
+
+        # Saving the screener again keeps when and why unchanged tickers were validated, resets the tickers that are
+        # validated again, and deletes the tickers that left the screener
+        mf.save_ticker_status([('AAA', mf.TICKER_VALID, mf.REASON_VALID), ('NA', mf.TICKER_VALID, mf.REASON_VALID)])
+        conn = mf.sq.connect(mf.fn_stock_info_db)
+        validated = conn.execute("SELECT ticker, status, last_validated, reason FROM tickers ORDER BY ticker")
+        validated = validated.fetchall()
+        self.assertEqual((validated[0][0], validated[0][3]), ('AAA', mf.REASON_VALID))
+        self.assertIsNotNone(validated[0][2])
+        screener.loc['NEW'] = screener.loc['AAA']
+        mf.save_screener(screener.drop('NA'), {'AAA': mf.TICKER_VALID, 'NEW': mf.TICKER_NOT_VALIDATED})
+        self.assertEqual(conn.execute("SELECT ticker, status, last_validated, reason FROM tickers ORDER BY ticker")
+                         .fetchall(), [validated[0], ('NEW', mf.TICKER_NOT_VALIDATED, None, None)])
+        conn.close()
+        self.assertEqual(sorted(mf.load_prices()), ['AAA', 'NEW'])
+        self.assertNotIn('NA', mf.load_sectors())
+
+        mf.save_screener(screener.drop('NA'), {'AAA': mf.TICKER_NOT_VALIDATED, 'NEW': mf.TICKER_NOT_VALIDATED})
+        conn = mf.sq.connect(mf.fn_stock_info_db)
+        self.assertEqual(conn.execute("SELECT last_validated, reason FROM tickers WHERE ticker = 'AAA'").fetchone(),
+                         (None, None))
+        conn.close()
+
+    def test_diff_screener(self):
+        def row(price, market_cap, sector='Technology'):
+            return {'price': price, 'market_cap': market_cap, 'volume': 1000, 'sector': sector,
+                    'industry': 'Software', 'country': 'United States'}
+
+        big, small = mf.min_market_cap * 2, mf.min_market_cap / 2
+        screener = mf.pd.DataFrame.from_dict({'SAME': row(10.0, big), 'PRICE': row(11.0, big),
+                                              'SECTOR': row(10.0, big, 'Energy'), 'SHRANK': row(10.0, small),
+                                              'GREW': row(10.0, big), 'NEW': row(10.0, big),
+                                              'MISSING': row(10.0, big)}, orient='index')
+        old_tickers = ['SAME', 'PRICE', 'SECTOR', 'SHRANK', 'GREW', 'GONE', 'MISSING']
+        tickers = {'SAME': mf.TICKER_VALID, 'PRICE': mf.TICKER_VALID, 'SECTOR': mf.TICKER_INVALID,
+                   'SHRANK': mf.TICKER_VALID, 'GREW': mf.TICKER_INVALID, 'GONE': mf.TICKER_VALID,
+                   'MISSING': mf.TICKER_MISSING_INFO}
+        cap_dict = dict.fromkeys(old_tickers, big)
+        cap_dict['GREW'] = small
+        sectors = {ticker: {'sector': 'Technology', 'industry': 'Software', 'country': 'United States'}
+                   for ticker in old_tickers}
+        ticker_dict, added, removed, changed = mf.diff_screener(screener, tickers, cap_dict,
+                                                                dict.fromkeys(old_tickers, 10.0), sectors)
+        self.assertEqual(added, ['NEW'])
+        self.assertEqual(removed, ['GONE'])
+        self.assertEqual(changed, ['PRICE', 'SECTOR', 'SHRANK', 'GREW'])
+        self.assertEqual(ticker_dict, {'SAME': mf.TICKER_VALID, 'PRICE': mf.TICKER_VALID,
+                                       'SECTOR': mf.TICKER_INVALID, 'SHRANK': mf.TICKER_NOT_VALIDATED,
+                                       'GREW': mf.TICKER_NOT_VALIDATED, 'NEW': mf.TICKER_NOT_VALIDATED,
+                                       'MISSING': mf.TICKER_NOT_VALIDATED})
+
+    def test_validate_tickers_locally(self):
+        min_volume = mf.min_dollar_volume
+        mf.price_dict = {'VALID': 10.0, 'LOW': 10.0, 'NEAR': 10.0, 'SMALL': 10.0, 'NOVOLUME': 10.0}
+        mf.volume_dict = {'VALID': min_volume, 'LOW': min_volume / 100, 'NEAR': min_volume / 10 * 0.95,
+                          'SMALL': min_volume}
+        cap_dict = {ticker: mf.min_market_cap * 2 for ticker in mf.price_dict}
+        cap_dict['SMALL'] = mf.min_market_cap / 2
+        tickers = dict.fromkeys(list(mf.price_dict) + ['NOCAP'], mf.TICKER_NOT_VALIDATED)
+        mf.save_ticker_dict(tickers)
+
+        escalated = mf.validate_tickers_locally(list(tickers), tickers, cap_dict, margin=0.1)
+        self.assertEqual(escalated, ['NEAR'])
+        self.assertEqual(tickers, {'VALID': mf.TICKER_VALID, 'LOW': mf.TICKER_INVALID,
+                                   'NEAR': mf.TICKER_NOT_VALIDATED, 'SMALL': mf.TICKER_INVALID,
+                                   'NOVOLUME': mf.TICKER_REMOVE, 'NOCAP': mf.TICKER_REMOVE})
+        self.assertEqual(mf.load_ticker_dict(), tickers)
+
+        # Without a margin, nothing is left for Yahoo Finance
+        mf.local_validation = True
+        try:
+            mf.validate_tickers(tickers, cap_dict, newonly=True)
+        finally:
+            mf.local_validation = False
+        self.assertEqual(tickers['NEAR'], mf.TICKER_INVALID)
+
+    def test_ticker_status(self):
+        mf.save_ticker_dict({'AAA': mf.TICKER_NOT_VALIDATED, 'BBB': mf.TICKER_NOT_VALIDATED, 'CCC': mf.TICKER_VALID})
+        mf.ticker_dict = mf.load_ticker_dict()
+        self.assertFalse(mf.is_tickers_validated())
+
+        mf.set_ticker_status(mf.ticker_dict, [('AAA', mf.TICKER_VALID, mf.REASON_VALID),
+                                              ('BBB', mf.TICKER_INVALID, mf.REASON_SMALL_MARKET_CAP)])
+        self.assertTrue(mf.is_tickers_validated())
+        self.assertEqual(mf.get_valid_ticker_list(), ['AAA', 'CCC'])
+        conn = mf.sq.connect(mf.fn_stock_info_db)
+        rows = conn.execute("SELECT ticker, status, reason, last_validated IS NOT NULL FROM tickers").fetchall()
+        self.assertEqual(rows, [('AAA', mf.TICKER_VALID, mf.REASON_VALID, 1),
+                                ('BBB', mf.TICKER_INVALID, mf.REASON_SMALL_MARKET_CAP, 1),
+                                ('CCC', mf.TICKER_VALID, None, 0)])
+        plan = conn.execute("EXPLAIN QUERY PLAN SELECT ticker FROM tickers WHERE status = 1").fetchall()
+        self.assertIn('tickers_status', str(plan))
+        conn.close()
+
+        # Tickers left out of ticker_dict aren't listed
+        del mf.ticker_dict['CCC']
+        self.assertEqual(mf.get_valid_ticker_list(), ['AAA'])
+
+    def test_universe_tables(self):
+        calls = []
+        old_create = mf._create_universe_tables
+        mf._create_universe_tables = lambda conn: calls.append(old_create(conn))
+        try:
+            mf.save_ticker_dict({'AAA': mf.TICKER_VALID, 'BBB': mf.TICKER_NOT_VALIDATED})
+            mf.get_valid_ticker_list()
+        finally:
+            mf._create_universe_tables = old_create
+        # The tables are created once per db file, not on every save and load
+        self.assertEqual(len(calls), 1)
+        mf.save_prices({'AAA': 10.5})
+        mf.save_market_caps({'AAA': 1e9, 'BBB': 2e9})
+        mf.save_sectors({'AAA': {'sector': 'Technology', 'industry': 'Software', 'country': 'United States'}})
+        self.assertEqual(mf.load_ticker_dict(), {'AAA': mf.TICKER_VALID, 'BBB': mf.TICKER_NOT_VALIDATED})
+        self.assertEqual(mf.load_prices(), {'AAA': 10.5})
+        self.assertEqual(mf.load_market_caps(), {'AAA': 1e9, 'BBB': 2e9})
+        self.assertEqual(mf.load_sectors()['AAA']['industry'], 'Software')
+
+    def test_load_statements_imports_json(self):
+        file_name = os.path.join(self.tmp_dir.name, 'quarterly_income_statement')
+        with open(file_name + '.json', 'w') as json_file:
+            mf.json.dump(mf.income_statement, json_file)
+        self.assertEqual(mf.load_statements('income', file_name), mf.income_statement)
+        os.remove(file_name + '.json')
+        self.assertEqual(mf.load_statements('income', file_name), mf.income_statement)
+
+    def test_backtest(self):
+        tickers = sorted(mf.balance_sheet)
+        # compute_metrics takes the first balance sheet as the most recent one
+        for statement in mf.balance_sheet.values():
+            statement.sort(key=lambda quarter: next(iter(quarter)), reverse=True)
+        price_file = os.path.join(self.tmp_dir.name, 'prices.csv')
+        with open(price_file, 'w') as prices:
+            prices.write("date,ticker,close\n")
+            for i, ticker in enumerate(tickers):
+                prices.write(f"2022-07-01,{ticker},{10 + i}\n2023-01-02,{ticker},{10 + i + i % 7}\n")
+        price_ordinals, closes = mf.load_price_history(price_file, tickers)
+        panel = mf.BacktestPanel(tickers, mf.balance_sheet, mf.income_statement, mf.market_cap_dict, price_ordinals,
+                                 closes, lag=0, min_cap=0)
+
+        # With every quarter public, and the latest close, the metrics are the ones of the live ranking
+        roc, earnings_yield, market_cap, ranked = panel.metrics([mf.date(2023, 1, 2).toordinal()])
+        expected = mf.compute_metrics(tickers)
+        full_year = np.array([len(mf.income_statement[ticker]) >= 4 for ticker in tickers])
+        np.testing.assert_allclose(market_cap[0], expected['market_cap'])
+        np.testing.assert_allclose(roc[0][full_year], expected['roc'][full_year])
+        np.testing.assert_allclose(earnings_yield[0][full_year], expected['yield'][full_year])
+        self.assertFalse(ranked[0][~full_year].any())
+
+        # A quarter that isn't public yet on the as-of date doesn't change the ranking
+        as_of = mf.date(2022, 7, 1).toordinal()
+        before = panel.metrics([as_of])
+        for statement in (mf.balance_sheet, mf.income_statement):
+            statement['T5'] = statement['T5'] + [{'2022-06-30': {'ebit': 10 ** 12, 'cash': 10 ** 12}}]
+        late_panel = mf.BacktestPanel(tickers, mf.balance_sheet, mf.income_statement, mf.market_cap_dict,
+                                      price_ordinals, closes, lag=30, min_cap=0)
+        panel.lag = 30
+        np.testing.assert_array_equal(late_panel.metrics([as_of])[0], panel.metrics([as_of])[0])
+        self.assertFalse(np.array_equal(before[0], panel.metrics([as_of])[0], equal_nan=True))
+
+        holdings, returns = mf.backtest(late_panel, [mf.date(2022, 7, 1), mf.date(2022, 9, 30)], top_n=10, hold=185)
+        self.assertEqual(list(returns['holdings']), [10, 10])
+        first = holdings[holdings['as_of'] == mf.date(2022, 7, 1)]
+        self.assertEqual(list(first['position']), list(range(1, 11)))
+        self.assertTrue(first['magic_rank'].is_monotonic_increasing)
+        positions = [tickers.index(ticker) for ticker in first['ticker']]
+        np.testing.assert_allclose(first['forward_return'], [(i % 7) / (10 + i) for i in positions])
+        # The second portfolio's holding period ends after the price history does
+        self.assertTrue(np.isnan(returns['portfolio_return'].iloc[1]))
+
+        if multiprocessing.get_start_method() == 'fork':
+            pooled, pooled_returns = mf.backtest(late_panel, [mf.date(2022, 7, 1), mf.date(2022, 9, 30)], top_n=10,
+                                                 hold=185, n_processes=2)
+            mf.pd.testing.assert_frame_equal(pooled, holdings)
+
+    def test_backtest_shares_from_balance_sheets(self):
+        """ A ticker that is no longer in market_cap_dict (e.g. delisted) is ranked with its balance sheets' shares """
+        tickers = sorted(ticker for ticker in mf.balance_sheet if len(mf.income_statement[ticker]) >= 4)
+        ticker = tickers[0]
+        del mf.market_cap_dict[ticker]
+        price_ordinals = np.array([mf.date(2023, 1, 2).toordinal()])
+        closes = np.full((1, len(tickers)), 10.0)
+
+        def metrics():
+            panel = mf.BacktestPanel(tickers, mf.balance_sheet, mf.income_statement, mf.market_cap_dict,
+                                     price_ordinals, closes, lag=0, min_cap=0)
+            return panel.metrics(price_ordinals)
+
+        roc, earnings_yield, market_cap, ranked = metrics()
+        self.assertFalse(ranked[0][0])
+        for quarter in mf.balance_sheet[ticker]:
+            next(iter(quarter.values()))['ordinarySharesNumber'] = 1000
+        roc, earnings_yield, market_cap, ranked = metrics()
+        self.assertEqual(market_cap[0][0], 10000)
+        self.assertTrue(ranked[0][0])
+
+    def test_compute_metrics_missing_statement(self):
+        mf.income_statement['T0'] = None
+        del mf.balance_sheet['T1']
+        metrics = mf.compute_metrics(['T0', 'T1', 'T2'])
+        self.assertTrue(np.isnan(metrics.loc['T0', 'roc']))
+        self.assertTrue(np.isnan(metrics.loc['T1', 'yield']))
+
+    def test_metrics(self):
+        metrics = mf.Metrics()
+        metrics.count("errors", type=mf.ERROR_METRIC)
+        metrics.count("errors", 2, type=mf.ERROR_METRIC)
+        metrics.observe("stage_seconds", 0.5, stage="update_db")
+        metrics.observe("stage_seconds", 1.5, stage="update_db")
+        with metrics.locked(mf.dict_lock, "dict_lock"):
+            self.assertTrue(mf.dict_lock.locked())
+        self.assertFalse(mf.dict_lock.locked())
+
+        # A worker process's metrics are added to the parent's
+        worker = mf.Metrics()
+        worker.count("requests", 4, engine="threads", status=200)
+        worker.observe("stage_seconds", 3.0, stage="update_db")
+        metrics.merge(worker.state())
+        self.assertEqual(metrics.timers[("stage_seconds", (("stage", "update_db"),))], [3, 5.0, 3.0])
+        self.assertEqual(metrics.counters[("errors", (("type", mf.ERROR_METRIC),))], 3)
+
+        prometheus = metrics.to_prometheus()
+        self.assertIn('magic_formula_stage_seconds_sum{stage="update_db"} 5.0', prometheus)
+        self.assertIn('magic_formula_stage_seconds_count{stage="update_db"} 3', prometheus)
+        self.assertIn('magic_formula_requests_total{engine="threads",status="200"} 4', prometheus)
+        self.assertIn('magic_formula_lock_wait_seconds_count{lock="dict_lock"} 1', prometheus)
+        self.assertEqual(metrics.to_dict()['counters']['errors'], [{'labels': {'type': mf.ERROR_METRIC}, 'value': 3}])
+
+        # Decorated stages are timed in the module's metrics
+        old_metrics, mf.metrics = mf.metrics, metrics
+        try:
+            mf.update_db(['T0', 'T1'])
+        finally:
+            mf.metrics = old_metrics
+        self.assertEqual(metrics.timers[("stage_seconds", (("stage", "update_db"),))][0], 4)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            metrics.dump(os.path.join(temp_dir, 'metrics.prom'))
+            with open(os.path.join(temp_dir, 'metrics.prom')) as metrics_file:
+                self.assertEqual(metrics_file.read(), metrics.to_prometheus())
+
+    def test_profiler(self):
+        profile_dir = os.path.join(self.tmp_dir.name, 'profile')
+        file_name = os.path.join(self.tmp_dir.name, 'quarterly_income_statement')
+        with open(file_name + '.json', 'w') as json_file:
+            mf.json.dump(mf.income_statement, json_file)
+        mf.profiler = mf.Profiler(profile_dir, top_n=5, trace_memory=True)
+        try:
+            mf.update_db(['T0', 'T1'])
+            mf.update_db(['T2'])
+            mf.load_statements('income', file_name)
+            summary_file_name = mf.profiler.write()
+        finally:
+            profiler, mf.profiler = mf.profiler, None
+
+        # Both calls are in update_db's profile; compute_metrics is profiled as part of update_db
+        self.assertEqual(len(profiler.profiles['update_db']), 2)
+        stats = mf.pstats.Stats(os.path.join(profile_dir, 'update_db.prof'))
+        self.assertIn('compute_metrics', {function for _, _, function in stats.stats})
+        self.assertEqual(profiler.memory[0][0], file_name + '.json')
+        self.assertGreater(profiler.memory[0][3], 0)
+        with open(summary_file_name) as summary_file:
+            summary = summary_file.read()
+        self.assertIn('=== update_db: 2 call(s)', summary)
+        self.assertIn('=== Memory of ' + file_name + '.json', summary)
+
+    def test_profiler_threads(self):
+        profiler = mf.Profiler(os.path.join(self.tmp_dir.name, 'profile'))
+        started, release = mf.threading.Event(), mf.threading.Event()
+
+        def outer():
+            with profiler.stage('outer'):
+                started.set()
+                release.wait(10)
+
+        thread = mf.threading.Thread(target=outer)
+        thread.start()
+        started.wait(10)
+        try:
+            with profiler.stage('inner'):
+                pass
+        finally:
+            release.set()
+            thread.join()
+        # Only with per-thread profiles does a stage in another thread get its own profile
+        self.assertEqual(sorted(profiler.profiles), ['inner', 'outer'] if mf.Profiler.PER_THREAD else ['outer'])
+        self.assertEqual(mf.Profiler._enabled, 0)
+
+    def test_rank_command(self):
+        mf.update_db(list(mf.balance_sheet))
+        conn = mf.sq.connect(mf.fn_stock_info_db)
+        conn.execute("UPDATE stock_info SET most_recent = ?", (mf.date.today().isoformat(),))
+        conn.commit()
+        conn.close()
+        expected = mf.get_ranking(mf.fn_stock_info_db, 10)
+
+        old_dir = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+        try:
+            self.assertEqual(mf.rank_main(['--top', '10', '--group-by', 'sector']), 0)
+            with open('stock_info.csv', newline='') as csv_file:
+                rows = list(csv.DictReader(csv_file))
+            with open('stock_info_by_sector.csv', newline='') as csv_file:
+                self.assertEqual(len(list(csv.DictReader(csv_file))), 10)
+        finally:
+            os.chdir(old_dir)
+        self.assertEqual([row['ticker'] for row in rows], list(expected['ticker']))
+        self.assertEqual([int(row['magic_rank']) for row in rows], list(expected['magic_rank']))
+        self.assertEqual([float(row['roc']) for row in rows], list(expected['roc']))
+
+        # The full run ranks stock_info with the same filters as the rank command, e.g. after an --upsert that left
+        # other sectors' rows in it
+        parser = mf.argparse.ArgumentParser()
+        mf.add_ranking_arguments(parser)
+        conn = mf.sq.connect(mf.fn_stock_info_db)
+        with conn:
+            conn.execute("UPDATE stock_info SET sector = 'Energy' WHERE rowid % 2 = 0")
+        conn.close()
+        sector = 'Energy'
+        os.chdir(self.tmp_dir.name)
+        try:
+            self.assertEqual(mf.rank_main(['--sector', sector]), 0)
+            with open('stock_info.csv', newline='') as csv_file:
+                rank_command_rows = list(csv.DictReader(csv_file))
+            conn = mf.sq.connect(mf.fn_stock_info_db)
+            mf.rank_with_arguments(conn, parser.parse_args(['--sector', sector]))
+            conn.close()
+            with open('stock_info.csv', newline='') as csv_file:
+                full_run_rows = list(csv.DictReader(csv_file))
+        finally:
+            os.chdir(old_dir)
+        self.assertEqual(full_run_rows, rank_command_rows)
+        self.assertEqual({row['sector'] for row in full_run_rows}, {sector})
+        self.assertLess(len(full_run_rows), len(mf.get_ranking(mf.fn_stock_info_db)))
+
+        # The rank command doesn't import numpy, pandas, or the retrieval modules
+        script = (f"import sys; import magic_formula as mf; mf.fn_stock_info_db = {mf.fn_stock_info_db!r}; "
+                  f"status = mf.rank_main(['--top', '5']); "
+                  f"print(status, sorted({{name.split('.')[0] for name in sys.modules if '.' in name}} & "
+                  f"{{'numpy', 'pandas', 'yahoofinancials', 'requests', 'multiprocessing'}}))")
+        output = subprocess.run([sys.executable, '-c', script], cwd=self.tmp_dir.name, capture_output=True, text=True,
+                                env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(mf.__file__))))
+        self.assertEqual(output.stdout.splitlines()[-1], '0 []')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+import asyncio
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import yahoo_async
+
+
+def timeseries_response(symbol):
+    """ A fundamentals-timeseries response with two quarters of EBIT and total assets """
+    return {"timeseries": {"result": [
+        {"meta": {"symbol": [symbol.upper()]}, "timestamp": [1656547200],
+         "quarterlyEBIT": [{"asOfDate": "2022-03-31", "reportedValue": {"raw": 10}},
+                           {"asOfDate": "2022-06-30", "reportedValue": {"raw": 20}}]},
+        {"meta": {"symbol": [symbol.upper()]}, "timestamp": [1656547200],
+         "quarterlyTotalAssets": [{"asOfDate": "2022-06-30", "reportedValue": {"raw": 500}}]},
+    ], "error": None}}
+
+
+class StubYahooHandler(BaseHTTPRequestHandler):
+    """ Serves timeseries responses. "throttled" gets HTTP 429 twice before succeeding, "missing" gets 404, and
+        "broken" always gets 500. Urls longer than max_url_length get 414 """
+    throttled_count = 0
+    max_url_length = None
+    lock = threading.Lock()
+
+    def do_GET(self):
+        if self.max_url_length is not None and len(self.path) > self.max_url_length:
+            return self._reply(414, b"URI Too Long")
+        symbol = self.path.split('?')[0].rsplit('/', 1)[-1]
+        if symbol == 'throttled':
+            with self.lock:
+                StubYahooHandler.throttled_count += 1
+                count = StubYahooHandler.throttled_count
+            if count <= 2:
+                return self._reply(429, b"Too Many Requests", {"Retry-After": "0"})
+        if symbol == 'missing':
+            return self._reply(404, b"Not Found")
+        if symbol == 'broken':
+            return self._reply(500, b"Server Error")
+        self._reply(200, json.dumps(timeseries_response(symbol)).encode())
+
+    def _reply(self, status, body, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestYahooAsync(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubYahooHandler)
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_retrieve(self):
+        retriever = yahoo_async.AsyncRetriever(rate=100, concurrency=4, max_retries=3, backoff_base=0.01,
+                                               base_url=self.base_url)
+        received = []
+        tickers = ['AAA', 'BBB', 'THROTTLED', 'MISSING', 'BROKEN']
+        statements = retriever.retrieve(tickers, 'income', lambda ticker, statement: received.append(ticker))
+        retriever.close()
+
+        self.assertEqual(statements['AAA'], [{'2022-03-31': {'ebit': 10}},
+                                             {'2022-06-30': {'ebit': 20, 'totalAssets': 500}}])
+        self.assertEqual(statements['THROTTLED'], statements['AAA'])
+        self.assertIsNone(statements['MISSING'])
+        self.assertNotIn('BROKEN', statements)
+        self.assertIn('BROKEN', retriever.failures)
+        self.assertEqual(sorted(received), sorted(statements))
+        self.assertEqual(retriever.retry_count, 2 + 3)
+
+    def test_retrieve_combined(self):
+        retriever = yahoo_async.AsyncRetriever(rate=100, concurrency=4, backoff_base=0.01, base_url=self.base_url)
+        statements = retriever.retrieve(['AAA', 'MISSING'], ['balance', 'income'])
+        self.assertEqual(retriever.request_count, 2)
+        self.assertEqual(statements['AAA'], {'balance': [{'2022-06-30': {'totalAssets': 500}}],
+                                             'income': [{'2022-03-31': {'ebit': 10}}, {'2022-06-30': {'ebit': 20}}]})
+        self.assertEqual(statements['MISSING'], {'balance': None, 'income': None})
+
+        # When the combined url is too long for the server, each statement is requested separately
+        StubYahooHandler.max_url_length = 12000
+        try:
+            statements = retriever.retrieve(['AAA', 'BBB'], ['balance', 'income'])
+        finally:
+            StubYahooHandler.max_url_length = None
+            retriever.close()
+        self.assertFalse(retriever.combine)
+        self.assertEqual(statements['BBB'], statements['AAA'])
+        self.assertEqual(sorted(statements['AAA']), ['balance', 'income'])
+        self.assertEqual(statements['AAA']['income'][0], {'2022-03-31': {'ebit': 10}})
+
+    def test_statement_url(self):
+        url = yahoo_async.statement_url('AAPL', 'balance', self.base_url)
+        self.assertTrue(url.startswith(f"{self.base_url}/ws/fundamentals-timeseries/v1/finance/timeseries/aapl?"))
+        self.assertIn("quarterlyTotalAssets", url)
+
+    def test_token_bucket(self):
+        async def acquire_all():
+            bucket = yahoo_async.TokenBucket(rate=50, capacity=1)
+            for _ in range(11):
+                await bucket.acquire()
+
+        start = time.monotonic()
+        asyncio.run(acquire_all())
+        self.assertGreaterEqual(time.monotonic() - start, 0.19)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import os
+import tempfile
+import requests
+from yahoofinancials import YahooFinancials
+import magic_formula as mf
+import yahoo_mock
+
+
+BALANCE = {'AAA': [{'2022-06-30': {'totalAssets': 500, 'accountsPayable': 7}}, {'2022-03-31': {'totalAssets': 400}}],
+           'BBB': [{'2022-06-30': {'totalAssets': 900}}]}
+INCOME = {'AAA': [{'2022-03-31': {'ebit': 10}}, {'2022-06-30': {'ebit': 20}}], 'BBB': [{'2022-06-30': {'ebit': 30}}]}
+
+
+class TestYahooMock(unittest.TestCase):
+    def setUp(self):
+        self.recordings = yahoo_mock.recordings_from_statements(BALANCE, INCOME, {'AAA': 1e9, 'BBB': 2e9},
+                                                                {'AAA': 10.0, 'BBB': 20.0}, {'AAA': 1000, 'BBB': 2000})
+
+    def test_serves_recordings(self):
+        with yahoo_mock.MockYahooServer(self.recordings) as server:
+            harness = yahoo_mock.YahooFinancialsHarness(server.base_url, sleep_scale=0)
+            with harness.active():
+                yahoo_financials = YahooFinancials(['AAA', 'BBB'])
+                statements = yahoo_financials.get_financial_stmts('quarterly', ['balance', 'income'])
+                volumes = yahoo_financials.get_ten_day_avg_daily_volume()
+                market_caps = yahoo_financials.get_market_cap()
+        self.assertEqual(statements['balanceSheetHistoryQuarterly'], BALANCE)
+        self.assertEqual(statements['incomeStatementHistoryQuarterly'], INCOME)
+        self.assertEqual(volumes, {'AAA': 1000, 'BBB': 2000})
+        self.assertEqual(market_caps, {'AAA': 1e9, 'BBB': 2e9})
+        self.assertEqual(harness.summary()['requests'], 8)
+        self.assertEqual(server.requests, {'fundamentals': 4, 'quoteSummary': 4})
+
+    def test_faults(self):
+        with yahoo_mock.MockYahooServer(self.recordings, throttle_rate=1.0) as server:
+            response = requests.get(server.base_url + yahoo_mock.FUNDAMENTALS_PATH + 'aaa?type=quarterlyEBIT')
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '1')
+        with yahoo_mock.MockYahooServer(self.recordings, error_rate=1.0) as server:
+            self.assertEqual(requests.get(server.base_url + '/v6/finance/quoteSummary/aaa?modules=price').status_code,
+                             500)
+
+        # Requests above max_rate are throttled, after a burst of max_rate requests
+        with yahoo_mock.MockYahooServer(self.recordings, max_rate=3) as server:
+            statuses = [requests.get(server.base_url + '/v6/finance/quoteSummary/aaa?modules=price').status_code
+                        for _ in range(5)]
+        self.assertEqual(statuses[:3], [200] * 3)
+        self.assertIn(429, statuses[3:])
+
+    def test_fetch_batch_combines_statements(self):
+        with yahoo_mock.MockYahooServer(self.recordings) as server:
+            with yahoo_mock.YahooFinancialsHarness(server.base_url, sleep_scale=0).active():
+                statements = mf.fetch_batch(['AAA', 'BBB'], mf.METRIC_STATEMENTS)
+        self.assertEqual(statements, {'balance': BALANCE, 'income': INCOME})
+        # One request per ticker for both statements
+        self.assertEqual(server.requests, {'fundamentals': 2})
+
+    def test_retrieve_statements(self):
+        old_globals = {name: getattr(mf, name) for name in ('fn_stock_info_db', 'fn_response_cache', 'echo_errors',
+                                                             'thread_start_delay')}
+        with tempfile.TemporaryDirectory() as work_dir, \
+                yahoo_mock.MockYahooServer(self.recordings, error_rate=0.2, seed=1) as server:
+            mf.fn_stock_info_db = os.path.join(work_dir, 'stock_info.db')
+            mf.fn_response_cache = os.path.join(work_dir, 'response_cache.db')
+            mf.echo_errors, mf.thread_start_delay = False, 0
+            mf.balance_sheet, mf.income_statement = {}, {}
+            try:
+                mf.create_errors_table()
+                with yahoo_mock.YahooFinancialsHarness(server.base_url, sleep_scale=0).active():
+                    mf.retrieve_statements(['AAA', 'BBB'])
+                # Requests that got HTTP 500 are retried by YahooFinancials
+                self.assertGreater(server.statuses[500], 0)
+                self.assertEqual(mf.get_statement_store().load('income'), INCOME)
+            finally:
+                mf.close_error_sink()
+                for name, value in old_globals.items():
+                    setattr(mf, name, value)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+"""
+Asyncio engine for retrieving quarterly financial statements from Yahoo Finance
+
+Requests are paced by a token bucket (so throughput is set by the configured request rate, not by fixed sleeps), the
+number of requests in flight is bounded, and throttled or failed requests are retried with exponential backoff and
+jitter. All requests share one pooled HTTP session. The base URL can be pointed at a local server for offline testing.
+
+Statements are returned in the same shape as YahooFinancials.get_financial_stmts: {ticker: [{date: {field: value}}]}
+Several statement types (e.g. ["balance", "income"]) can be retrieved with a single request per ticker.
+"""
+
+import asyncio
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from json import loads
+
+import requests
+from requests.adapters import HTTPAdapter
+from yahoofinancials.etl import YahooFinanceETL, UrlOpener
+from yahoofinancials.maps import REQUEST_MAP, FUNDAMENTALS_MAP
+
+YAHOO_BASE_URL = "https://query2.finance.yahoo.com"
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+URL_TOO_LONG_STATUS_CODES = (400, 413, 414, 431)  # A server may reject the long url of a combined request
+
+
+class TokenBucket:
+    """ Allows rate acquisitions per second on average, with bursts of up to capacity """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class RetrievalError(Exception):
+    def __init__(self, reason, status=None):
+        super().__init__(reason)
+        self.status = status
+
+
+def _request_types(statement_type):
+    """ The timeseries types (e.g. "quarterlyTotalAssets") that make up a quarterly statement """
+    return FUNDAMENTALS_MAP[YahooFinanceETL.YAHOO_FINANCIAL_TYPES[statement_type][0]]['quarterly']
+
+
+def statement_url(ticker, statement_type, base_url=YAHOO_BASE_URL):
+    """ URL of a ticker's quarterly statement ("balance" or "income"), built the same way YahooFinancials builds it.
+        statement_type can also be a list of statement types, which are then all requested with this one url """
+    statement_types = [statement_type] if isinstance(statement_type, str) else statement_type
+    config = REQUEST_MAP['fundamentals']
+    types = [request_type for statement_type in statement_types for request_type in _request_types(statement_type)]
+    config = dict(config, request=dict(config['request'], type={'options': {'statements': {'quarterly': types}}}))
+    url = YahooFinanceETL(ticker)._construct_url(ticker.lower(), config, {}, 'quarterly', 'statements')
+    return url.replace(YAHOO_BASE_URL, base_url, 1)
+
+
+def parse_statement(text):
+    """ Turns a fundamentals-timeseries response into [{date: {field: value}}, ...], or None if it has no data """
+    try:
+        raw_data = loads(text).get(REQUEST_MAP['fundamentals']['response_field'])
+        data = YahooFinanceETL._format_raw_fundamental_data(raw_data)
+    except (KeyError, TypeError, AttributeError, ValueError):
+        return None
+    return YahooFinanceETL._reformat_stmt_data_process(data)
+
+
+def split_statements(text, statement_types):
+    """ Splits the response of a combined request into {statement_type: [{date: {field: value}}, ...]}. Each
+        statement is None if the response has no data """
+    try:
+        raw_data = loads(text).get(REQUEST_MAP['fundamentals']['response_field'])
+    except (TypeError, AttributeError, ValueError):
+        raw_data = None
+    return split_statement_data(raw_data, statement_types)
+
+
+def split_statement_data(raw_data, statement_types):
+    """ Like split_statements, for the response field of a combined request that was already decoded (e.g. as
+        YahooFinancials caches it) """
+    try:
+        results = raw_data['result']
+    except (KeyError, TypeError):
+        return {statement_type: None for statement_type in statement_types}
+    statements = {}
+    for statement_type in statement_types:
+        types = set(_request_types(statement_type))
+        raw_data = {'result': [result for result in results if any(key in types for key in result)]}
+        data = YahooFinanceETL._format_raw_fundamental_data(raw_data)
+        statements[statement_type] = YahooFinanceETL._reformat_stmt_data_process(data)
+    return statements
+
+
+class AsyncRetriever:
+    """ Retrieves quarterly statements for many tickers concurrently.
+        Retrieving a list of statement types makes one request per ticker for all of them; if the server rejects
+        the long url of those requests, they're split into one request per statement type for the rest of the run.
+
+        rate: average number of requests per second
+        concurrency: maximum number of requests in flight
+        max_retries: number of times a throttled/failed request is retried before the ticker is given up on
+        backoff_base, backoff_cap: the n-th retry waits a random time of up to min(backoff_cap, backoff_base * 2 ** n)
+            seconds (or the server's Retry-After, if it's longer)
+    """
+
+    def __init__(self, rate=2.0, concurrency=8, max_retries=5, backoff_base=1.0, backoff_cap=60.0,
+                 base_url=YAHOO_BASE_URL, timeout=30):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update(UrlOpener.request_headers)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.request_count = 0
+        self.retry_count = 0
+        self.bytes_received = 0
+        self.failures = {}  # ticker -> reason the ticker could not be retrieved
+        self.combine = True  # Whether a list of statement types is retrieved with a single request
+
+    def close(self):
+        self.session.close()
+
+    def _backoff(self, attempt, retry_after=None):
+        delay = random.uniform(0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    async def _get(self, url, bucket, semaphore, executor):
+        """ GETs a url with retries; returns the response text, or None if the ticker doesn't exist (HTTP 404) """
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.max_retries + 1):
+            await bucket.acquire()
+            retry_after = None
+            async with semaphore:
+                self.request_count += 1
+                try:
+                    response = await loop.run_in_executor(
+                        executor, lambda: self.session.get(url, timeout=self.timeout))
+                except requests.RequestException as e:
+                    reason = str(e)
+                else:
+                    with response:
+                        self.bytes_received += len(response.content)
+                        if response.status_code == 200:
+                            return response.text
+                        if response.status_code == 404:
+                            return None
+                        reason = f"HTTP {response.status_code}"
+                        if response.status_code not in RETRY_STATUS_CODES:
+                            raise RetrievalError(reason, response.status_code)
+                        try:
+                            retry_after = float(response.headers.get("Retry-After"))
+                        except (TypeError, ValueError):
+                            pass
+            if attempt < self.max_retries:
+                self.retry_count += 1
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+        raise RetrievalError(f"{reason}, gave up after {self.max_retries} retries")
+
+    async def _fetch_statement(self, ticker, statement_type, bucket, semaphore, executor):
+        if isinstance(statement_type, str):
+            text = await self._get(statement_url(ticker, statement_type, self.base_url), bucket, semaphore, executor)
+            return None if text is None else parse_statement(text)
+        if self.combine:
+            try:
+                text = await self._get(statement_url(ticker, statement_type, self.base_url), bucket, semaphore,
+                                       executor)
+            except RetrievalError as e:
+                if e.status not in URL_TOO_LONG_STATUS_CODES:
+                    raise
+                self.combine = False
+            else:
+                return split_statements(text, statement_type)
+        return {single_type: await self._fetch_statement(ticker, single_type, bucket, semaphore, executor)
+                for single_type in statement_type}
+
+    async def _fetch(self, ticker, statement_type, bucket, semaphore, executor, on_result):
+        try:
+            statement = await self._fetch_statement(ticker, statement_type, bucket, semaphore, executor)
+        except RetrievalError as e:
+            self.failures[ticker] = str(e)
+            return
+        on_result(ticker, statement)
+
+    async def fetch_all(self, tickers, statement_type, on_result):
+        """ Retrieves the statement of each ticker, calling on_result(ticker, statement) as each one arrives.
+            If statement_type is a list of statement types, statement is {statement_type: statement}.
+            Tickers that fail after all retries are left out, and recorded in self.failures """
+        bucket = TokenBucket(self.rate)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            await asyncio.gather(*(self._fetch(ticker, statement_type, bucket, semaphore, executor, on_result)
+                                   for ticker in tickers))
+
+    def retrieve(self, tickers, statement_type, on_result=None):
+        """ Blocking version of fetch_all. Also returns the retrieved statements as {ticker: statement} """
+        statements = {}
+
+        def collect(ticker, statement):
+            statements[ticker] = statement
+            if on_result is not None:
+                on_result(ticker, statement)
+
+        asyncio.run(self.fetch_all(tickers, statement_type, collect))
+        return statements
@@ -0,0 +1,307 @@
+"""
+Local stand-in for the Yahoo Finance endpoints that the Magic Formula script uses
+
+Serves fundamentals-timeseries responses (quarterly balance sheets and income statements) and quoteSummary responses
+(the "price" and "summaryDetail" modules, which hold market caps, prices, and average volumes) from recorded data, with
+configurable latency, random server errors, and HTTP 429 throttling. YahooFinancialsHarness points YahooFinancials at
+the server, so retrieval throughput, tail latency, and retry behavior can be measured without touching Yahoo Finance.
+
+Recordings are {ticker: {"balance": [{date: {field: value}}], "income": [...], "price": {...}, "summaryDetail": {...}}},
+i.e. statements in the same shape as YahooFinancials.get_financial_stmts and the statement store. The server only
+answers the types of a request that a ticker has data for, the way Yahoo Finance does.
+
+Usage: python yahoo_mock.py recordings.json [--port 8000] [--latency 0.2] [--error-rate 0.01] [--max-rate 5]
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+import yahoofinancials.etl as etl
+
+FUNDAMENTALS_PATH = "/ws/fundamentals-timeseries/v1/finance/timeseries/"
+QUOTE_SUMMARY_PATH = re.compile(r"/v\d+/finance/quoteSummary/")
+YAHOO_HOSTS = re.compile(r"https://query[12]\.finance\.yahoo\.com")
+
+
+def field_of_type(request_type):
+    """ The statement field of a timeseries type, the way YahooFinancials names it (e.g. "quarterlyTotalAssets" ->
+        "totalAssets", "quarterlyEBIT" -> "ebit") """
+    field = re.sub(r"^(quarterly|annual|trailing)", "", request_type)
+    return field.lower() if field == "EBIT" else field[0].lower() + field[1:]
+
+
+def recordings_from_statements(balance_sheet, income_statement, market_caps=None, prices=None, volumes=None):
+    """ Builds recordings out of statements, market caps, prices, and ten-day average volumes (e.g. the ones kept in
+        stock_info.db), in the format MockYahooServer serves """
+    market_caps, prices, volumes = market_caps or {}, prices or {}, volumes or {}
+    recordings = {}
+    for ticker in set(balance_sheet) | set(income_statement) | set(market_caps):
+        price = {"regularMarketPrice": prices.get(ticker), "marketCap": market_caps.get(ticker), "currency": "USD"}
+        summary = {"averageDailyVolume10Day": volumes.get(ticker), "marketCap": market_caps.get(ticker)}
+        recordings[ticker.upper()] = {"balance": balance_sheet.get(ticker) or [],
+                                      "income": income_statement.get(ticker) or [],
+                                      "price": price, "summaryDetail": summary}
+    return recordings
+
+
+class MockYahooServer:
+    """ Serves recordings over HTTP on host:port (port 0 picks a free port), from a background thread.
+
+        latency, jitter: every response is delayed latency seconds, plus a random exponential delay with a mean of
+            jitter seconds (so that the latency has a tail)
+        error_rate: fraction of requests answered with HTTP 500
+        throttle_rate: fraction of requests answered with HTTP 429
+        max_rate: requests per second (in bursts of up to max_rate) above which requests are answered with HTTP 429,
+            like Yahoo Finance's rate limiting; None for no limit
+        retry_after: the Retry-After header of HTTP 429 responses, in seconds
+    """
+
+    def __init__(self, recordings, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, max_rate=None,
+                 retry_after=1, host="127.0.0.1", port=0, seed=None):
+        self.recordings = {ticker.upper(): recording for ticker, recording in recordings.items()}
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_rate = max_rate
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tokens = max_rate or 0
+        self._last = time.monotonic()
+        self._fields = {}  # ticker -> {field: [(date, value)]}, built the first time a ticker's statements are served
+        self.requests = Counter()  # Requests by endpoint
+        self.statuses = Counter()  # Responses by HTTP status
+        self._server = ThreadingHTTPServer((host, port), _MockHandler)
+        self._server.daemon_threads = True
+        self._server.mock = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _fault(self):
+        """ The status of an injected fault for the next request (429 or 500), or None """
+        with self._lock:
+            if self.max_rate is not None:
+                now = time.monotonic()
+                self._tokens = min(self.max_rate, self._tokens + (now - self._last) * self.max_rate)
+                self._last = now
+                if self._tokens < 1:
+                    return 429
+                self._tokens -= 1
+            roll = self._random.random()
+            delay = self.latency + (self._random.expovariate(1 / self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+    def _ticker_fields(self, ticker):
+        with self._lock:
+            fields = self._fields.get(ticker)
+            if fields is None:
+                fields = {}
+                recording = self.recordings[ticker]
+                for statement_type in ("balance", "income"):
+                    for quarter in recording.get(statement_type) or []:
+                        for period, values in quarter.items():
+                            for field, value in (values or {}).items():
+                                fields.setdefault(field, []).append((period, value))
+                self._fields[ticker] = fields
+        return fields
+
+    def fundamentals(self, ticker, request_types):
+        """ The fundamentals-timeseries response of a ticker, for the requested types """
+        results = []
+        if ticker in self.recordings:
+            fields = self._ticker_fields(ticker)
+            for request_type in request_types:
+                records = fields.get(field_of_type(request_type))
+                if not records:
+                    continue
+                results.append({
+                    "meta": {"symbol": [ticker], "type": [request_type]},
+                    "timestamp": [int(np.datetime64(period, 's').astype(np.int64)) for period, _ in records],
+                    request_type: [{"asOfDate": period, "periodType": "3M", "currencyCode": "USD",
+                                    "reportedValue": {"raw": value}} for period, value in records]})
+        return 200, {"timeseries": {"result": results, "error": None}}
+
+    def quote_summary(self, ticker, modules):
+        """ The quoteSummary response of a ticker, for the requested modules """
+        if ticker not in self.recordings:
+            return 404, {"quoteSummary": {"result": None, "error": {"code": "Not Found",
+                                                                    "description": "Quote not found for ticker symbol: "
+                                                                                   + ticker}}}
+        recording = self.recordings[ticker]
+        result = {module: recording[module] for module in modules if recording.get(module) is not None}
+        return 200, {"quoteSummary": {"result": [result], "error": None}}
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like Yahoo Finance
+
+    def do_GET(self):
+        mock = self.server.mock
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        ticker = url.path.rsplit("/", 1)[-1].upper()
+        if url.path.startswith(FUNDAMENTALS_PATH):
+            endpoint = "fundamentals"
+        elif QUOTE_SUMMARY_PATH.match(url.path):
+            endpoint = "quoteSummary"
+        else:
+            return self._reply(mock, "other", 404, {"error": "Not Found"})
+
+        status = mock._fault()
+        if status == 429:
+            return self._reply(mock, endpoint, 429, {"error": "Too Many Requests"},
+                               {"Retry-After": str(mock.retry_after)})
+        if status is not None:
+            return self._reply(mock, endpoint, status, {"error": "Internal Server Error"})
+        if endpoint == "fundamentals":
+            request_types = ",".join(query.get("type", [])).split(",")
+            status, body = mock.fundamentals(ticker, [request_type for request_type in request_types if request_type])
+        else:
+            status, body = mock.quote_summary(ticker, ",".join(query.get("modules", [])).split(","))
+        self._reply(mock, endpoint, status, body)
+
+    def _reply(self, mock, endpoint, status, body, headers=None):
+        with mock._lock:
+            mock.requests[endpoint] += 1
+            mock.statuses[status] += 1
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class _ScaledTime:
+    """ Stands in for the time module in yahoofinancials.etl, with every sleep scaled by scale """
+
+    def __init__(self, scale):
+        self.scale = scale
+
+    def sleep(self, seconds):
+        time.sleep(seconds * self.scale)
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+
+class YahooFinancialsHarness:
+    """ Points YahooFinancials (in this process, and processes forked from it) at base_url while active, and records
+        the latency and status of every request it makes.
+
+        min_interval: the minimum number of seconds between two requests (YahooFinancials waits 7 by default)
+        sleep_scale: scales the random 2-10 second waits YahooFinancials makes before retrying a failed request; 1 keeps
+            them as they are
+    """
+
+    def __init__(self, base_url, min_interval=0, sleep_scale=1.0):
+        self.base_url = base_url
+        self.min_interval = min_interval
+        self.sleep_scale = sleep_scale
+        self.latencies = []  # Seconds each request took
+        self.statuses = Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def active(self):
+        original_open = etl.UrlOpener.open
+        original_interval = etl.YahooFinanceETL._MIN_INTERVAL
+        original_time = etl.time
+        harness = self
+
+        def open_local(opener, url, *args, **kwargs):
+            start = time.perf_counter()
+            response = original_open(opener, YAHOO_HOSTS.sub(harness.base_url, url), *args, **kwargs)
+            with harness._lock:
+                harness.latencies.append(time.perf_counter() - start)
+                harness.statuses[response.status_code] += 1
+            return response
+
+        etl.UrlOpener.open = open_local
+        etl.YahooFinanceETL._MIN_INTERVAL = self.min_interval
+        if self.sleep_scale != 1:
+            etl.time = _ScaledTime(self.sleep_scale)
+        try:
+            yield self
+        finally:
+            etl.UrlOpener.open = original_open
+            etl.YahooFinanceETL._MIN_INTERVAL = original_interval
+            etl.time = original_time
+
+    def summary(self):
+        """ Number of requests, their statuses, and their latency percentiles (in seconds) """
+        latencies = np.array(self.latencies)
+        percentiles = [float(p) for p in np.percentile(latencies, [50, 95, 99])] if len(latencies) else [None] * 3
+        return {"requests": len(latencies), "statuses": {str(status): count for status, count in self.statuses.items()},
+                "latency_p50": percentiles[0], "latency_p95": percentiles[1], "latency_p99": percentiles[2],
+                "latency_max": float(latencies.max()) if len(latencies) else None}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves recorded Yahoo Finance responses locally')
+    parser.add_argument('recordings', help='JSON file of recordings')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds every response is delayed')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Mean of an extra, random delay, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests answered with HTTP 429')
+    parser.add_argument('--max-rate', type=float, help='Requests per second above which requests get HTTP 429')
+    args = parser.parse_args()
+
+    with open(args.recordings) as recordings_file:
+        recordings = json.load(recordings_file)
+    server = MockYahooServer(recordings, args.latency, args.jitter, args.error_rate, args.throttle_rate, args.max_rate,
+                             host=args.host, port=args.port)
+    print(f"Serving {len(recordings)} tickers at {server.base_url}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server._server.server_close()
+        print(dict(server.requests), dict(server.statuses))
+
+
+if __name__ == '__main__':
+    main()